@@ -20,6 +20,7 @@ from shapely.geometry import Polygon as SPolygon
 from lofarpipe.support.data_map import DataMap
 from lofarpipe.support.parset import Parset
 from factor.lib.direction import Direction
+from factor.lib.state import get_state_store
 try:
     from matplotlib import pyplot as plt
     from matplotlib.patches import Polygon, Circle
@@ -51,6 +52,11 @@ logging.getLogger('astropy').setLevel(logging.CRITICAL)
 logging.getLogger('factor:parset').setLevel(logging.CRITICAL)
 logging.getLogger('factor:directions').setLevel(logging.CRITICAL)
 
+# Started and completed operations of all directions and names of the
+# directions with a saved state, as read by load_operations()
+all_operations = {}
+directions_with_state = set()
+
 
 def show_instructions():
     log.info('Left-click on a direction to select it and see its current state')
@@ -142,9 +148,9 @@ def load_directions(parset_file):
             log.critical('target_has_own_facet = True, but target RA, Dec, or radius not found in parset')
             sys.exit(1)
 
+    load_operations(parset['dir_working'])
     for direction in directions:
-        has_state = direction.load_state()
-        if has_state:
+        if has_state(direction):
             direction_list.append(direction)
 
     return direction_list, options
@@ -358,7 +364,7 @@ def get_current_info(direction):
     """
     info = 'Selected direction: {}\n'.format(direction.name)
 
-    if not direction.load_state():
+    if not has_state(direction):
         info += 'State not available'
         return info
 
@@ -537,6 +543,7 @@ def update_plot():
     info = 'Updating display...'
     c.set_text(info)
     fig.canvas.draw()
+    load_operations(all_directions[0].working_dir)
     for a in ax.patches:
         if hasattr(a, 'facet_name'):
             for d in all_directions:
@@ -564,7 +571,7 @@ def set_patch_color(a, d):
     """
     global selected_direction
 
-    if not d.load_state():
+    if not has_state(d):
         # Means that state is not available, so set to unprocessed
         a.set_edgecolor('#a9a9a9')
         a.set_facecolor('#F2F2F2')
@@ -646,12 +653,37 @@ def unset_highlight():
                 a.set_linewidth(2)
 
 
+def load_operations(working_dir):
+    """
+    Reads the operations of all directions from the state store
+
+    The started and completed operations of all directions are read with a
+    single query, instead of loading the state of each direction
+    """
+    global all_operations, directions_with_state
+
+    store = get_state_store(working_dir)
+    all_operations = store.get_operations()
+    directions_with_state = set(store.get_names('direction'))
+
+
+def has_state(direction):
+    """
+    Returns True if the direction has a saved state
+    """
+    if len(directions_with_state) == 0:
+        # The state may be in the state files of an earlier version of Factor
+        return direction.load_state()
+    return direction.name in directions_with_state
+
+
 def get_completed_ops(direction):
     """
     Returns list of completed operations
     """
-    has_state = direction.load_state()
-    if has_state:
+    if direction.name in all_operations:
+        return all_operations[direction.name]['completed']
+    elif len(directions_with_state) == 0 and direction.load_state():
         return direction.completed_operations
     else:
         return []
@@ -661,8 +693,9 @@ def get_started_ops(direction):
     """
     Returns list of started operations
     """
-    has_state = direction.load_state()
-    if has_state:
+    if direction.name in all_operations:
+        return all_operations[direction.name]['started']
+    elif len(directions_with_state) == 0 and direction.load_state():
         return direction.started_operations
     else:
         return []
@@ -8,6 +8,7 @@ import numpy as np
 from collections import Counter
 import factor._logging
 import re
+import json
 
 log = logging.getLogger('factor:cluster')
 
@@ -237,3 +238,339 @@ def find_executables(parset):
             log.error('The path to the {0} executable could not be determined. '
                 'Please make sure it is in your PATH.'.format(name))
             sys.exit(1)
+
+
+def get_node_hardware(scratch_dir=None, test_size_mb=256):
+    """
+    Returns the hardware properties of the node on which it is run
+
+    This function is run on each node by probe_nodes(). It must therefore be
+    self-contained (with all imports inside it)
+
+    Parameters
+    ----------
+    scratch_dir : str, optional
+        Scratch directory whose write throughput and free space are measured
+    test_size_mb : int, optional
+        Size in MB of the file written to measure the throughput
+
+    Returns
+    -------
+    hardware : dict
+        Dict with the number of cores ('ncores'), the total memory in MB
+        ('memory_mb'), the size of /dev/shm in MB ('shm_mb'), and the write
+        throughput in MB/s and free space in MB of the scratch directory
+        ('scratch_write_mbps' and 'scratch_free_mb'). Values that could not be
+        measured are None
+
+    """
+    import os
+    import time
+    import uuid
+
+    hardware = {'ncores': None, 'memory_mb': None, 'shm_mb': None,
+        'scratch_write_mbps': None, 'scratch_free_mb': None}
+
+    # Cores available to this process (which may be fewer than those of the
+    # node, e.g., under a SLURM allocation)
+    try:
+        hardware['ncores'] = len(os.sched_getaffinity(0))
+    except AttributeError:
+        hardware['ncores'] = os.sysconf('SC_NPROCESSORS_ONLN')
+
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    hardware['memory_mb'] = int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+
+    try:
+        st = os.statvfs('/dev/shm')
+        hardware['shm_mb'] = st.f_blocks * st.f_frsize / 1024.0**2
+    except OSError:
+        pass
+
+    if scratch_dir is not None and os.path.isdir(scratch_dir):
+        st = os.statvfs(scratch_dir)
+        hardware['scratch_free_mb'] = st.f_bavail * st.f_frsize / 1024.0**2
+        test_file = os.path.join(scratch_dir, 'factor_probe_{0}'.format(
+            uuid.uuid4().hex[0:6]))
+        block = os.urandom(4 * 1024**2)
+        try:
+            start = time.time()
+            with open(test_file, 'wb') as f:
+                for i in range(max(1, test_size_mb // 4)):
+                    f.write(block)
+                f.flush()
+                os.fsync(f.fileno())
+            hardware['scratch_write_mbps'] = (max(1, test_size_mb // 4) * 4 /
+                max(1e-6, time.time() - start))
+        except (IOError, OSError):
+            pass
+        finally:
+            if os.path.exists(test_file):
+                os.remove(test_file)
+
+    return hardware
+
+
+def probe_nodes(node_list, scratch_dir=None):
+    """
+    Probes the hardware of the nodes in parallel
+
+    Parameters
+    ----------
+    node_list : list of str
+        Names of the nodes. Nodes other than localhost are probed over ssh
+    scratch_dir : str, optional
+        Scratch directory whose write throughput is measured
+
+    Returns
+    -------
+    hardware : dict
+        Dict with the hardware properties of each node (see
+        get_node_hardware()), keyed by node name. The value is None for nodes
+        that could not be probed
+
+    """
+    import inspect
+    import subprocess
+    import threading
+
+    script = inspect.getsource(get_node_hardware) + (
+        '\nimport json\nprint(json.dumps(get_node_hardware({0!r})))\n'.format(
+        scratch_dir))
+    hardware = {}
+
+    def probe(node):
+        try:
+            if node == 'localhost':
+                hardware[node] = get_node_hardware(scratch_dir)
+                return
+            p = subprocess.Popen(['ssh', '-o', 'BatchMode=yes', node, 'python',
+                '-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            stdout, stderr = p.communicate(script)
+            if p.returncode != 0:
+                raise RuntimeError(stderr.strip())
+            hardware[node] = json.loads(stdout.strip().split('\n')[-1])
+        except Exception as e:
+            log.warn('Could not probe node {0}: {1}'.format(node, e))
+            hardware[node] = None
+
+    threads = [threading.Thread(target=probe, args=(node,)) for node in
+        set(node_list)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return hardware
+
+
+def set_node_resources(parset):
+    """
+    Probes the nodes and sets the resources to use on each one
+
+    The number of CPUs is the number of cores, the number of IO-intensive
+    threads is the number of jobs that the scratch disk can sustain at about
+    50 MB/s each (or sqrt(ncpu) if there is no scratch disk), and the fraction
+    of memory for WSClean is reduced by the size of the ram drive if
+    dir_local_selfcal is on one. The values given in the parset (if any) are
+    used as upper limits. The resources are stored in
+    parset['cluster_specific']['node_resources'], and ncpu, nthread_io and
+    wsclean_fmem are set to their largest values over all nodes (see
+    get_local_resources() for the resources of the node on which Factor runs)
+
+    Parameters
+    ----------
+    parset : dict
+        Parset dictionary
+
+    """
+    cluster_parset = parset['cluster_specific']
+    node_list = cluster_parset['node_list']
+    limits = cluster_parset['probe_limits']
+    log.info('Probing the hardware of {0} node(s)...'.format(len(set(node_list))))
+    hardware = probe_nodes(node_list, cluster_parset['dir_local'])
+
+    # Save the probe results
+    save_file = os.path.join(parset['dir_working'], 'state', 'node_hardware.json')
+    if not os.path.exists(os.path.dirname(save_file)):
+        os.makedirs(os.path.dirname(save_file))
+    with open(save_file, 'w') as f:
+        json.dump(hardware, f, indent=1)
+
+    node_resources = {}
+    for node in node_list:
+        hw = hardware[node]
+        if hw is None or hw['ncores'] is None:
+            # Probe failed, so fall back to the parset values
+            node_resources[node] = dict([(key, cluster_parset[key]) for key in
+                ['ncpu', 'nthread_io', 'wsclean_fmem']])
+            node_resources[node]['memory_mb'] = None
+            continue
+        ncpu = hw['ncores']
+        if hw['scratch_write_mbps'] is not None:
+            nthread_io = int(hw['scratch_write_mbps'] / 50.0)
+        else:
+            nthread_io = int(np.ceil(np.sqrt(ncpu)))
+        wsclean_fmem = 0.9
+        if (cluster_parset['dir_local_selfcal'] is not None and
+            cluster_parset['dir_local_selfcal'].startswith('/dev/shm') and
+            hw['shm_mb'] is not None and hw['memory_mb'] is not None):
+            wsclean_fmem = max(0.1, wsclean_fmem - hw['shm_mb'] / hw['memory_mb'])
+        ncpu = min(ncpu, limits.get('ncpu', ncpu))
+        nthread_io = max(1, min(nthread_io, ncpu, limits.get('nthread_io', ncpu)))
+        wsclean_fmem = min(wsclean_fmem, limits.get('wsclean_fmem', wsclean_fmem))
+        node_resources[node] = {'ncpu': ncpu, 'nthread_io': nthread_io,
+            'wsclean_fmem': wsclean_fmem, 'memory_mb': hw['memory_mb']}
+        log.info('Node {0}: using up to {1} CPU(s), {2} IO-intensive job(s) and '
+            '{3:.0f}% of the memory for WSClean jobs'.format(node, ncpu,
+            nthread_io, wsclean_fmem*100.0))
+
+    cluster_parset['node_resources'] = node_resources
+    for key in ['ncpu', 'nthread_io', 'wsclean_fmem']:
+        cluster_parset[key] = max([r[key] for r in node_resources.itervalues()])
+
+
+def get_node_resources(parset, hosts):
+    """
+    Returns the resources that can be used on each of a set of nodes
+
+    Parameters
+    ----------
+    parset : dict
+        Parset dictionary
+    hosts : list of str
+        Names of the nodes
+
+    Returns
+    -------
+    resources : dict
+        Dict with the number of CPUs ('ncpu'), number of IO-intensive threads
+        ('nthread_io'), and fraction of memory for WSClean ('wsclean_fmem')
+        that can be used on every one of the nodes, and the smallest memory of
+        the nodes in MB ('memory_mb', None if it is not known for all of them)
+
+    """
+    cluster_parset = parset['cluster_specific']
+    node_resources = cluster_parset.get('node_resources', {})
+    resources = {}
+    for key in ['ncpu', 'nthread_io', 'wsclean_fmem']:
+        values = [node_resources[h][key] for h in hosts if h in node_resources]
+        if len(values) < len(hosts):
+            values.append(cluster_parset[key])
+        resources[key] = min(values)
+    memory = [node_resources[h].get('memory_mb') for h in hosts if h in
+        node_resources]
+    if len(memory) == len(hosts) and None not in memory:
+        resources['memory_mb'] = min(memory)
+    else:
+        resources['memory_mb'] = None
+
+    return resources
+
+
+def get_local_resources(parset):
+    """
+    Returns the resources that can be used on the node on which Factor runs
+
+    If the local node is one of the probed nodes, its resources are used.
+    Otherwise, the parset values are used, limited to the number of cores of
+    the local node. Unlike parset['cluster_specific']['ncpu'] (the largest
+    value over all nodes), the result can be used to size work done by Factor
+    itself (e.g., setting up the bands) without oversubscribing a head node
+    that is smaller than the compute nodes
+
+    Parameters
+    ----------
+    parset : dict
+        Parset dictionary
+
+    Returns
+    -------
+    resources : dict
+        Dict with the same keys as returned by get_node_resources()
+
+    """
+    import socket
+
+    cluster_parset = parset['cluster_specific']
+    node_resources = cluster_parset.get('node_resources', {})
+    for host in ['localhost', socket.gethostname(), socket.getfqdn()]:
+        if host in node_resources:
+            return get_node_resources(parset, [host])
+
+    hw = get_node_hardware()
+    resources = dict([(key, cluster_parset[key]) for key in ['ncpu',
+        'nthread_io', 'wsclean_fmem']])
+    resources['memory_mb'] = hw['memory_mb']
+    if hw['ncores'] is not None:
+        resources['ncpu'] = min(resources['ncpu'], hw['ncores'])
+        resources['nthread_io'] = max(1, min(resources['nthread_io'],
+            resources['ncpu']))
+
+    return resources
+
+
+def get_chunk_size(parset, obs_length_sec, data_rate_mbps,
+    min_chunk_size_sec=1200.0):
+    """
+    Returns the size of the time chunks that suits the nodes
+
+    The chunks are made short enough that each band has at least as many
+    chunks as there are CPUs for each direction (the CPUs of the nodes divided
+    among the directions that are processed at once), so that the steps that
+    run over the chunks (e.g., the solve, apply and predict steps of selfcal)
+    use all CPUs. They are also made
+    short enough that the chunks processed at once on a node fit in its memory.
+    The chunks are never made shorter than min_chunk_size_sec, to limit the
+    overhead of processing many small files
+
+    Parameters
+    ----------
+    parset : dict
+        Parset dictionary
+    obs_length_sec : float
+        Length of the longest observation in s
+    data_rate_mbps : float
+        Memory needed to process a chunk, in MB per second of observation
+    min_chunk_size_sec : float, optional
+        Minimum size of the chunks in s
+
+    Returns
+    -------
+    chunk_size_sec : float
+        Size of the chunks in s
+
+    """
+    cluster_parset = parset['cluster_specific']
+    node_list = cluster_parset['node_list']
+    ncpu = get_node_resources(parset, node_list)['ncpu']
+    ncpu_per_dir = max(1, ncpu / cluster_parset['ndir_per_node'])
+    chunk_size_sec = obs_length_sec / ncpu_per_dir
+
+    # Find the smallest memory of the nodes (as found by probing them, or else
+    # that of this node)
+    memory_mb = None
+    hardware_file = os.path.join(parset['dir_working'], 'state', 'node_hardware.json')
+    if cluster_parset['probe_nodes'] and os.path.exists(hardware_file):
+        with open(hardware_file, 'r') as f:
+            hardware = json.load(f)
+        memory = [hw['memory_mb'] for hw in hardware.itervalues() if hw is not
+            None and hw['memory_mb'] is not None]
+        if len(memory) > 0:
+            memory_mb = min(memory)
+    if memory_mb is None:
+        memory_mb = get_node_hardware()['memory_mb']
+    if memory_mb is not None and data_rate_mbps > 0.0:
+        chunk_size_sec = min(chunk_size_sec, memory_mb / ncpu / data_rate_mbps)
+
+    chunk_size_sec = max(min_chunk_size_sec, chunk_size_sec)
+    log.info('Using time chunks of {0:.0f} s ({1} CPU(s) per '
+        'direction)'.format(chunk_size_sec, ncpu_per_dir))
+
+    return chunk_size_sec
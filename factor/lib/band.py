@@ -9,7 +9,8 @@ import casacore.tables as pt
 import lofar.parmdb
 import numpy as np
 import multiprocessing
-import itertools
+from factor.lib.state import get_state_store
+from factor.lib.solutions import convert_parmdb_to_phasors
 
 
 class Band(object):
@@ -37,11 +38,16 @@ class Band(object):
         Size of chunks in seconds
     use_compression : bool, optional
         If True, use Dysco comprossion on output chunk files
+    use_reference_chunks : bool, optional
+        If True, make the chunks as reference tables instead of copies
+    nthread_io : int, optional
+        Maximum number of input files to check or chunk at once
 
     """
     def __init__(self, MSfiles, factor_working_dir, dirindparmdb,
         skymodel_dirindep=None, local_dir=None, test_run=False, check_files=True,
-        process_files=False, chunk_size_sec=2400.0, use_compression=False):
+        process_files=False, chunk_size_sec=2400.0, use_compression=False,
+        use_reference_chunks=False, nthread_io=1):
 
         self.files = MSfiles
         self.msnames = [ MS.split('/')[-1] for MS in self.files ]
@@ -51,12 +57,11 @@ class Band(object):
         self.numMS = len(self.files)
 
         # Get the frequency info and set name
-        sw = pt.table(self.files[0]+'::SPECTRAL_WINDOW', ack=False)
-        self.freq = sw.col('REF_FREQUENCY')[0]
-        self.nchan = sw.col('NUM_CHAN')[0]
-        self.chan_freqs_hz = sw.col('CHAN_FREQ')[0]
-        self.chan_width_hz = sw.col('CHAN_WIDTH')[0][0]
-        sw.close()
+        metadata = get_ms_metadata(self.files[0], self.working_dir)
+        self.freq = metadata['freq']
+        self.nchan = metadata['nchan']
+        self.chan_freqs_hz = metadata['chan_freqs_hz']
+        self.chan_width_hz = metadata['chan_width_hz']
         self.name = 'Band_{0:.2f}MHz'.format(self.freq/1e6)
         self.log = logging.getLogger('factor:{}'.format(self.name))
         self.log.debug('Band name is {}'.format(self.name))
@@ -70,41 +75,24 @@ class Band(object):
         # Do some checks if desired
         if process_files or not has_state:
             self.check_freqs()
-            self.check_parmdb()
+            self.check_parmdb(nthread_io=nthread_io)
 
             # Get the field RA and Dec
-            obs = pt.table(self.files[0]+'::FIELD', ack=False)
-            self.ra = np.degrees(float(obs.col('REFERENCE_DIR')[0][0][0]))
-            if self.ra < 0.:
-                self.ra = 360.0 + (self.ra)
-            self.dec = np.degrees(float(obs.col('REFERENCE_DIR')[0][0][1]))
-            obs.close()
+            self.ra = metadata['ra']
+            self.dec = metadata['dec']
 
             # Get the station diameter
-            ant = pt.table(self.files[0]+'::ANTENNA', ack=False)
-            self.diam = float(ant.col('DISH_DIAMETER')[0])
-            ant.close()
+            self.diam = metadata['diam']
 
             # Find mean elevation and FOV
+            el_sum = 0.0
+            el_count = 0
             for MS_id in xrange(self.numMS):
-                # Add (virtual) elevation column to MS
-                tab = pt.table(self.files[MS_id], ack=False)
-                exiting_colnames = tab.colnames()
-                if 'AZEL1' not in exiting_colnames:
-                    tab.close()
-                    pt.addDerivedMSCal(self.files[MS_id])
-                    tab = pt.table(self.files[MS_id], ack=False)
-
-                # Calculate mean elevation
-                if MS_id == 0:
-                    global_el_values = tab.getcol('AZEL1', rowincr=10000)[:, 1]
-                else:
-                    global_el_values = np.hstack( (global_el_values, tab.getcol('AZEL1', rowincr=10000)[:, 1]) )
-                tab.close()
-
-                # Remove (virtual) elevation column from MS
-                pt.removeDerivedMSCal(self.files[MS_id])
-            self.mean_el_rad = np.mean(global_el_values)
+                ms_metadata = get_ms_metadata(self.files[MS_id], self.working_dir,
+                    elevation=True)
+                el_sum += ms_metadata['el_sum']
+                el_count += ms_metadata['el_count']
+            self.mean_el_rad = el_sum / el_count
             sec_el = 1.0 / np.sin(self.mean_el_rad)
             self.fwhm_deg = 1.1 * ((3.0e8 / self.freq) / self.diam) * 180. / np.pi * sec_el
 
@@ -112,19 +100,20 @@ class Band(object):
             self.has_sub_data = True
             self.has_sub_data_new = False
             for MSid in xrange(self.numMS):
-                tab = pt.table(self.files[MSid], ack=False)
-                if not 'SUBTRACTED_DATA_ALL' in tab.colnames():
+                ms_metadata = get_ms_metadata(self.files[MSid], self.working_dir)
+                if not 'SUBTRACTED_DATA_ALL' in ms_metadata['colnames']:
                     self.log.error('SUBTRACTED_DATA_ALL column not found in file '
                         '{}'.format(self.files[MSid]))
                     self.has_sub_data = False
-                tab.close()
             if not self.has_sub_data:
                 self.log.info('Exiting...')
                 sys.exit(1)
 
             # cut input files into chunks if needed
             self.chunk_input_files(chunk_size_sec, dirindparmdb, local_dir=local_dir,
-                                   test_run=test_run, use_compression=use_compression)
+                                   test_run=test_run, use_compression=use_compression,
+                                   use_reference_chunks=use_reference_chunks,
+                                   nthread_io=nthread_io)
             if len(self.files) == 0:
                 self.log.warn('No data left after checking input files for band: {}. '
                                'Probably too little unflagged data.'.format(self.name))
@@ -135,17 +124,15 @@ class Band(object):
                 self.starttime = np.finfo('d').max
                 self.endtime = 0.
                 for MSid in xrange(self.numMS):
-                    tab = pt.table(self.files[MSid], ack=False)
-                    self.starttime = min(self.starttime,np.min(tab.getcol('TIME')))
-                    self.endtime = max(self.endtime,np.min(tab.getcol('TIME')))
-                    for t2 in tab.iter(["ANTENNA1","ANTENNA2"]):
-                        if (t2.getcell('ANTENNA1',0)) < (t2.getcell('ANTENNA2',0)):
-                            self.timepersample = t2.col('TIME')[1] - t2.col('TIME')[0]
-                            numsamples = t2.nrows()
-                            self.sumsamples += numsamples
-                            self.minSamplesPerFile = min(self.minSamplesPerFile,numsamples)
-                            break
-                    tab.close()
+                    ms_metadata = get_ms_metadata(self.files[MSid], self.working_dir,
+                        samples=True)
+                    self.starttime = min(self.starttime, ms_metadata['starttime'])
+                    self.endtime = max(self.endtime, ms_metadata['starttime'])
+                    if ms_metadata['baseline_nsamples'] is not None:
+                        self.timepersample = ms_metadata['baseline_timepersample']
+                        numsamples = ms_metadata['baseline_nsamples']
+                        self.sumsamples += numsamples
+                        self.minSamplesPerFile = min(self.minSamplesPerFile,numsamples)
             self.save_state()
 
         self.log.debug("Using {0} files.".format(len(self.files)))
@@ -153,117 +140,33 @@ class Band(object):
             self.log.debug("Using Skymodel: {}".format(os.path.basename(skymodel_dirindep)))
 
 
-    def check_parmdb(self):
-        """
-        Checks the dir-indep instrument parmdb for various problems
+    def check_parmdb(self, nthread_io=1):
         """
-        for pdb_id in xrange(self.numMS):
-            # Check for special BBS table name "instrument"
-            if os.path.basename(self.dirindparmdbs[pdb_id]) == 'instrument':
-                self.dirindparmdbs[pdb_id] += '_dirindep'
-                if not os.path.exists(self.dirindparmdbs[pdb_id]):
-                    if not os.path.exists(os.path.join(self.files[pdb_id], 'instrument')):
-                        self.log.critical('Direction-independent instument parmdb not found '
-                            'for band {0}'.format(self.files[pdb_id]))
-                        sys.exit(1)
-                    self.log.warn('Direction-independent instument parmdb for band {0} is '
-                        'named "instrument". Copying to "instrument_dirindep" so that BBS '
-                        'will not overwrite this table...'.format(self.files[pdb_id]))
-                    os.system('cp -r {0} {1}'.format(os.path.join(self.files[pdb_id],
-                        'instrument'), self.dirindparmdbs[pdb_id]))
-            if not os.path.exists(self.dirindparmdbs[pdb_id]):
-                self.log.critical('Direction-independent instrument parmdb "{0}" not found '
-                    'for band {1}'.format(self.dirindparmdbs[pdb_id], self.files[pdb_id]))
-                sys.exit(1)
-
-            # Check whether there are ampl/phase or real/imag
-            try:
-                pdb = lofar.parmdb.parmdb(self.dirindparmdbs[pdb_id])
-                solname = pdb.getNames()[0]
-            except IndexError:
-                self.log.critical('Direction-independent instument parmdb appears to be empty '
-                            'for band {0}'.format(self.files[pdb_id]))
-                sys.exit(1)
-            if solname[0:4] != 'Gain':
-                self.log.critical('Direction-independent instument parmdb contains not-handled value {0} '
-                                  'for band {1}'.format(solname,self.files[pdb_id]))
-                sys.exit(1)
+        Checks the dir-indep instrument parmdbs for various problems
 
-            if 'Real' in solname or 'Imag' in solname:
-                # Convert real/imag to phasors
-                self.log.warn('Direction-independent instument parmdb for band {0} contains '
-                    'real/imaginary values. Converting to phase/amplitude...'.format(self.files[pdb_id]))
-                self.convert_parmdb_to_phasors_id(pdb_id)
-            pdb = False
-
-            # Check that there aren't extra default values in the parmdb, as this
-            # confuses DPPP
-            pdb = lofar.parmdb.parmdb(self.dirindparmdbs[pdb_id])
-            solname = pdb.getNames()[0]
-            defvals = pdb.getDefValues()
-            for v in defvals:
-                if 'Ampl' not in v and 'Phase' not in v:
-                    pdb.deleteDefValues(v)
-            pdb.flush()
-
-
-    def convert_parmdb_to_phasors_id(self, pdb_id=0):
-        """
-        Converts a single instrument parmdb from real/imag to phasors
+        The parmdbs are checked in parallel (see check_parmdb()), and the
+        results are cached, so that unchanged parmdbs are not checked again
 
         Parameters
         ----------
-        pdb_id : int
-            index of the instrument parmdb to convert
-        """
-        phasors_parmdb_file = self.dirindparmdbs[pdb_id] + '_phasors'
-        pdb_in = lofar.parmdb.parmdb(self.dirindparmdbs[pdb_id])
-        pdb_out = lofar.parmdb.parmdb(phasors_parmdb_file, create=True)
-
-        # Check parmdb for non-handled values
-        solnames = pdb_in.getNames()
-        for name in solnames:
-            if name[0:9] != 'Gain:0:0:' and name[0:9] != 'Gain:1:1:':
-                self.log.critical('Direction-independent instument parmdb contains not-handled value {0} '
-                                  'for band {1}'.format(name,self.files[pdb_id]))
-                sys.exit(1)
+        nthread_io : int, optional
+            Maximum number of parmdbs to check at once
 
-        # Get station names
-        stations = set([s.split(':')[-1] for s in pdb_in.getNames()])
-
-        # Calculate and store phase and amp values for each station
-        parms = pdb_in.getValuesGrid('*')
-        for i, s in enumerate(stations):
-            if i == 0:
-                freqs = np.copy(parms['Gain:0:0:Imag:{}'.format(s)]['freqs'])
-                freqwidths = np.copy(parms['Gain:0:0:Imag:{}'.format(s)]['freqwidths'])
-                times = np.copy(parms['Gain:0:0:Imag:{}'.format(s)]['times'])
-                timewidths = np.copy(parms['Gain:0:0:Imag:{}'.format(s)]['timewidths'])
-
-            valIm_00 = np.copy(parms['Gain:0:0:Imag:{}'.format(s)]['values'][:, 0])
-            valIm_11 = np.copy(parms['Gain:1:1:Imag:{}'.format(s)]['values'][:, 0])
-            valRe_00 = np.copy(parms['Gain:0:0:Real:{}'.format(s)]['values'][:, 0])
-            valRe_11 = np.copy(parms['Gain:1:1:Real:{}'.format(s)]['values'][:, 0])
-
-            valAmp_00 = np.sqrt((valRe_00**2) + (valIm_00**2))
-            valAmp_11 = np.sqrt((valRe_11**2) + (valIm_11**2))
-            valPh_00 = np.arctan2(valIm_00, valRe_00)
-            valPh_11 = np.arctan2(valIm_11, valRe_11)
-
-            pdb_out.addValues({'Gain:0:0:Phase:{}'.format(s): {'freqs': freqs, 'freqwidths':
-                freqwidths, 'times': times, 'timewidths': timewidths, 'values': valPh_00[:,np.newaxis]}})
-            pdb_out.addValues({'Gain:1:1:Phase:{}'.format(s): {'freqs': freqs, 'freqwidths':
-                freqwidths, 'times': times, 'timewidths': timewidths, 'values': valPh_11[:,np.newaxis]}})
-            pdb_out.addValues({'Gain:0:0:Ampl:{}'.format(s): {'freqs': freqs, 'freqwidths':
-                freqwidths, 'times': times, 'timewidths': timewidths, 'values': valAmp_00[:,np.newaxis]}})
-            pdb_out.addValues({'Gain:1:1:Ampl:{}'.format(s): {'freqs': freqs, 'freqwidths':
-                freqwidths, 'times': times, 'timewidths': timewidths, 'values': valAmp_11[:,np.newaxis]}})
-
-        # Write values
-        pdb_out.flush()
-        pdb_in = False
-        pdb_out = False
-        self.dirindparmdbs[pdb_id] = phasors_parmdb_file
+        """
+        tasks = [(self.files[pdb_id], self.dirindparmdbs[pdb_id], self.working_dir,
+            self.name) for pdb_id in xrange(self.numMS)]
+        nprocs = min(nthread_io, len(tasks))
+        if nprocs > 1:
+            pool = multiprocessing.Pool(nprocs)
+            results = pool.map(check_parmdb_star, tasks)
+            pool.close()
+            pool.join()
+        else:
+            results = map(check_parmdb_star, tasks)
+        if None in results:
+            self.log.info('Exiting...')
+            sys.exit(1)
+        self.dirindparmdbs = results
 
 
     def check_freqs(self):
@@ -272,14 +175,13 @@ class Band(object):
         """
         # check that all MSs have the same frequency axis
         for MS_id in xrange(1,self.numMS):
-            sw = pt.table(self.files[MS_id]+'::SPECTRAL_WINDOW', ack=False)
-            if self.freq != sw.col('REF_FREQUENCY')[0] or self.nchan != sw.col('NUM_CHAN')[0] \
-                    or not np.array_equal(self.chan_freqs_hz, sw.getcell('CHAN_FREQ',0)) \
-                    or not np.array_equal(self.chan_width_hz, sw.getcell('CHAN_WIDTH',0)[0] ):
+            metadata = get_ms_metadata(self.files[MS_id], self.working_dir)
+            if self.freq != metadata['freq'] or self.nchan != metadata['nchan'] \
+                    or not np.array_equal(self.chan_freqs_hz, metadata['chan_freqs_hz']) \
+                    or not np.array_equal(self.chan_width_hz, metadata['chan_width_hz']):
                 self.log.critical('Frequency axis for MS {0} differs from the one for MS {1}! '
                                   'Exiting!'.format(self.files[MS_id],self.files[0]))
                 sys.exit(1)
-            sw.close()
 
         # check for gaps in the frequency channels
         self.missing_channels = []
@@ -290,13 +192,16 @@ class Band(object):
 
 
     def chunk_input_files(self, chunksize, dirindparmdb, local_dir=None,
-        test_run=False, min_fraction=0.5, use_compression=False):
+        test_run=False, min_fraction=0.5, use_compression=False,
+        use_reference_chunks=False, nthread_io=1):
         """
         Make copies of input files that are smaller than 2*chunksize
 
         Chops off chunk of chunksize length until remainder is smaller than 2*chunksize
         Generates new self.files, self.msnames, and self.dirindparmdbs
-        The direction independent parmDBs are fully copied into the new MSs
+        The direction independent parmDBs are fully copied into the new MSs. The
+        input files are chunked in parallel, each in a single pass (see
+        chunk_ms())
 
         Parameters
         ----------
@@ -314,36 +219,36 @@ class Band(object):
             to be kept. Only used whn chunking large files. (default = 0.1)
         use_compression : bool, optional
             If True, use Dysco comprossion on output chunk files
+        use_reference_chunks : bool, optional
+            If True, make the chunks as reference tables instead of copies
+            (ignored if use_compression is True)
+        nthread_io : int, optional
+            Maximum number of input files to chunk at once
 
         """
-        newfiles = []
-        newdirindparmdbs = []
+        chunk_tasks = []
+        ms_chunks = []
         for MS_id in xrange(self.numMS):
             nchunks = 1
-            tab = pt.table(self.files[MS_id], ack=False)
+            metadata = get_ms_metadata(self.files[MS_id], self.working_dir)
 
             # Make filter for data columns that we don't need. These include imaging
             # columns and those made during initial subtraction
-            colnames = tab.colnames()
+            colnames = metadata['colnames']
             colnames_to_remove = ['MODEL_DATA', 'CORRECTED_DATA', 'IMAGING_WEIGHT',
                 'SUBTRACTED_DATA_HIGH', 'SUBTRACTED_DATA_ALL_NEW', 'SUBTRACTED_DATA',
                 'LOFAR_FULL_RES_FLAG']
             colnames_to_keep = [c for c in colnames if c not in colnames_to_remove]
 
-            timepersample = tab.getcell('EXPOSURE',0)
-            timetab = tab.sort('unique desc TIME')
-            tab.close()
-            timearray = timetab.getcol('TIME')
-            timetab.close()
-            numsamples = len(timearray)
-            mystarttime = np.min(timearray)
-            myendtime = np.max(timearray)
+            timepersample = metadata['exposure']
+            numsamples = metadata['ntimes']
+            mystarttime = metadata['starttime']
+            myendtime = metadata['endtime']
             assert (timepersample*(numsamples-1)+.5) > (myendtime-mystarttime)
             if (myendtime-mystarttime) > (2.*chunksize):
                 nchunks = int((numsamples*timepersample)/chunksize)
             if test_run:
                 self.log.debug('Would split (or not) {0} into {1} chunks. '.format(self.files[MS_id], nchunks))
-                tab.close()
                 continue
 
             # Define directory where chunks are stored
@@ -353,27 +258,11 @@ class Band(object):
 
             if nchunks > 1 or use_compression:
                 self.log.debug('Spliting {0} into {1} chunks...'.format(self.files[MS_id], nchunks))
-
-                pool = multiprocessing.Pool()
-                results = pool.map(process_chunk_star,
-                    itertools.izip(itertools.repeat(self.files[MS_id]),
-                    itertools.repeat(self.dirindparmdbs[MS_id]),
-                    range(nchunks), itertools.repeat(nchunks),
-                    itertools.repeat(mystarttime),
-                    itertools.repeat(myendtime), itertools.repeat(chunksize),
-                    itertools.repeat(dirindparmdb),
-                    itertools.repeat(colnames_to_keep),
-                    itertools.repeat(newdirname),
-                    itertools.repeat(local_dir),
-                    itertools.repeat(min_fraction),
-                    itertools.repeat(use_compression) ))
-                pool.close()
-                pool.join()
-
-                for chunk_file, chunk_parmdb in results:
-                    if bool(chunk_file) and bool(chunk_parmdb) :
-                        newfiles.append(chunk_file)
-                        newdirindparmdbs.append(chunk_parmdb)
+                ms_chunks.append(len(chunk_tasks))
+                chunk_tasks.append((self.files[MS_id], self.dirindparmdbs[MS_id],
+                    nchunks, chunksize, dirindparmdb, colnames_to_keep, newdirname,
+                    self.working_dir, local_dir, min_fraction, use_compression,
+                    use_reference_chunks))
             else:
                 # Make symlinks for the files
                 chunk_name = '{0}_chunk0.ms'.format(os.path.splitext(os.path.basename(self.files[MS_id]))[0])
@@ -383,9 +272,9 @@ class Band(object):
                 if not os.path.exists(chunk_file):
                     # It's a "new" file, check that the chunk has at least min_fraction
                     # unflagged data. If not, then continue with the for loop over MSs
-                    # This will re-run for bad files every time factor is started, but the
-                    # user could just remove the file from the input directory.
-                    if find_unflagged_fraction(self.files[MS_id]) < min_fraction:
+                    # (the flag statistics are cached, so this check is fast when
+                    # factor is started again)
+                    if find_unflagged_fraction(self.files[MS_id], self.working_dir) < min_fraction:
                         self.log.debug('File {} not used because it contains too little unflagged'
                                        ' data'.format(os.path.basename(self.files[MS_id])))
                         continue
@@ -394,8 +283,30 @@ class Band(object):
                 if not os.path.exists(newdirindparmdb):
                     os.symlink(self.dirindparmdbs[MS_id], newdirindparmdb)
 
-                newfiles.append(chunk_file)
-                newdirindparmdbs.append(newdirindparmdb)
+                ms_chunks.append([(chunk_file, newdirindparmdb)])
+
+        # Chunk the files, using one pool for all of them
+        nprocs = min(nthread_io, len(chunk_tasks))
+        if nprocs > 1:
+            pool = multiprocessing.Pool(nprocs)
+            results = pool.map(chunk_ms_star, chunk_tasks)
+            pool.close()
+            pool.join()
+        else:
+            results = map(chunk_ms_star, chunk_tasks)
+        if None in results:
+            self.log.error('Chunking of one or more files failed. Exiting...')
+            sys.exit(1)
+
+        newfiles = []
+        newdirindparmdbs = []
+        for chunks in ms_chunks:
+            if isinstance(chunks, int):
+                chunks = results[chunks]
+            for chunk_file, chunk_parmdb in chunks:
+                if chunk_file is not None and chunk_parmdb is not None:
+                    newfiles.append(chunk_file)
+                    newdirindparmdbs.append(chunk_parmdb)
 
         # Check that each file has at least min_fraction unflagged data. If not, remove
         # it from the file list.
@@ -403,7 +314,7 @@ class Band(object):
         check_all_unflagged = False
         if check_all_unflagged:
             for f, p in zip(newfiles[:], newdirindparmdbs[:]):
-                if self.find_unflagged_fraction(f) < min_fraction:
+                if find_unflagged_fraction(f, self.working_dir) < min_fraction:
                     newfiles.remove(f)
                     newdirindparmdbs.remove(p)
                     self.log.debug('Skipping file {0} in further processing '
@@ -445,40 +356,347 @@ class Band(object):
 
     def save_state(self):
         """
-        Saves the band state to a file
+        Saves the band state to the state store
 
         """
-        import pickle
-
-        with open(self.save_file, 'wb') as f:
-            # Remove log object, as it cannot be pickled
-            save_dict = self.__dict__.copy()
-            save_dict.pop('log')
-            pickle.dump(save_dict, f)
+        # Remove log object, as it cannot be pickled
+        save_dict = self.__dict__.copy()
+        save_dict.pop('log')
+        get_state_store(self.working_dir).save('band', self.name, save_dict)
 
 
     def load_state(self):
         """
-        Loads the band state from a file
+        Loads the band state from the state store
 
         Returns
         -------
         success : bool
             True if state was successfully loaded, False if not
         """
-        import pickle
+        d = get_state_store(self.working_dir).load('band', self.name,
+            legacy_file=self.save_file)
+        if d is None:
+            return False
+        self.__dict__.update(d)
+        return True
+
+
+
+def check_parmdb_star(inputs):
+    """
+    Simple helper function for pool.map
+
+    Returns None if the check exited on an error, so that the pool does not
+    hang
+    """
+    try:
+        return check_parmdb(*inputs)
+    except SystemExit:
+        return None
+
+
+def check_parmdb(ms_file, parmdb_file, working_dir, band_name):
+    """
+    Checks a dir-indep instrument parmdb for various problems
+
+    A parmdb named "instrument" is copied (so that BBS will not overwrite it),
+    a parmdb with real/imaginary values is converted to phasors, and default
+    values other than amplitudes and phases are removed. The result is cached,
+    keyed by the path and signature of the parmdb, so that the check is skipped
+    if the parmdb was not changed since it was last checked
+
+    Parameters
+    ----------
+    ms_file : str
+        Filename of MS
+    parmdb_file : str
+        Filename of dir-indep instrument parmdb
+    working_dir : str
+        Factor working directory
+    band_name : str
+        Name of band (used for logging)
 
+    Returns
+    -------
+    parmdb_file : str
+        Filename of the checked parmdb to use
+
+    """
+    log = logging.getLogger('factor:{}'.format(band_name))
+
+    # Check for special BBS table name "instrument"
+    if os.path.basename(parmdb_file) == 'instrument':
+        parmdb_file += '_dirindep'
+        if not os.path.exists(parmdb_file):
+            if not os.path.exists(os.path.join(ms_file, 'instrument')):
+                log.critical('Direction-independent instument parmdb not found '
+                    'for band {0}'.format(ms_file))
+                sys.exit(1)
+            log.warn('Direction-independent instument parmdb for band {0} is '
+                'named "instrument". Copying to "instrument_dirindep" so that BBS '
+                'will not overwrite this table...'.format(ms_file))
+            shutil.copytree(os.path.join(ms_file, 'instrument'), parmdb_file)
+    if not os.path.exists(parmdb_file):
+        log.critical('Direction-independent instrument parmdb "{0}" not found '
+            'for band {1}'.format(parmdb_file, ms_file))
+        sys.exit(1)
+
+    store = get_state_store(working_dir)
+    path = os.path.abspath(parmdb_file)
+    cached = store.load_ms_metadata(path, get_ms_signature(parmdb_file))
+    if cached is not None and os.path.exists(cached['checked_parmdb']):
+        return cached['checked_parmdb']
+
+    # Check whether there are ampl/phase or real/imag
+    pdb = lofar.parmdb.parmdb(parmdb_file)
+    solnames = pdb.getNames()
+    if len(solnames) == 0:
+        log.critical('Direction-independent instument parmdb appears to be empty '
+                    'for band {0}'.format(ms_file))
+        sys.exit(1)
+    solname = solnames[0]
+    if solname[0:4] != 'Gain':
+        log.critical('Direction-independent instument parmdb contains not-handled value {0} '
+                          'for band {1}'.format(solname, ms_file))
+        sys.exit(1)
+
+    checked_parmdb_file = parmdb_file
+    if 'Real' in solname or 'Imag' in solname:
+        # Convert real/imag to phasors
+        log.warn('Direction-independent instument parmdb for band {0} contains '
+            'real/imaginary values. Converting to phase/amplitude...'.format(ms_file))
+        for name in solnames:
+            if name[0:9] != 'Gain:0:0:' and name[0:9] != 'Gain:1:1:':
+                log.critical('Direction-independent instument parmdb contains not-handled value {0} '
+                                  'for band {1}'.format(name, ms_file))
+                sys.exit(1)
+        checked_parmdb_file = parmdb_file + '_phasors'
+        pdb_out = lofar.parmdb.parmdb(checked_parmdb_file, create=True)
+        convert_parmdb_to_phasors(pdb, pdb_out)
+        pdb_out = False
+        pdb = lofar.parmdb.parmdb(checked_parmdb_file)
+
+    # Check that there aren't extra default values in the parmdb, as this
+    # confuses DPPP
+    defvals = pdb.getDefValues()
+    for v in defvals:
+        if 'Ampl' not in v and 'Phase' not in v:
+            pdb.deleteDefValues(v)
+    pdb.flush()
+    pdb = False
+
+    # Cache the result with the signature of the parmdb after the check (as
+    # removing default values modifies it)
+    store.save_ms_metadata(path, get_ms_signature(parmdb_file),
+        {'checked_parmdb': checked_parmdb_file})
+
+    return checked_parmdb_file
+
+
+def get_ms_signature(ms_file):
+    """
+    Returns a signature of an MS that changes when the MS is modified
+
+    The signature is made from the modification times and sizes of the MS
+    directory and its main table files, so that it can be made without opening
+    the MS
+
+    Parameters
+    ----------
+    ms_file : str
+        Filename of MS
+
+    Returns
+    -------
+    signature : str
+        Signature of the MS
+
+    """
+    parts = []
+    for path in [ms_file, os.path.join(ms_file, 'table.dat'),
+        os.path.join(ms_file, 'table.f0')]:
         try:
-            with open(self.save_file, 'r') as f:
-                d = pickle.load(f)
-            self.__dict__.update(d)
-            return True
-        except:
-            return False
+            st = os.stat(path)
+            parts.append('{0!r}:{1}'.format(st.st_mtime, st.st_size))
+        except OSError:
+            parts.append('')
+
+    return ';'.join(parts)
+
+
+def get_ms_metadata(ms_file, working_dir, elevation=False, samples=False,
+    flags=False):
+    """
+    Returns the metadata of an MS
+
+    The metadata are cached in the state store of the working directory, keyed
+    by the path of the MS, and are read from the MS only if they are not in
+    the cache or if the MS was modified since they were cached
+
+    Parameters
+    ----------
+    ms_file : str
+        Filename of MS
+    working_dir : str
+        Factor working directory
+    elevation : bool, optional
+        If True, include the sum and number of the elevations of the phase
+        center at the unique times of the MS
+    samples : bool, optional
+        If True, include the time per sample and number of samples of the first
+        cross-correlation baseline
+    flags : bool, optional
+        If True, include the flag statistics (see get_flag_statistics())
+
+    Returns
+    -------
+    metadata : dict
+        Dict with the reference frequency ('freq'), the number, frequencies and
+        width of the channels ('nchan', 'chan_freqs_hz', 'chan_width_hz'), the
+        phase center in degrees ('ra' and 'dec'), the station diameter
+        ('diam'), the mean ITRF position of the stations in m
+        ('array_position'), the column names ('colnames'), the number of rows
+        ('nrows'), the exposure time
+        ('exposure'), the first and last times and number of unique times
+        ('starttime', 'endtime', 'ntimes'), and, if requested, the elevation
+        statistics ('el_sum' and 'el_count'), the baseline samples
+        ('baseline_timepersample' and 'baseline_nsamples', None if there are no
+        cross-correlations), and the flag statistics
+
+    """
+    path = os.path.abspath(ms_file)
+    store = get_state_store(working_dir)
+    signature = get_ms_signature(ms_file)
+    metadata = store.load_ms_metadata(path, signature)
+    if metadata is None:
+        metadata = {}
+    updated = False
+
+    if 'freq' not in metadata or 'nrows' not in metadata:
+        sw = pt.table(ms_file+'::SPECTRAL_WINDOW', ack=False)
+        metadata['freq'] = sw.col('REF_FREQUENCY')[0]
+        metadata['nchan'] = sw.col('NUM_CHAN')[0]
+        metadata['chan_freqs_hz'] = sw.col('CHAN_FREQ')[0]
+        metadata['chan_width_hz'] = sw.col('CHAN_WIDTH')[0][0]
+        sw.close()
+
+        obs = pt.table(ms_file+'::FIELD', ack=False)
+        metadata['ra'] = np.degrees(float(obs.col('REFERENCE_DIR')[0][0][0]))
+        if metadata['ra'] < 0.:
+            metadata['ra'] = 360.0 + (metadata['ra'])
+        metadata['dec'] = np.degrees(float(obs.col('REFERENCE_DIR')[0][0][1]))
+        obs.close()
+
+        ant = pt.table(ms_file+'::ANTENNA', ack=False)
+        metadata['diam'] = float(ant.col('DISH_DIAMETER')[0])
+        metadata['array_position'] = np.mean(ant.getcol('POSITION'), axis=0)
+        ant.close()
+
+        tab = pt.table(ms_file, ack=False)
+        metadata['colnames'] = tab.colnames()
+        metadata['nrows'] = tab.nrows()
+        metadata['exposure'] = tab.getcell('EXPOSURE', 0)
+        timetab = tab.sort('unique desc TIME')
+        tab.close()
+        timearray = timetab.getcol('TIME')
+        timetab.close()
+        metadata['ntimes'] = len(timearray)
+        metadata['starttime'] = np.min(timearray)
+        metadata['endtime'] = np.max(timearray)
+        updated = True
+
+    if elevation and 'el_sum' not in metadata:
+        # Calculate the elevation of the phase center at each unique time (the
+        # time array is read above unless the other metadata were cached)
+        if not updated:
+            tab = pt.table(ms_file, ack=False)
+            timetab = tab.sort('unique desc TIME')
+            tab.close()
+            timearray = timetab.getcol('TIME')
+            timetab.close()
+            if 'array_position' not in metadata:
+                ant = pt.table(ms_file+'::ANTENNA', ack=False)
+                metadata['array_position'] = np.mean(ant.getcol('POSITION'), axis=0)
+                ant.close()
+        el_values = get_elevation(timearray, metadata['ra'], metadata['dec'],
+            metadata['array_position'])
+        metadata['el_sum'] = np.sum(el_values)
+        metadata['el_count'] = len(el_values)
+        updated = True
+
+    if samples and 'baseline_nsamples' not in metadata:
+        metadata['baseline_timepersample'] = None
+        metadata['baseline_nsamples'] = None
+        tab = pt.table(ms_file, ack=False)
+        for t2 in tab.iter(["ANTENNA1","ANTENNA2"]):
+            if (t2.getcell('ANTENNA1',0)) < (t2.getcell('ANTENNA2',0)):
+                metadata['baseline_timepersample'] = t2.col('TIME')[1] - t2.col('TIME')[0]
+                metadata['baseline_nsamples'] = t2.nrows()
+                break
+        tab.close()
+        updated = True
+
+    if flags and 'unflagged_fraction' not in metadata:
+        metadata.update(get_flag_statistics(ms_file))
+        updated = True
+
+    if updated:
+        store.save_ms_metadata(path, signature, metadata)
+
+    return metadata
 
 
+def get_elevation(times, ra_deg, dec_deg, position):
+    """
+    Returns the elevation of a direction as seen from a position on Earth
+
+    The elevation is calculated for all times at once from the local sidereal
+    time. Precession, nutation and refraction are neglected, which changes the
+    elevation by much less than a degree
+
+    Parameters
+    ----------
+    times : array
+        Times as MJD in seconds (as in the TIME column of an MS)
+    ra_deg : float
+        Right ascension (J2000) in degrees
+    dec_deg : float
+        Declination (J2000) in degrees
+    position : array
+        ITRF (x, y, z) position in m
+
+    Returns
+    -------
+    elevation : array
+        Elevation in radians at each time
 
-def find_unflagged_fraction(ms_file):
+    """
+    # Geodetic longitude and latitude (WGS84), using Bowring's formula
+    x, y, z = position
+    a = 6378137.0
+    f = 1.0 / 298.257223563
+    b = a * (1.0 - f)
+    e2 = 1.0 - (b / a)**2
+    ep2 = (a / b)**2 - 1.0
+    p = np.hypot(x, y)
+    theta = np.arctan2(z * a, p * b)
+    lon = np.arctan2(y, x)
+    lat = np.arctan2(z + ep2 * b * np.sin(theta)**3, p - e2 * a * np.cos(theta)**3)
+
+    # Local sidereal time from the Greenwich mean sidereal time
+    jd = np.asarray(times) / 86400.0 + 2400000.5
+    gmst_deg = 280.46061837 + 360.98564736629 * (jd - 2451545.0)
+    hour_angle = np.radians(gmst_deg) + lon - np.radians(ra_deg)
+
+    dec = np.radians(dec_deg)
+    sin_el = (np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) *
+        np.cos(hour_angle))
+
+    return np.arcsin(np.clip(sin_el, -1.0, 1.0))
+
+
+def find_unflagged_fraction(ms_file, working_dir):
     """
     Finds the fraction of data that is unflagged
 
@@ -486,6 +704,8 @@ def find_unflagged_fraction(ms_file):
     ----------
     ms_file : str
         Filename of input MS
+    working_dir : str
+        Factor working directory (used to cache the flag statistics)
 
     Returns
     -------
@@ -493,45 +713,128 @@ def find_unflagged_fraction(ms_file):
         Fraction of unflagged data
 
     """
-    import subprocess
-
-    # Call taql. Note that we do not use pt.taql(), as pt.taql() can cause
-    # hanging/locking issues on some systems
-    p = subprocess.Popen("taql 'CALC sum([select nfalse(FLAG) from {0}]) / "
-        "sum([select nelements(FLAG) from {0}])'".format(ms_file),
-        shell=True, stdout=subprocess.PIPE)
-    r = p.communicate()
-
-    # If the taql subprocess exits abnormally we need to handle it, or we get
-    # a weird error.
-    if p.returncode!=0:
-        # Try using casacore.tables insted
-        try:
-            t = pt.table(ms_file, ack=False)
-            flags_per_element = t.calc('nfalse(FLAG)')
-            nelements = t.calc('nelements(FLAG)')[0] # = number of channels * number of pols
-            unflagged_fraction = float(np.sum(flags_per_element)) / nelements / len(t)
-            t.close()
-        except:
-            print('taql exited abnormally checking flagged fraction for file {}.'.format(ms_file))
-            sys.exit(1)
+    return get_ms_metadata(ms_file, working_dir, flags=True)['unflagged_fraction']
+
+
+def get_unflagged_fraction(flag_stats, starttime=None, endtime=None):
+    """
+    Returns the fraction of data that is unflagged in a time range
+
+    Parameters
+    ----------
+    flag_stats : dict
+        Flag statistics of an MS (see get_flag_statistics())
+    starttime : float, optional
+        Start of time range (inclusive) as MJD in seconds. If None, the range
+        starts at the first time
+    endtime : float, optional
+        End of time range (exclusive) as MJD in seconds. If None, the range
+        ends after the last time
+
+    Returns
+    -------
+    unflagged_fraction : float
+        Fraction of unflagged data (0 if there are no data in the range)
+
+    """
+    in_range = np.ones(len(flag_stats['flag_times']), dtype=bool)
+    if starttime is not None:
+        in_range &= flag_stats['flag_times'] >= starttime
+    if endtime is not None:
+        in_range &= flag_stats['flag_times'] < endtime
+    nelements = np.sum(flag_stats['time_nelements'][in_range])
+    if nelements == 0:
+        return 0.0
+
+    return float(np.sum(flag_stats['time_nunflagged'][in_range])) / nelements
+
+
+def get_flag_statistics(ms_file, block_size_mb=256.0):
+    """
+    Returns the flag statistics of an MS
+
+    The FLAG column is read in blocks of rows, so that the memory use does not
+    depend on the size of the MS
+
+    Parameters
+    ----------
+    ms_file : str
+        Filename of input MS
+    block_size_mb : float, optional
+        Approximate size in MB of the blocks of flags that are read at once
+
+    Returns
+    -------
+    flag_stats : dict
+        Dict with the fraction of unflagged data ('unflagged_fraction'), the
+        fraction per channel ('chan_unflagged_fraction'), and the unique times
+        ('flag_times') with the number of unflagged and total elements at each
+        time ('time_nunflagged' and 'time_nelements'), from which the fraction
+        for any time range can be found with get_unflagged_fraction()
+
+    """
+    tab = pt.table(ms_file, ack=False)
+    flag_times, time_index = np.unique(tab.getcol('TIME'), return_inverse=True)
+    time_nunflagged = np.zeros(len(flag_times))
+    time_nelements = np.zeros(len(flag_times))
+    chan_nunflagged = 0.0
+    chan_nelements = 0.0
+    nrows = len(tab)
+    block_rows = 1
+    if nrows > 0:
+        block_rows = max(1, int(block_size_mb * 1024**2 /
+            np.asarray(tab.getcell('FLAG', 0)).nbytes))
+    for row in xrange(0, nrows, block_rows):
+        flags = tab.getcol('FLAG', startrow=row, nrow=min(block_rows, nrows-row))
+        unflagged = np.logical_not(flags)
+        index = time_index[row:row+len(flags)]
+        time_nunflagged += np.bincount(index, weights=np.sum(unflagged, axis=(1, 2)),
+            minlength=len(flag_times))
+        time_nelements += np.bincount(index, minlength=len(flag_times)) * flags[0].size
+        chan_nunflagged = chan_nunflagged + np.sum(unflagged, axis=(0, 2))
+        chan_nelements += flags.shape[0] * flags.shape[2]
+    tab.close()
+
+    flag_stats = {'flag_times': flag_times, 'time_nunflagged': time_nunflagged,
+        'time_nelements': time_nelements}
+    flag_stats['unflagged_fraction'] = get_unflagged_fraction(flag_stats)
+    if chan_nelements > 0:
+        flag_stats['chan_unflagged_fraction'] = chan_nunflagged / chan_nelements
     else:
-        unflagged_fraction = float(r[0])
+        flag_stats['chan_unflagged_fraction'] = np.zeros(0)
 
-    return unflagged_fraction
+    return flag_stats
 
 
-def process_chunk_star(inputs):
+def chunk_ms_star(inputs):
     """
     Simple helper function for pool.map
+
+    Returns None if the chunking exited on an error, so that the pool does not
+    hang
     """
-    return process_chunk(*inputs)
+    try:
+        return chunk_ms(*inputs)
+    except SystemExit:
+        return None
 
 
-def process_chunk(ms_file, ms_parmdb, chunkid, nchunks, mystarttime, myendtime, chunksize, dirindparmdb,
-    colnames_to_keep, newdirname, local_dir=None, min_fraction=0.1, use_compression=True):
+def chunk_ms(ms_file, ms_parmdb, nchunks, chunksize, dirindparmdb, colnames_to_keep,
+    newdirname, working_dir, local_dir=None, min_fraction=0.1, use_compression=True,
+    use_reference_chunks=False, block_size_mb=256.0):
     """
-    Processes one time chunk of input ms_file and returns new file names
+    Splits input ms_file into time chunks and returns the new file names
+
+    The input MS is read only once: the chunks are contiguous ranges of rows,
+    and the rows of each chunk are streamed in blocks from the input MS to the
+    chunk. Chunks that already exist with the correct number of rows are not
+    written again, and chunks with too little unflagged data (as found from the
+    cached flag statistics of the input MS) are not written at all
+
+    If use_reference_chunks is True (and use_compression is False), the chunks
+    are instead made as reference tables that refer to the rows of the input
+    MS, so that no data are copied. Such a chunk must be copied (see
+    factor.scripts.chunk_by_time.make_copy()) before it is written to
 
     Parameters
     ----------
@@ -539,14 +842,8 @@ def process_chunk(ms_file, ms_parmdb, chunkid, nchunks, mystarttime, myendtime,
         Input MS file to chunk
     ms_parmdb : str
         Input dir-independent parmdb for input MS file
-    chunkid : int
-        ID of chunk
     nchunks : int
         Total number of chunks
-    mystarttime : float
-        Start time of MS file
-    myendtime : float
-        End time of MS file
     chunksize : float
         length of a chunk in seconds
     dirindparmdb : str
@@ -555,6 +852,8 @@ def process_chunk(ms_file, ms_parmdb, chunkid, nchunks, mystarttime, myendtime,
         List of column names to keep in output chunk
     newdirname : str
         Name of output directory
+    working_dir : str
+        Factor working directory (used to cache the flag statistics)
     local_dir : str
         Path to local scratch directory for temp output. The file is then
         copied to the original output directory
@@ -563,157 +862,251 @@ def process_chunk(ms_file, ms_parmdb, chunkid, nchunks, mystarttime, myendtime,
         to be kept
     use_compression : bool, optional
         If True, use Dysco compression on output chunk files
+    use_reference_chunks : bool, optional
+        If True, make the chunks as reference tables instead of copies
+    block_size_mb : float, optional
+        Approximate size in MB of the blocks of rows that are copied at once
 
     Returns
     -------
-    chunk_file : str
-        Filename of chunk MS or None
-    newdirindparmdb : str
-        Filename of direction-independent instrument parmdb for chunk_file or None
+    chunks : list of tuple
+        List of (chunk_file, newdirindparmdb) for each chunk, where both are
+        None if the chunk contains too little unflagged data
 
     """
     log = logging.getLogger('factor:MS-chunker')
-    chunk_name = '{0}_chunk{1}.ms'.format(os.path.splitext(os.path.basename(ms_file))[0], chunkid)
-    chunk_file = os.path.join(newdirname, chunk_name)
-    old_chunk_file = os.path.join(os.path.dirname(ms_file), 'chunks', chunk_name)
-
-    starttime = mystarttime+chunkid*chunksize
-    endtime = mystarttime+(chunkid+1)*chunksize
-    if chunkid == 0:
-        starttime -= chunksize
-    if chunkid == (nchunks-1):
-        endtime += 2.*chunksize
     tab = pt.table(ms_file, lockoptions='autonoread', ack=False)
-    seltab = tab.query('TIME >= ' + str(starttime) + ' && TIME < ' + str(endtime),
-        sortlist='TIME,ANTENNA1,ANTENNA2', columns=','.join(colnames_to_keep))
 
-    copy = True
-    if os.path.exists(chunk_file):
-        try:
-            newtab = pt.table(chunk_file, ack=False)
-            if len(newtab) == len(seltab):
-                copy = False
-                newtab.close()
-            else:
-                log.error('Chunk {0} exists with incorrect length ({1} samples expected, {2} samples found), please check it!'.format(chunk_name, len(seltab), len(newtab)))
-                newtab.close()
-                sys.exit(1)
-        except:
-            copy = True
-        if copy:
-            shutil.rmtree(chunk_file)
-    elif os.path.exists(old_chunk_file):
-        # For compatibility, also search in old location
-        try:
-            newtab = pt.table(old_chunk_file, ack=False)
-            if len(newtab) == len(seltab):
-                copy = False
-                chunk_file = old_chunk_file
-                newtab.close()
+    # Make sure the rows are ordered by time and baseline. If not (which is
+    # unusual), the rows are read through a sorted reference table
+    times = tab.getcol('TIME')
+    order = np.lexsort((tab.getcol('ANTENNA2'), tab.getcol('ANTENNA1'), times))
+    if np.any(order != np.arange(len(order))):
+        sorttab = tab.sort('TIME,ANTENNA1,ANTENNA2')
+        tab.close()
+        tab = sorttab
+        times = times[order]
+    mystarttime = times[0]
+    myendtime = times[-1]
+
+    # Find the times and rows of each chunk. The first and last chunks are
+    # extended to include all times
+    time_ranges = []
+    row_ranges = []
+    for chunkid in range(nchunks):
+        starttime = mystarttime+chunkid*chunksize
+        endtime = mystarttime+(chunkid+1)*chunksize
+        if chunkid == 0:
+            starttime -= chunksize
+        if chunkid == (nchunks-1):
+            endtime += 2.*chunksize
+        time_ranges.append((starttime, endtime))
+        row_ranges.append((np.searchsorted(times, starttime, side='left'),
+            np.searchsorted(times, endtime, side='left')))
+
+    # Find the columns to copy (as (output, input) pairs). Columns with
+    # undefined cells (e.g., FLAG_CATEGORY) are left undefined in the chunks.
+    # With compression, DATA is replaced with SUBTRACTED_DATA_ALL
+    columns = []
+    for colname in colnames_to_keep:
+        if not tab.iscelldefined(colname, 0):
+            continue
+        if use_compression and colname == 'DATA':
+            continue
+        if use_compression and colname == 'SUBTRACTED_DATA_ALL':
+            columns.append(('DATA', colname))
+        else:
+            columns.append((colname, colname))
+    row_bytes = sum([np.asarray(tab.getcell(colname, 0)).nbytes for _, colname
+        in columns])
+    block_rows = max(1, int(block_size_mb * 1024**2 / row_bytes))
+
+    flag_stats = get_ms_metadata(ms_file, working_dir, flags=True)
+    chunks = []
+    for chunkid, (startrow, endrow) in enumerate(row_ranges):
+        nrows = endrow - startrow
+        chunk_name = '{0}_chunk{1}.ms'.format(os.path.splitext(os.path.basename(ms_file))[0], chunkid)
+
+        # Check that the chunk has at least min_fraction unflagged data.
+        # If not, then return (None, None) for it
+        starttime, endtime = time_ranges[chunkid]
+        if get_unflagged_fraction(flag_stats, starttime, endtime) < min_fraction:
+            log.debug('Chunk {} not used because it contains too little unflagged data'.format(chunk_name))
+            chunks.append((None, None))
+            continue
+
+        chunk_file = find_existing_chunk(os.path.join(newdirname, chunk_name),
+            os.path.join(os.path.dirname(ms_file), 'chunks', chunk_name), nrows)
+        if chunk_file is not None:
+            log.debug('Chunk {} exists with correct length, not copying!'.format(chunk_name))
+        elif use_reference_chunks and not use_compression:
+            chunk_file = os.path.join(newdirname, chunk_name)
+            log.debug('Going to make reference table of {0} samples as file '
+                '{1}'.format(nrows, chunk_file))
+            if os.path.exists(chunk_file):
+                shutil.rmtree(chunk_file)
+            reftab = tab.query(columns=','.join(colnames_to_keep), offset=startrow,
+                limit=nrows, name=chunk_file)
+            reftab.close()
+            shutil.copytree(ms_parmdb, os.path.join(chunk_file, dirindparmdb))
+        else:
+            chunk_file = os.path.join(newdirname, chunk_name)
+            log.debug('Going to copy {0} samples to file {1}'.format(nrows, chunk_file))
+            if local_dir is not None:
+                # Set output to temp directory
+                out_file = os.path.join(local_dir, chunk_name)
             else:
-                log.error('Chunk {0} exists with incorrect length ({1} samples expected, {2} samples found), please check it!'.format(chunk_name, len(seltab), len(newtab)))
-                newtab.close()
-                sys.exit(1)
-        except:
-            copy = True
-    else:
-        copy = True
+                out_file = chunk_file
+            if os.path.exists(out_file):
+                shutil.rmtree(out_file)
+
+            # Make the chunk with all rows and copy the input rows to it
+            outtab, nan_columns = make_empty_chunk(tab, out_file, colnames_to_keep,
+                nrows, use_compression)
+            for row in xrange(startrow, endrow, block_rows):
+                nrow = min(block_rows, endrow - row)
+                if len(nan_columns) > 0:
+                    flags = tab.getcol('FLAG', startrow=row, nrow=nrow)
+                for outcolname, colname in columns:
+                    data = tab.getcol(colname, startrow=row, nrow=nrow)
+                    if outcolname in nan_columns:
+                        data[flags] = np.NaN
+                    outtab.putcol(outcolname, data, startrow=row-startrow, nrow=nrow)
+            outtab.close()
+
+            if os.path.realpath(out_file) != os.path.realpath(chunk_file):
+                # Copy temp file to original output location and clean up. The
+                # temp file is removed only once the copy has succeeded
+                if os.path.exists(chunk_file):
+                    shutil.rmtree(chunk_file)
+                try:
+                    shutil.copytree(out_file, chunk_file)
+                except Exception:
+                    shutil.rmtree(chunk_file, ignore_errors=True)
+                    raise
+                shutil.rmtree(out_file)
+
+            shutil.copytree(ms_parmdb, os.path.join(chunk_file, dirindparmdb))
+
+        chunks.append((chunk_file, os.path.join(chunk_file, dirindparmdb)))
+    tab.close()
 
-    newdirindparmdb = os.path.join(chunk_file, dirindparmdb)
+    return chunks
 
-    if copy:
-        log.debug('Going to copy {0} samples to file {1}'.format(str(len(seltab)),chunk_file))
 
-        if local_dir is not None:
-            # Set output to temp directory
-            chunk_file_original = chunk_file
-            chunk_file = os.path.join(local_dir, os.path.basename(chunk_file_original))
-            if os.path.exists(chunk_file):
-                shutil.rmtree(chunk_file)
+def find_existing_chunk(chunk_file, old_chunk_file, nrows):
+    """
+    Finds an existing chunk file with the expected number of rows
 
-        if use_compression:
-            # Replace current storage manager by DyscoStMan if needed
-            log.debug('Compressing file...')
-
-            # Write table to disk so that we can open it in write mode
-            temp_file = chunk_file + '.tmp'
-            seltab.copy(temp_file, deep=True)
-            seltab.close()
-            seltab = pt.table(temp_file, readonly=False, ack=False)
-
-            # Get flags, as we must replace flagged values with NaNs before
-            # compression
-            flags = seltab.getcol('FLAG')
-            flagged = np.where(flags)
-
-            # Replace DATA with SUBTRACTED_DATA_ALL and set flagged values to
-            # NaN (needed for Dysco compression)
-            seltab.renamecol('DATA', 'DATA_TEMP')
-            desc = seltab.getcoldesc('DATA_TEMP')
-            desc['name'] = 'DATA'
-            seltab.addcols(desc)
-            data = seltab.getcol('SUBTRACTED_DATA_ALL')
-            data[flagged] = np.NaN
-            seltab.putcol('DATA', data)
-            seltab.removecols(['DATA_TEMP'])
-            seltab.removecols(['SUBTRACTED_DATA_ALL'])
-
-            # Set DyscoStMan to be storage manager for WEIGHT_SPECTRUM
-            # For the weights, we use a bit rate of 12, as
-            # recommended in Sec 4.4 of Offringa (2016)
-            dmi = {
-                'SPEC': {
-                    'dataBitCount': np.uint32(16),
-                    'distribution': 'TruncatedGaussian',
-                    'distributionTruncation': 1.5,
-                    'normalization': 'RF',
-                    'weightBitCount': np.uint32(12)},
-                'NAME': 'WEIGHT_SPECTRUM_dm',
-                'SEQNR': 1,
-                'TYPE': 'DyscoStMan'}
-
-            # Change WEIGHT_SPECTRUM to a Direct column if needed
-            desc = seltab.getcoldesc('WEIGHT_SPECTRUM')
-            if desc['option'] != 1:
-                seltab.renamecol('WEIGHT_SPECTRUM', 'WEIGHT_SPECTRUM_TEMP')
-                desc = seltab.getcoldesc('WEIGHT_SPECTRUM_TEMP')
-                desc['name'] = 'WEIGHT_SPECTRUM'
-                desc['option'] = 1 # make a Direct column
-                seltab.addcols(desc, dmi)
-                data = seltab.getcol('WEIGHT_SPECTRUM_TEMP')
-                data[flagged] = np.NaN
-                seltab.putcol('WEIGHT_SPECTRUM', data)
-                seltab.removecols(['WEIGHT_SPECTRUM_TEMP'])
-
-            # Save the new table
-            seltab.copy(chunk_file, deep=True)
-        else:
-            # Just use existing storage manager
-            seltab.copy(chunk_file, deep=True)
-
-        if local_dir is not None:
-            # Copy temp file to original output location and clean up
-            chunk_file_destination_dir = os.path.dirname(chunk_file_original)
-            os.system('/bin/cp -r {0} {1}'.format(chunk_file, chunk_file_destination_dir))
-            if not os.path.samefile(chunk_file, chunk_file_original):
+    An unreadable chunk file is removed. A chunk file with a different number
+    of rows is an error
+
+    Parameters
+    ----------
+    chunk_file : str
+        Filename of chunk MS
+    old_chunk_file : str
+        Filename of chunk MS in the old location (for compatibility)
+    nrows : int
+        Expected number of rows
+
+    Returns
+    -------
+    chunk_file : str or None
+        Filename of the existing chunk MS, or None if there is none
+
+    """
+    log = logging.getLogger('factor:MS-chunker')
+    for filename in [chunk_file, old_chunk_file]:
+        if not os.path.exists(filename):
+            continue
+        try:
+            newtab = pt.table(filename, ack=False)
+            nrows_found = len(newtab)
+            newtab.close()
+        except Exception:
+            if filename == chunk_file:
                 shutil.rmtree(chunk_file)
-            chunk_file = chunk_file_original
+            return None
+        if nrows_found != nrows:
+            log.error('Chunk {0} exists with incorrect length ({1} samples expected, '
+                '{2} samples found), please check it!'.format(os.path.basename(filename),
+                nrows, nrows_found))
+            sys.exit(1)
+        return filename
 
-        shutil.copytree(ms_parmdb, newdirindparmdb)
-    else:
-        log.debug('Chunk {} exists with correct length, not copying!'.format(chunk_name))
+    return None
 
-    seltab.close()
-    tab.close()
-    if copy and use_compression:
-        shutil.rmtree(temp_file)
-
-    # Check that the chunk has at least min_fraction unflagged data.
-    # If not, then return (None, None)
-    if find_unflagged_fraction(chunk_file) < min_fraction:
-        log.debug('Chunk {} not used because it contains too little unflagged data'.format(chunk_name))
-        seltab.close()
-        tab.close()
-        return (None, None)
 
-    return (chunk_file, newdirindparmdb)
+def make_empty_chunk(tab, chunk_file, colnames_to_keep, nrows, use_compression):
+    """
+    Makes a chunk MS with the columns and subtables of an input MS
+
+    Parameters
+    ----------
+    tab : table
+        Input MS
+    chunk_file : str
+        Filename of chunk MS
+    colnames_to_keep : list
+        List of column names to keep in chunk
+    nrows : int
+        Number of rows of chunk
+    use_compression : bool
+        If True, replace DATA with SUBTRACTED_DATA_ALL and use Dysco compression
+        for WEIGHT_SPECTRUM
+
+    Returns
+    -------
+    outtab : table
+        Chunk MS, opened for writing
+    nan_columns : list of str
+        Columns in which flagged values must be set to NaN (needed for Dysco
+        compression)
+
+    """
+    # Copy the table without rows to get the column descriptions and the
+    # subtables
+    seltab = tab.query('FALSE', columns=','.join(colnames_to_keep))
+    seltab.copy(chunk_file, deep=True)
+    seltab.close()
+    outtab = pt.table(chunk_file, readonly=False, ack=False)
+
+    nan_columns = []
+    if use_compression:
+        # Replace DATA with SUBTRACTED_DATA_ALL (the DATA column is recreated, to
+        # be filled with SUBTRACTED_DATA_ALL)
+        desc = outtab.getcoldesc('DATA')
+        desc['name'] = 'DATA'
+        outtab.removecols(['DATA', 'SUBTRACTED_DATA_ALL'])
+        outtab.addcols(desc)
+        nan_columns.append('DATA')
+
+        # Set DyscoStMan to be storage manager for WEIGHT_SPECTRUM
+        # For the weights, we use a bit rate of 12, as
+        # recommended in Sec 4.4 of Offringa (2016)
+        dmi = {
+            'SPEC': {
+                'dataBitCount': np.uint32(16),
+                'distribution': 'TruncatedGaussian',
+                'distributionTruncation': 1.5,
+                'normalization': 'RF',
+                'weightBitCount': np.uint32(12)},
+            'NAME': 'WEIGHT_SPECTRUM_dm',
+            'SEQNR': 1,
+            'TYPE': 'DyscoStMan'}
+
+        # Change WEIGHT_SPECTRUM to a Direct column if needed
+        desc = outtab.getcoldesc('WEIGHT_SPECTRUM')
+        if desc['option'] != 1:
+            desc['name'] = 'WEIGHT_SPECTRUM'
+            desc['option'] = 1 # make a Direct column
+            if 'shape' not in desc:
+                desc['shape'] = np.shape(tab.getcell('WEIGHT_SPECTRUM', 0))
+            outtab.removecols(['WEIGHT_SPECTRUM'])
+            outtab.addcols(desc, dmi)
+            nan_columns.append('WEIGHT_SPECTRUM')
+
+    outtab.addrows(nrows)
+
+    return outtab, nan_columns
@@ -0,0 +1,209 @@
+"""
+Definition of the cleanup service that removes files in the background
+"""
+import os
+import atexit
+import logging
+import shutil
+import subprocess
+import tempfile
+import threading
+import Queue
+
+
+log = logging.getLogger('factor:cleanup')
+
+
+class CleanupService(object):
+    """
+    Class that removes files and directories on the nodes in the background
+
+    Removal requests are queued and handled by a bounded number of worker
+    threads, so that the nodes are cleaned up in parallel without starting an
+    unlimited number of rm processes. Paths to be removed on the same node are
+    combined into as few rm calls as possible, and the ssh connection to each
+    node is reused
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Maximum number of removals to run at once
+    batch_size : int, optional
+        Maximum number of paths to remove with a single rm call
+
+    """
+    def __init__(self, max_workers=8, batch_size=100):
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.failures = []
+        self.lock = threading.Lock()
+        self.ssh_control_dir = None
+        self.ssh_hosts = set()
+
+
+    def remove(self, paths, host='localhost'):
+        """
+        Queues paths for removal
+
+        Parameters
+        ----------
+        paths : str or list of str
+            Paths of files or directories to remove
+        host : str, optional
+            Node on which the paths are to be removed
+
+        """
+        if isinstance(paths, basestring):
+            paths = [paths]
+        paths = [p for p in paths if p is not None and p.strip() not in ['', '/']]
+        if len(paths) == 0:
+            return
+
+        for i in range(0, len(paths), self.batch_size):
+            self.queue.put((host, paths[i:i+self.batch_size]))
+
+        # Start new workers if needed (up to the maximum number)
+        with self.lock:
+            while len(self.workers) < min(self.max_workers, self.queue.qsize()):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+
+    def wait(self):
+        """
+        Waits until all queued removals are done and reports any failures
+
+        """
+        self.queue.join()
+        with self.lock:
+            failures = self.failures
+            self.failures = []
+        if len(failures) > 0:
+            log.warn('Cleanup failed for {0} removal(s). Some temporary data may '
+                'need to be removed by hand'.format(len(failures)))
+
+
+    def _work(self):
+        """
+        Runs queued removals
+        """
+        while True:
+            task = self.queue.get()
+            if task is None:
+                # Signal to stop
+                self.queue.task_done()
+                return
+            host, paths = task
+            try:
+                self._remove(host, paths)
+            except Exception as e:
+                self._report_failure(host, paths, str(e))
+            finally:
+                self.queue.task_done()
+
+
+    def _remove(self, host, paths):
+        """
+        Removes paths on a host
+        """
+        if host == 'localhost':
+            cmd = ['rm', '-rf'] + paths
+        else:
+            cmd = ['ssh'] + self._get_ssh_options() + [host, 'rm', '-rf'] + paths
+            with self.lock:
+                self.ssh_hosts.add(host)
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            self._report_failure(host, paths, stderr.strip())
+
+
+    def _get_ssh_options(self):
+        """
+        Returns the ssh options that make connections to the same node reuse a
+        single master connection
+        """
+        with self.lock:
+            if self.ssh_control_dir is None:
+                self.ssh_control_dir = tempfile.mkdtemp(prefix='factor_ssh_')
+        return ['-o', 'BatchMode=yes', '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={0}'.format(os.path.join(self.ssh_control_dir,
+            '%r@%h:%p')), '-o', 'ControlPersist=60']
+
+
+    def _stop_ssh_masters(self):
+        """
+        Stops the master connections to the nodes, as they would otherwise
+        persist after their control directory is removed
+        """
+        with self.lock:
+            hosts = self.ssh_hosts
+            self.ssh_hosts = set()
+        for host in hosts:
+            cmd = ['ssh', '-o', 'ControlPath={0}'.format(os.path.join(
+                self.ssh_control_dir, '%r@%h:%p')), '-O', 'exit', host]
+            try:
+                p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+                p.communicate()
+            except OSError as e:
+                log.debug('Could not stop ssh master connection to {0}: '
+                    '{1}'.format(host, e))
+
+
+    def _report_failure(self, host, paths, message):
+        """
+        Logs and records a failed removal
+        """
+        log.warn('Could not remove {0} on {1}: {2}'.format(', '.join(paths), host,
+            message))
+        with self.lock:
+            self.failures.append((host, paths, message))
+
+
+    def close(self):
+        """
+        Waits for the queued removals, stops the workers, and stops the ssh
+        master connections and removes their control directory
+
+        """
+        self.wait()
+        with self.lock:
+            workers = self.workers
+            self.workers = []
+        for worker in workers:
+            self.queue.put(None)
+        for worker in workers:
+            worker.join()
+        if self.ssh_control_dir is not None:
+            self._stop_ssh_masters()
+            shutil.rmtree(self.ssh_control_dir, ignore_errors=True)
+            self.ssh_control_dir = None
+
+
+_service = None
+
+
+def get_cleanup_service():
+    """
+    Returns the cleanup service, starting it if needed
+
+    The queued removals are completed before Python exits
+
+    Returns
+    -------
+    service : CleanupService instance
+        The cleanup service
+
+    """
+    global _service
+
+    if _service is None:
+        _service = CleanupService()
+        atexit.register(_service.close)
+
+    return _service
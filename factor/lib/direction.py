@@ -12,6 +12,7 @@ from scipy.ndimage import gaussian_filter
 from scipy.special import erf
 import sys
 import glob
+from factor.lib.state import get_state_store
 
 
 class Direction(object):
@@ -116,6 +117,7 @@ class Direction(object):
         self.target_rms_rad = 0.2 # preaverage target rms
         self.subtracted_data_colname = 'SUBTRACTED_DATA_ALL' # name of empty data column
         self.use_compression = False # whether to use Dysco compression
+        self.use_reference_chunks = False # whether the chunks are reference tables
         self.pre_average = False # whether to use baseline averaging
         self.peel_calibrator = False # whether to peel calibrator before imaging
         self.solve_all_correlations = False # whether to solve for all corrs for slow gain
@@ -139,7 +141,8 @@ class Direction(object):
         self.working_dir = factor_working_dir
         self.save_file = os.path.join(self.working_dir, 'state',
             self.name+'_save.pkl')
-        self.vertices_file = self.save_file
+        self.vertices_file = os.path.join(self.working_dir, 'state',
+            self.name+'_vertices.pkl')
 
 
     def set_cal_size(self, selfcal_cellsize_arcsec):
@@ -936,22 +939,35 @@ class Direction(object):
 
     def save_state(self):
         """
-        Saves the direction state to a file
+        Saves the direction state to the state store
+
+        The vertices are also saved to a separate file (if they have changed),
+        as it is read by the pipeline scripts
 
         """
         import pickle
 
-        with open(self.save_file, 'wb') as f:
-            # Remove log and skymodel objects, as they cannot be pickled
-            save_dict = self.__dict__.copy()
-            save_dict.pop('log')
-            save_dict.pop('skymodel')
-            pickle.dump(save_dict, f)
+        # Remove log and skymodel objects, as they cannot be pickled
+        save_dict = self.__dict__.copy()
+        save_dict.pop('log')
+        save_dict.pop('skymodel')
+        save_dict.pop('saved_vertices', None)
+        get_state_store(self.working_dir).save('direction', self.name, save_dict,
+            self.started_operations, self.completed_operations)
+
+        vertices = dict([(key, save_dict[key]) for key in ['vertices',
+            'vertices_cal'] if key in save_dict])
+        if len(vertices) > 0 and (getattr(self, 'saved_vertices', None) !=
+            vertices or not os.path.exists(self.vertices_file)):
+            with open(self.vertices_file+'.tmp', 'wb') as f:
+                pickle.dump(vertices, f)
+            os.rename(self.vertices_file+'.tmp', self.vertices_file)
+            self.saved_vertices = vertices
 
 
     def load_state(self):
         """
-        Loads the direction state from a file
+        Loads the direction state from the state store
 
         Note: only state attributes are loaded to avoid overwritting
         non-state attributes
@@ -961,29 +977,48 @@ class Direction(object):
         success : bool
             True if state was successfully loaded, False if not
         """
-        import pickle
-
-        try:
-            with open(self.save_file, 'r') as f:
-                d = pickle.load(f)
-
-                # Load list of started operations
-                if 'started_operations' in d:
-                    self.started_operations = d['started_operations']
-
-                # Load list of completed operations
-                if 'completed_operations' in d:
-                    self.completed_operations = d['completed_operations']
-
-                # Load mapfiles needed for facetsubreset
-                if 'converted_parmdb_mapfile' in d:
-                    self.converted_parmdb_mapfile = d['converted_parmdb_mapfile']
-                if 'sourcedb_new_facet_sources' in d:
-                    self.sourcedb_new_facet_sources = d['sourcedb_new_facet_sources']
-            return True
-        except:
+        d = get_state_store(self.working_dir).load('direction', self.name,
+            legacy_file=self.save_file)
+        if d is None:
             return False
 
+        # Load list of started operations
+        if 'started_operations' in d:
+            self.started_operations = d['started_operations']
+
+        # Load list of completed operations
+        if 'completed_operations' in d:
+            self.completed_operations = d['completed_operations']
+
+        # Load mapfiles needed for facetsubreset
+        if 'converted_parmdb_mapfile' in d:
+            self.converted_parmdb_mapfile = d['converted_parmdb_mapfile']
+        if 'sourcedb_new_facet_sources' in d:
+            self.sourcedb_new_facet_sources = d['sourcedb_new_facet_sources']
+        return True
+
+
+    def load_operations(self):
+        """
+        Loads the lists of started and completed operations from the state store
+
+        This is much faster than loading the full state with load_state()
+
+        Returns
+        -------
+        success : bool
+            True if state was successfully loaded, False if not
+        """
+        operations = get_state_store(self.working_dir).get_operations(self.name)
+        if self.name not in operations:
+            # The direction has no started or completed operations, or its
+            # state has not been saved to the store yet
+            return self.load_state()
+
+        self.started_operations = operations[self.name]['started']
+        self.completed_operations = operations[self.name]['completed']
+        return True
+
 
     def reset_state(self, op_names=None):
         """
@@ -1035,10 +1070,14 @@ class Direction(object):
     def cleanup(self):
         """
         Cleans up unneeded data
+
+        The files are removed in the background by the cleanup service
         """
         from lofarpipe.support.data_map import DataMap
+        from factor.lib.cleanup import get_cleanup_service
         import glob
 
+        remove_files = []
         for mapfile in self.cleanup_mapfiles:
             try:
                 datamap = DataMap.load(mapfile)
@@ -1050,14 +1089,14 @@ class Direction(object):
                         files = [item.file]
                     for f in files:
                         if os.path.exists(f):
-                            os.system('rm -rf {0} &'.format(f))
+                            remove_files.append(f)
 
                             # Also delete associated "_CONCAT" files that result
                             # from virtual concatenation
                             extra_files = glob.glob(f+'_CONCAT')
                             for e in extra_files:
                                 if os.path.exists(e):
-                                    os.system('rm -rf {0} &'.format(e))
+                                    remove_files.append(e)
 
                         # Deal with special case of f being a WSClean image
                         if f.endswith('MFS-image.fits'):
@@ -1066,13 +1105,14 @@ class Direction(object):
                             extra_files = glob.glob(image_root+'*.fits')
                             for e in extra_files:
                                 if os.path.exists(e):
-                                    os.system('rm -rf {0} &'.format(e))
+                                    remove_files.append(e)
                         elif f.endswith('-image.fits'):
                             # Search for related images and delete if found
                             image_root = f.split('-image.fits')[0]
                             extra_files = glob.glob(image_root+'*.fits')
                             for e in extra_files:
                                 if os.path.exists(e):
-                                    os.system('rm -rf {0} &'.format(e))
+                                    remove_files.append(e)
             except IOError:
                 pass
+        get_cleanup_service().remove(remove_files)
@@ -0,0 +1,273 @@
+"""
+Definition of the runtime history class
+"""
+import os
+import logging
+import socket
+import time
+import numpy as np
+
+
+log = logging.getLogger('factor:history')
+
+
+class RuntimeHistory(object):
+    """
+    Class that keeps a history of the run times of the operations
+
+    The history is kept per working directory, so that operations that are
+    rerun (e.g., after a reset) are planned from their measured costs
+
+    Parameters
+    ----------
+    working_dir : str
+        Factor working directory. The history is stored in the state
+        subdirectory
+
+    """
+    def __init__(self, working_dir):
+        self.save_file = os.path.join(working_dir, 'state', 'runtime_history.pkl')
+        self.records = []
+        self.load()
+
+
+    def load(self):
+        """
+        Loads the history from its file (if any)
+
+        """
+        import pickle
+
+        if not os.path.exists(self.save_file):
+            return
+        try:
+            with open(self.save_file, 'r') as f:
+                self.records = pickle.load(f)
+        except Exception:
+            log.warn('Could not read runtime history file {0}. Starting a new '
+                'history'.format(self.save_file))
+            self.records = []
+
+
+    def save(self):
+        """
+        Saves the history to its file
+
+        The file is first written under a temporary name and then renamed, so
+        that an interrupted write does not corrupt the history
+
+        """
+        import pickle
+
+        save_dir = os.path.dirname(self.save_file)
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        tmp_file = self.save_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(self.records, f)
+        os.rename(tmp_file, self.save_file)
+
+
+    def get_metadata(self, op):
+        """
+        Returns the direction and band metadata of an operation
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation for which to get the metadata
+
+        Returns
+        -------
+        metadata : dict
+            Dict with the operation and direction names, the facet image size,
+            and the number of bands and time chunks
+
+        """
+        if op.direction.facet_imsize is not None:
+            imsize = op.direction.facet_imsize
+        else:
+            imsize = op.direction.cal_imsize
+
+        return {'operation': op.name, 'direction': op.direction.name,
+            'imsize': imsize, 'nbands': len(op.bands),
+            'nchunks': len(op.bands[0].files)}
+
+
+    def add(self, op, stats, cost):
+        """
+        Adds the measured run time of a successful operation to the history
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation that was run
+        stats : dict
+            Measurements returned by call_generic_pipeline() (wall time in s,
+            CPU time in s and peak memory in MB)
+        cost : float
+            Estimated cost of the operation (see Scheduler.estimate_cost()),
+            used to calibrate the estimates of operations without a history
+
+        """
+        record = self.get_metadata(op)
+        record['time'] = stats['wall_time']
+        record['cpu_time'] = stats['cpu_time']
+        record['peak_memory_mb'] = stats['peak_memory_mb']
+        record['ncpu'] = op.direction.max_proc_per_node * len(op.direction.hosts)
+        record['max_proc_per_node'] = op.direction.max_proc_per_node
+        record['hosts'] = op.direction.hosts[:]
+        record['cost'] = cost
+        record['date'] = time.time()
+        self.records.append(record)
+        self.save()
+
+
+    def predict(self, op, cost):
+        """
+        Predicts the amount of work (in CPU-seconds) of an operation
+
+        If the same operation was run before on the same data, the work of its
+        most recent run is used. Otherwise, the estimated cost is converted to
+        CPU-seconds with the median ratio of measured work to estimated cost of
+        the earlier runs of the same type of operation (or of all operations,
+        if there are none). Runs with no estimated cost are not used. See
+        get_work() for how the work of a run is measured
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation for which to predict the work
+        cost : float
+            Estimated cost of the operation
+
+        Returns
+        -------
+        work : float or None
+            Predicted work in CPU-seconds, or None if there is no usable
+            history
+
+        """
+        if len(self.records) == 0:
+            return None
+
+        last_run = self.get_last_run(op)
+        if last_run is not None:
+            return get_work(last_run)
+
+        ratios = [get_work(r) / r['cost'] for r in self.records if
+            r['operation'] == op.name and r['cost'] > 0.0]
+        if len(ratios) == 0:
+            ratios = [get_work(r) / r['cost'] for r in self.records if
+                r['cost'] > 0.0]
+        if len(ratios) == 0:
+            return None
+
+        return np.median(ratios) * cost
+
+
+    def predict_peak_memory(self, op):
+        """
+        Returns the peak memory measured for the last run of an operation
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation for which to get the peak memory
+
+        Returns
+        -------
+        peak_memory_mb : float or None
+            Peak memory in MB, or None if the operation was not run before on
+            the same data
+
+        """
+        last_run = self.get_last_run(op)
+        if last_run is None:
+            return None
+
+        return last_run['peak_memory_mb']
+
+
+    def predict_memory_per_process(self, op):
+        """
+        Returns the peak memory per process measured for the last run of an
+        operation
+
+        The peak memory of the run is divided by the number of processes it
+        could run at once on a node. As the memory is measured on the node on
+        which the pipeline is run, the result is only meaningful for
+        operations run on that node
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation for which to get the memory
+
+        Returns
+        -------
+        memory_mb : float or None
+            Peak memory per process in MB, or None if the operation was not
+            run before on the same data
+
+        """
+        last_run = self.get_last_run(op)
+        if last_run is None or last_run['peak_memory_mb'] is None:
+            return None
+        nproc = last_run.get('max_proc_per_node', max(1, last_run['ncpu'] /
+            max(1, len(last_run['hosts']))))
+
+        return last_run['peak_memory_mb'] / float(max(1, nproc))
+
+
+    def get_last_run(self, op):
+        """
+        Returns the record of the last run of an operation on the same data
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation for which to get the record
+
+        Returns
+        -------
+        record : dict or None
+            Record of the last run, or None if the operation was not run before
+            on the same data
+
+        """
+        metadata = self.get_metadata(op)
+        matches = [r for r in self.records if all([r[k] == metadata[k] for k
+            in metadata])]
+        if len(matches) == 0:
+            return None
+
+        return matches[-1]
+
+
+def get_work(record):
+    """
+    Returns the work (in CPU-seconds) of a recorded run
+
+    The measured CPU time is used if all of the run's nodes are the node on
+    which the pipeline was run (as the CPU time does not include jobs run on
+    other nodes). Otherwise, the work is the wall time times the number of
+    CPUs given to the run
+
+    Parameters
+    ----------
+    record : dict
+        Record of the run (see RuntimeHistory.add())
+
+    Returns
+    -------
+    work : float
+        Work in CPU-seconds
+
+    """
+    local_names = ['localhost', socket.gethostname()]
+    if (record.get('cpu_time') is not None and record['cpu_time'] > 0.0 and
+        all([h in local_names for h in record['hosts']])):
+        return record['cpu_time']
+
+    return record['time'] * record['ncpu']
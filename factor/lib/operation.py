@@ -6,11 +6,13 @@ Contains the master class for all operations
 import os
 import logging
 import socket
-import subprocess
 import numpy as np
 import sys
 import uuid
+import re
+import hashlib
 from factor import _logging
+from factor.lib.cleanup import get_cleanup_service
 from jinja2 import Environment, FileSystemLoader
 from lofarpipe.support.utilities import create_directory
 
@@ -19,6 +21,18 @@ env_parset = Environment(loader=FileSystemLoader(os.path.join(DIR, '..', 'pipeli
     'parsets')))
 env_config = Environment(loader=FileSystemLoader(os.path.join(DIR, '..', 'pipeline')))
 
+# Direction attributes that set the resources of an operation. They are ignored
+# when checking whether the parameters of the pipeline steps have changed, as an
+# operation may be given different resources when it is restarted
+RESOURCE_PARAMETERS = ['hosts', 'max_proc_per_node', 'max_io_proc_per_node',
+    'max_cpus_per_proc_single', 'max_cpus_per_proc_ntimes',
+    'max_cpus_per_io_proc_ntimes', 'max_cpus_per_proc_nfiles',
+    'max_cpus_per_io_proc_nfiles', 'max_cpus_per_proc_nbands',
+    'max_percent_memory_per_proc_single',
+    'max_percent_memory_per_proc_ntimes', 'max_percent_memory_per_io_proc_ntimes',
+    'max_percent_memory_per_proc_nfiles', 'max_percent_memory_per_io_proc_nfiles',
+    'max_percent_memory_per_proc_nbands', 'local_dir', 'selfcal_local_dir']
+
 
 class Operation(object):
     """
@@ -128,6 +142,13 @@ class Operation(object):
         self.pipeline_config_file = os.path.join(self.pipeline_parset_dir,
             'pipeline.cfg')
 
+        # Pipeline statefile (written by the pipeline) and file with the
+        # fingerprints of its steps (written by Factor)
+        self.pipeline_state_file = os.path.join(self.pipeline_parset_dir,
+            'statefile')
+        self.step_state_file = os.path.join(self.pipeline_parset_dir,
+            'step_fingerprints.pkl')
+
         # Define parameters needed for the pipeline config.
         self.cfg_dict = {'lofarroot': parset['cluster_specific']['lofarroot'],
                          'pythonpath': parset['cluster_specific']['lofarpythonpath'],
@@ -206,6 +227,359 @@ class Operation(object):
         with open(self.pipeline_config_file, 'w') as f:
             f.write(tmp)
 
+        # Check which steps of a previous run (if any) can be reused
+        self.check_step_state()
+
+
+    def get_step_fingerprints(self):
+        """
+        Returns the fingerprints of the parameters and inputs of the pipeline
+        steps
+
+        The parameters are taken from the pipeline parset, rendered with the
+        resource parameters (see RESOURCE_PARAMETERS) set to fixed values. The
+        inputs are the existing files and directories given in the parameters
+        (e.g., input mapfiles and the files they list), except those in the
+        directories that the pipeline writes to itself (its parset and log
+        directories and the scratch directories)
+
+        Returns
+        -------
+        fingerprints : dict
+            Dict with the fingerprints of each step (keyed by step name) as
+            dicts with 'params' (hash of the parameters) and 'inputs' (dict of
+            input path fingerprints) items
+        step_order : list of str
+            Names of the steps in the order in which they are run (the steps of
+            a loop follow the loop step)
+
+        """
+        parms_dict = self.parms_dict.copy()
+        for key in RESOURCE_PARAMETERS:
+            if key in parms_dict and parms_dict[key] is not None:
+                parms_dict[key] = 'resource'
+        step_parameters, step_order = self.get_pipeline_steps(parms_dict)
+        step_lines = {}
+        for step, parameters in step_parameters.iteritems():
+            step_lines[step] = ['{0}={1}'.format(key, value) for key, value in
+                parameters]
+
+        # Paths in these directories are made or modified by the pipeline
+        # itself when it runs, so they are not treated as inputs
+        own_dirs = [d for d in [self.pipeline_parset_dir, self.log_dir,
+            self.local_dir_parent, self.local_scratch_dir,
+            self.parset['cluster_specific']['dir_local_selfcal'],
+            self.local_selfcal_scratch_dir] if d is not None]
+
+        fingerprints = {}
+        for step, lines in step_lines.iteritems():
+            inputs = {}
+            for line in lines:
+                for path in re.split('[\s,\[\]=\'"]+', line.split('=', 1)[1]):
+                    if (path.startswith('/') and os.path.exists(path) and not
+                        is_in_directories(path, own_dirs)):
+                        inputs[path] = get_path_fingerprint(path, follow_mapfile=True)
+            fingerprints[step] = {'params': hashlib.md5('\n'.join(
+                sorted(lines))).hexdigest(), 'inputs': inputs}
+
+        return fingerprints, step_order
+
+
+    def get_pipeline_steps(self, parms_dict=None):
+        """
+        Returns the steps of the pipeline and their parameters
+
+        Parameters
+        ----------
+        parms_dict : dict, optional
+            Dict used to render the pipeline parset template. If None,
+            self.parms_dict is used
+
+        Returns
+        -------
+        step_parameters : dict
+            Dict with the list of (key, value) parameter tuples of each step
+            (keyed by step name)
+        step_order : list of str
+            Names of the steps in the order in which they are run (the steps of
+            a loop follow the loop step)
+
+        """
+        if parms_dict is None:
+            parms_dict = self.parms_dict
+        template = self.pipeline_parset_template
+        if not hasattr(template, 'render'):
+            template = env_parset.get_template(template)
+        parset_lines = template.render(parms_dict).split('\n')
+
+        step_parameters = {}
+        step_order = []
+        loop_steps = {}
+        for line in parset_lines:
+            line = line.split('#')[0].strip()
+            if '=' not in line:
+                continue
+            key, value = [p.strip() for p in line.split('=', 1)]
+            step = key.split('.')[0]
+            if key == 'pipeline.steps':
+                step_order = [v.strip() for v in value.strip('[]').split(',')
+                    if v.strip() != '']
+            if key.endswith('.control.loopsteps'):
+                loop_steps[step] = [v.strip() for v in value.strip('[]').split(',')
+                    if v.strip() != '']
+            if step == 'pipeline':
+                continue
+            if step not in step_parameters:
+                step_parameters[step] = []
+            step_parameters[step].append((key, value))
+        for step, steps in loop_steps.iteritems():
+            if step in step_order:
+                indx = step_order.index(step) + 1
+                step_order = step_order[:indx] + steps + step_order[indx:]
+
+        return step_parameters, step_order
+
+
+    def get_output_fingerprints(self, completed_steps):
+        """
+        Returns the fingerprints of the outputs of completed pipeline steps
+
+        Parameters
+        ----------
+        completed_steps : list
+            List of (step type, outputs) tuples of the completed steps, as
+            stored in the pipeline statefile
+
+        Returns
+        -------
+        fingerprints : list
+            List of (step name, dict) tuples, one per completed step. Each dict
+            holds the hash of the contents of each of the step's output mapfiles
+            and the paths listed in them that exist
+
+        """
+        from lofarpipe.support.data_map import DataMap
+
+        fingerprints = []
+        for step_type, outputs in completed_steps:
+            mapfiles = {}
+            for key, value in outputs.iteritems():
+                if (not isinstance(value, basestring) or not
+                    value.endswith('.mapfile') or not os.path.exists(value)):
+                    continue
+                paths = []
+                try:
+                    for item in DataMap.load(value):
+                        # Handle case in which item.file is a Python list
+                        if item.file[0] == '[' and item.file[-1] == ']':
+                            files = item.file.strip('[]').split(',')
+                        else:
+                            files = [item.file]
+                        paths += [f.strip() for f in files if os.path.exists(f.strip())]
+                except Exception:
+                    pass
+                mapfiles[value] = {'hash': get_path_fingerprint(value),
+                    'paths': paths}
+            fingerprints.append((get_step_name(outputs), mapfiles))
+
+        return fingerprints
+
+
+    def check_step_state(self):
+        """
+        Checks the steps completed by a previous run of the pipeline
+
+        The completed steps stored in the pipeline statefile are checked in
+        order against the fingerprints saved when the previous run was set up.
+        A step is valid if neither its parameters and inputs nor those of any
+        step before it have changed and if its outputs still exist. The
+        statefile is truncated at the first invalid step, so that the pipeline
+        resumes there. New fingerprints are then saved for the current run
+
+        """
+        import pickle
+
+        fingerprints, step_order = self.get_step_fingerprints()
+        completed_steps = []
+        if os.path.exists(self.pipeline_state_file):
+            try:
+                with open(self.pipeline_state_file, 'r') as f:
+                    state = pickle.load(f)
+                completed_steps = state[1]
+            except Exception:
+                self.log.warn('Could not read pipeline statefile {0}. Starting '
+                    'the pipeline from the beginning'.format(self.pipeline_state_file))
+                os.remove(self.pipeline_state_file)
+
+        if len(completed_steps) > 0:
+            try:
+                with open(self.step_state_file, 'r') as f:
+                    saved = pickle.load(f)
+            except (IOError, EOFError, pickle.UnpicklingError):
+                # No fingerprints were saved, so the steps cannot be checked.
+                # Leave the statefile as it is
+                saved = None
+
+            if saved is not None:
+                # Find the first step that has changed. Steps that are not
+                # stored in the statefile (such as plugin steps) are rerun
+                # anyway, but their changes affect the stored steps after them
+                first_changed = len(step_order)
+                for i, step in enumerate(step_order):
+                    if not self.check_step_fingerprint(step, saved['steps'],
+                        fingerprints):
+                        first_changed = i
+                        break
+
+                nvalid = 0
+                for i, (step_type, outputs) in enumerate(completed_steps):
+                    step = get_step_name(outputs)
+                    if step not in step_order or step_order.index(step) >= first_changed:
+                        break
+                    if i < len(saved['outputs']):
+                        saved_outputs = saved['outputs'][i]
+                    else:
+                        saved_outputs = None
+                    if not self.check_step_outputs(step, outputs, saved_outputs):
+                        break
+                    nvalid += 1
+
+                if nvalid < len(completed_steps):
+                    self.log.info('{0} of {1} completed pipeline steps are '
+                        'still valid. Resuming operation {2} (direction: {3}) '
+                        'from there'.format(nvalid, len(completed_steps),
+                        self.name, self.direction.name))
+                    completed_steps = completed_steps[:nvalid]
+                    if nvalid == 0:
+                        os.remove(self.pipeline_state_file)
+                    else:
+                        state[1] = completed_steps
+                        with open(self.pipeline_state_file+'.tmp', 'w') as f:
+                            pickle.dump(state, f)
+                        os.rename(self.pipeline_state_file+'.tmp',
+                            self.pipeline_state_file)
+
+        self.step_fingerprints = fingerprints
+        self.save_step_state(completed_steps)
+
+
+    def check_step_fingerprint(self, step, saved_fingerprints, fingerprints):
+        """
+        Checks whether the parameters and inputs of a pipeline step are
+        unchanged
+
+        Parameters
+        ----------
+        step : str
+            Name of step
+        saved_fingerprints : dict
+            Fingerprints of the steps saved when the previous run was set up
+        fingerprints : dict
+            Current fingerprints of the steps
+
+        Returns
+        -------
+        unchanged : bool
+            True if the step is unchanged
+
+        """
+        if step not in fingerprints or step not in saved_fingerprints:
+            self.log.debug('Step {0} was not run before'.format(step))
+            return False
+
+        # Check parameters
+        if saved_fingerprints[step]['params'] != fingerprints[step]['params']:
+            self.log.debug('Parameters of step {0} have changed'.format(step))
+            return False
+
+        # Check inputs. Inputs that did not exist when the previous run was set
+        # up were made by the pipeline itself and are checked as outputs
+        for path, fingerprint in saved_fingerprints[step]['inputs'].iteritems():
+            if fingerprint != fingerprints[step]['inputs'].get(path):
+                self.log.debug('Input {0} of step {1} has changed'.format(path, step))
+                return False
+
+        return True
+
+
+    def check_step_outputs(self, step, outputs, saved_outputs):
+        """
+        Checks whether the outputs of a completed pipeline step are still valid
+
+        Parameters
+        ----------
+        step : str
+            Name of step
+        outputs : dict
+            Outputs of the step, as stored in the pipeline statefile
+        saved_outputs : tuple
+            Saved (step name, output fingerprints) tuple for this step, or None
+            if not available
+
+        Returns
+        -------
+        valid : bool
+            True if the outputs are valid
+
+        """
+        if saved_outputs is not None and saved_outputs[0] == step:
+            for mapfile, output in saved_outputs[1].iteritems():
+                if get_path_fingerprint(mapfile) != output['hash']:
+                    self.log.debug('Output mapfile {0} of step {1} has '
+                        'changed'.format(mapfile, step))
+                    return False
+                for path in output['paths']:
+                    if not os.path.exists(path):
+                        self.log.debug('Output {0} of step {1} is '
+                            'missing'.format(path, step))
+                        return False
+        elif 'mapfile' in outputs and not os.path.exists(outputs['mapfile']):
+            self.log.debug('Output mapfile of step {0} is missing'.format(step))
+            return False
+
+        return True
+
+
+    def save_step_state(self, completed_steps=None):
+        """
+        Saves the fingerprints of the pipeline steps
+
+        This method should be called when the operation is set up (by
+        check_step_state()) and after the pipeline has run, so that the
+        outputs of the completed steps are recorded. After the run, the input
+        fingerprints are also updated, as some steps write into their inputs
+        (e.g., the subtraction of facetsub writes into the chunks)
+
+        Parameters
+        ----------
+        completed_steps : list, optional
+            List of (step type, outputs) tuples of the completed steps. If None
+            (after the pipeline has run), they are read from the pipeline
+            statefile
+
+        """
+        import pickle
+
+        if not hasattr(self, 'step_fingerprints'):
+            return
+        if completed_steps is None:
+            try:
+                with open(self.pipeline_state_file, 'r') as f:
+                    completed_steps = pickle.load(f)[1]
+            except Exception:
+                completed_steps = []
+
+            for step in self.step_fingerprints.itervalues():
+                for path in step['inputs']:
+                    step['inputs'][path] = get_path_fingerprint(path,
+                        follow_mapfile=True)
+
+        saved = {'steps': self.step_fingerprints,
+            'outputs': self.get_output_fingerprints(completed_steps)}
+        with open(self.step_state_file+'.tmp', 'wb') as f:
+            pickle.dump(saved, f)
+        os.rename(self.step_state_file+'.tmp', self.step_state_file)
+
 
     def finalize(self):
         """
@@ -227,7 +601,7 @@ class Operation(object):
             True if operation was started on this direction
 
         """
-        has_state = self.direction.load_state()
+        has_state = self.direction.load_operations()
         if has_state:
             if self.name in self.direction.started_operations:
                 return True
@@ -248,7 +622,7 @@ class Operation(object):
             True if operation was successfully run on this direction
 
         """
-        has_state = self.direction.load_state()
+        has_state = self.direction.load_operations()
         if has_state:
             if self.name in self.direction.completed_operations:
                 return True
@@ -319,18 +693,127 @@ class Operation(object):
     def cleanup(self):
         """
         Cleans up temp files in the scratch directories of each node
+
+        The removal is done in the background by the cleanup service, in
+        parallel over the nodes
         """
-        if self.local_scratch_dir is not None:
-            for node in self.node_list:
-                if node == 'localhost':
-                    cmd = ['rm', '-rf', self.local_scratch_dir]
-                else:
-                    cmd = ['ssh', node, 'rm', '-rf', self.local_scratch_dir]
-                tmp = subprocess.call(cmd)
-        if self.local_selfcal_scratch_dir is not None:
+        scratch_dirs = [d for d in [self.local_scratch_dir,
+            self.local_selfcal_scratch_dir] if d is not None]
+        if len(scratch_dirs) > 0:
+            cleanup_service = get_cleanup_service()
             for node in self.node_list:
-                if node == 'localhost':
-                    cmd = ['rm', '-rf', self.local_selfcal_scratch_dir]
+                cleanup_service.remove(scratch_dirs, host=node)
+
+
+def get_step_name(outputs):
+    """
+    Returns the name of a pipeline step from its outputs
+
+    Parameters
+    ----------
+    outputs : dict
+        Outputs of the step, as stored in the pipeline statefile
+
+    Returns
+    -------
+    step : str
+        Name of the step, or None if it could not be determined
+
+    """
+    for key, suffix in [('mapfile', '.mapfile'), ('ok.mapfile', '.ok.mapfile')]:
+        if key in outputs and isinstance(outputs[key], basestring):
+            name = os.path.basename(outputs[key])
+            if name.endswith(suffix):
+                return name[:-len(suffix)]
+
+    return None
+
+
+def is_in_directories(path, directories):
+    """
+    Checks whether a path is one of the given directories or lies inside one
+
+    Parameters
+    ----------
+    path : str
+        Path to check
+    directories : list of str
+        Directories
+
+    Returns
+    -------
+    inside : bool
+        True if path is inside one of the directories
+
+    """
+    path = os.path.realpath(path)
+    for directory in directories:
+        directory = os.path.realpath(directory)
+        if path == directory or path.startswith(directory + os.sep):
+            return True
+
+    return False
+
+
+def get_path_fingerprint(path, follow_mapfile=False):
+    """
+    Returns a fingerprint of a file or directory
+
+    Parameters
+    ----------
+    path : str
+        Path of file or directory
+    follow_mapfile : bool, optional
+        If True and path is a mapfile, the fingerprints of the paths it lists
+        are included
+
+    Returns
+    -------
+    fingerprint : str or None
+        Fingerprint of the path, or None if it does not exist. For a mapfile, it
+        is the hash of its contents; for other files, their size and modification
+        time; for casacore tables (e.g., measurement sets), the sizes and
+        modification times of their main table files (table.dat and table.f0);
+        and for other directories the number of entries and their latest
+        modification time
+
+    """
+    if not os.path.exists(path):
+        return None
+
+    if os.path.exists(os.path.join(path, 'table.dat')):
+        # The table directory itself is not used, as its lock file changes
+        # whenever the table is opened
+        table_files = [os.path.join(path, f) for f in ['table.dat', 'table.f0']]
+        return ';'.join(['{0}:{1}'.format(os.path.getsize(f), os.path.getmtime(f))
+            for f in table_files if os.path.exists(f)])
+
+    if os.path.isdir(path):
+        entries = [os.path.join(path, e) for e in os.listdir(path)]
+        mtimes = [os.path.getmtime(e) for e in entries if os.path.exists(e)]
+        mtimes.append(os.path.getmtime(path))
+        return '{0}:{1}'.format(len(entries), max(mtimes))
+
+    if not path.endswith('.mapfile'):
+        return '{0}:{1}'.format(os.path.getsize(path), os.path.getmtime(path))
+
+    with open(path, 'r') as f:
+        contents = f.read()
+    fingerprint = hashlib.md5(contents).hexdigest()
+    if follow_mapfile:
+        from lofarpipe.support.data_map import DataMap
+
+        try:
+            listed = []
+            for item in DataMap.load(path):
+                # Handle case in which item.file is a Python list
+                if item.file[0] == '[' and item.file[-1] == ']':
+                    listed += item.file.strip('[]').split(',')
                 else:
-                    cmd = ['ssh', node, 'rm', '-rf', self.local_selfcal_scratch_dir]
-                tmp = subprocess.call(cmd)
+                    listed.append(item.file)
+            fingerprint = hashlib.md5(fingerprint + ''.join(
+                [str(get_path_fingerprint(f.strip())) for f in listed])).hexdigest()
+        except Exception:
+            pass
+
+    return fingerprint
@@ -0,0 +1,400 @@
+"""
+Definition of the pipeline step profiler and the profile report
+"""
+import os
+import sys
+import glob
+import json
+import logging
+import resource
+import socket
+import threading
+import time
+
+
+log = logging.getLogger('factor:profiler')
+
+
+class StepProfiler(object):
+    """
+    Class that profiles the steps of a pipeline run
+
+    For each step, the wall time, CPU time, peak resident memory, bytes read
+    and written, and hosts are recorded. The CPU time, memory, and I/O are
+    those of the pipeline process and the processes it starts on the local
+    node (jobs run on other nodes are not included)
+
+    Parameters
+    ----------
+    op_name : str
+        Name of operation
+    direction_name : str
+        Name of direction
+    profile_file : str
+        Name of JSON file to which the profile is written. If the file exists,
+        the new records are added to it
+    sample_interval : float, optional
+        Interval in seconds at which the memory use is sampled
+
+    """
+    def __init__(self, op_name, direction_name, profile_file, sample_interval=1.0):
+        self.op_name = op_name
+        self.direction_name = direction_name
+        self.profile_file = profile_file
+        self.sample_interval = sample_interval
+        self.hostname = socket.gethostname()
+        self.records = []
+
+
+    def attach(self, pipeline):
+        """
+        Wraps the run_task() method of a pipeline so that each step is profiled
+
+        Parameters
+        ----------
+        pipeline : GenericPipeline instance
+            Pipeline to profile
+
+        """
+        run_task = pipeline.run_task
+
+        def profiled_run_task(configblock, datafiles=[], **kwargs):
+            usage_start = get_usage()
+            start = time.time()
+            sampler = MemorySampler(self.sample_interval)
+            sampler.start()
+            outputs = None
+            try:
+                outputs = run_task(configblock, datafiles, **kwargs)
+            finally:
+                sampler.stop()
+                self.add_record(configblock, outputs, start, usage_start,
+                    get_usage(), sampler.peak_rss_mb)
+            return outputs
+
+        pipeline.run_task = profiled_run_task
+
+
+    def add_record(self, step_type, outputs, start, usage_start, usage_end,
+        peak_rss_mb):
+        """
+        Adds the profile of a step
+
+        Parameters
+        ----------
+        step_type : str
+            Type of step (e.g., 'executable_args')
+        outputs : dict
+            Outputs of the step (None if the step failed)
+        start : float
+            Start time of the step
+        usage_start : dict
+            Resource usage at the start of the step (see get_usage())
+        usage_end : dict
+            Resource usage at the end of the step
+        peak_rss_mb : float
+            Peak resident memory in MB during the step
+
+        """
+        from factor.lib.operation import get_step_name
+
+        step = None
+        nodes = []
+        if outputs is not None:
+            step = get_step_name(outputs)
+            nodes = get_mapfile_hosts(outputs.get('mapfile'))
+        if step is None:
+            step = step_type
+
+        record = {'operation': self.op_name, 'direction': self.direction_name,
+            'step': step, 'type': step_type, 'start': start,
+            'wall_time': time.time() - start,
+            'cpu_time': usage_end['cpu_time'] - usage_start['cpu_time'],
+            'peak_rss_mb': peak_rss_mb, 'host': self.hostname, 'nodes': nodes,
+            'status': 'ok' if outputs is not None else 'failed'}
+        for key in ['read_bytes', 'write_bytes']:
+            if usage_start[key] is not None and usage_end[key] is not None:
+                record[key] = usage_end[key] - usage_start[key]
+            else:
+                record[key] = None
+        self.records.append(record)
+
+
+    def save(self):
+        """
+        Writes the profile to the profile file
+
+        """
+        records = []
+        if os.path.exists(self.profile_file):
+            try:
+                with open(self.profile_file, 'r') as f:
+                    records = json.load(f)
+            except ValueError:
+                log.warn('Could not read profile file {0}. Overwriting '
+                    'it'.format(self.profile_file))
+        records += self.records
+        with open(self.profile_file+'.tmp', 'w') as f:
+            json.dump(records, f, indent=1)
+        os.rename(self.profile_file+'.tmp', self.profile_file)
+
+
+class MemorySampler(threading.Thread):
+    """
+    Thread that samples the resident memory of this process and its children
+
+    Parameters
+    ----------
+    interval : float
+        Sampling interval in seconds
+
+    """
+    def __init__(self, interval):
+        super(MemorySampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.peak_rss_mb = get_tree_rss_mb(os.getpid())
+        self._stop_event = threading.Event()
+
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak_rss_mb = max(self.peak_rss_mb, get_tree_rss_mb(os.getpid()))
+            self._stop_event.wait(self.interval)
+
+
+    def stop(self):
+        """
+        Stops the sampling
+        """
+        self._stop_event.set()
+        self.join()
+
+
+def get_usage():
+    """
+    Returns the CPU time and I/O of this process and its finished children
+
+    Returns
+    -------
+    usage : dict
+        Dict with the CPU time in s ('cpu_time') and the number of bytes read
+        from and written to storage ('read_bytes' and 'write_bytes', None if
+        not available)
+
+    """
+    usage = {'cpu_time': 0.0, 'read_bytes': None, 'write_bytes': None}
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        ru = resource.getrusage(who)
+        usage['cpu_time'] += ru.ru_utime + ru.ru_stime
+
+    # Note: on Linux, the I/O counters of a process include those of its
+    # finished children
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in usage:
+                    usage[key] = int(value)
+    except (IOError, ValueError):
+        pass
+
+    return usage
+
+
+def get_tree_rss_mb(pid):
+    """
+    Returns the total resident memory of a process and its descendants
+
+    Parameters
+    ----------
+    pid : int
+        Process ID
+
+    Returns
+    -------
+    rss_mb : float
+        Resident memory in MB. If /proc is not available, the peak resident
+        memory of the process is returned instead
+
+    """
+    if not os.path.exists('/proc/{0}/statm'.format(pid)):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    # Find the parent of each process
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/stat'.format(entry), 'r') as f:
+                # The command name (2nd field) is in parentheses and may
+                # contain spaces, so split after it
+                fields = f.read().rsplit(')', 1)[1].split()
+            parents[int(entry)] = int(fields[1])
+        except (IOError, IndexError, ValueError):
+            continue
+
+    tree = set([pid])
+    added = True
+    while added:
+        added = False
+        for child, parent in parents.iteritems():
+            if parent in tree and child not in tree:
+                tree.add(child)
+                added = True
+
+    pagesize = resource.getpagesize()
+    rss = 0
+    for p in tree:
+        try:
+            with open('/proc/{0}/statm'.format(p), 'r') as f:
+                rss += int(f.read().split()[1]) * pagesize
+        except (IOError, IndexError, ValueError):
+            continue
+
+    return rss / 1024.0**2
+
+
+def get_mapfile_hosts(mapfile):
+    """
+    Returns the hosts listed in a mapfile
+
+    Parameters
+    ----------
+    mapfile : str
+        Filename of mapfile
+
+    Returns
+    -------
+    hosts : list of str
+        Sorted list of the unique hosts (empty if the mapfile cannot be read)
+
+    """
+    from lofarpipe.support.data_map import DataMap
+
+    if mapfile is None or not os.path.exists(mapfile):
+        return []
+    try:
+        return sorted(set([item.host for item in DataMap.load(mapfile)]))
+    except Exception:
+        return []
+
+
+def read_profiles(dir_working):
+    """
+    Reads the profiles of all pipeline runs
+
+    Parameters
+    ----------
+    dir_working : str
+        Factor working directory
+
+    Returns
+    -------
+    records : list of dict
+        Step profiles
+
+    """
+    records = []
+    for profile_file in sorted(glob.glob(os.path.join(dir_working, 'logs', '*',
+        '*.profile.json'))):
+        try:
+            with open(profile_file, 'r') as f:
+                records += json.load(f)
+        except (IOError, ValueError):
+            log.warn('Could not read profile file {0}. Skipping it'.format(profile_file))
+
+    return records
+
+
+def write_csv(records, csv_file):
+    """
+    Writes step profiles to a CSV file
+
+    Parameters
+    ----------
+    records : list of dict
+        Step profiles
+    csv_file : str
+        Filename of output CSV file
+
+    """
+    import csv
+
+    columns = ['operation', 'direction', 'step', 'type', 'start', 'wall_time',
+        'cpu_time', 'peak_rss_mb', 'read_bytes', 'write_bytes', 'host',
+        'nodes', 'status']
+    with open(csv_file, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for record in records:
+            row = []
+            for column in columns:
+                value = record.get(column)
+                if column == 'nodes' and value is not None:
+                    value = ' '.join(value)
+                row.append(value)
+            writer.writerow(row)
+
+
+def report(parset_file, nsteps=20):
+    """
+    Prints a summary of the step profiles of a run
+
+    The steps are combined over all directions and sorted by their total wall
+    time. All step profiles are also written to logs/profile.csv in the
+    working directory
+
+    Parameters
+    ----------
+    parset_file : str
+        Filename of Factor parset
+    nsteps : int, optional
+        Number of steps to list
+
+    """
+    import factor.parset
+
+    parset = factor.parset.parset_read(parset_file, use_log_file=False)
+    records = read_profiles(parset['dir_working'])
+    if len(records) == 0:
+        log.error('No step profiles found in {0}. Please run Factor '
+            'first'.format(os.path.join(parset['dir_working'], 'logs')))
+        sys.exit(1)
+    csv_file = os.path.join(parset['dir_working'], 'logs', 'profile.csv')
+    write_csv(records, csv_file)
+
+    # Combine the steps of all directions
+    steps = {}
+    for record in records:
+        key = (record['operation'], record['step'])
+        if key not in steps:
+            steps[key] = {'nruns': 0, 'directions': set(), 'wall_time': 0.0,
+                'cpu_time': 0.0, 'peak_rss_mb': 0.0, 'io_bytes': 0}
+        s = steps[key]
+        s['nruns'] += 1
+        s['directions'].add(record['direction'])
+        s['wall_time'] += record['wall_time']
+        s['cpu_time'] += record['cpu_time']
+        s['peak_rss_mb'] = max(s['peak_rss_mb'], record['peak_rss_mb'])
+        for io_key in ['read_bytes', 'write_bytes']:
+            if record.get(io_key) is not None:
+                s['io_bytes'] += record[io_key]
+    total_wall_time = max(1e-6, sum([s['wall_time'] for s in steps.itervalues()]))
+    top_steps = sorted(steps.iteritems(), key=lambda item: -item[1]['wall_time'])[:nsteps]
+
+    log.info('Profiled {0} step runs of {1} operation(s) (all profiles written '
+        'to {2})'.format(len(records), len(set([r['operation'] for r in
+        records])), csv_file))
+    log.info('Top {0} steps by total wall time (over all directions):'.format(
+        len(top_steps)))
+    log.info('{0:<16} {1:<36} {2:>5} {3:>10} {4:>6} {5:>10} {6:>10} {7:>10}'.format(
+        'Operation', 'Step', 'Runs', 'Wall (h)', '%', 'CPU (h)', 'Peak (GB)',
+        'I/O (GB)'))
+    for (op_name, step), s in top_steps:
+        log.info('{0:<16} {1:<36} {2:>5} {3:>10.2f} {4:>6.1f} {5:>10.2f} '
+            '{6:>10.2f} {7:>10.2f}'.format(op_name, step, s['nruns'],
+            s['wall_time'] / 3600.0, s['wall_time'] / total_wall_time * 100.0,
+            s['cpu_time'] / 3600.0, s['peak_rss_mb'] / 1024.0,
+            s['io_bytes'] / 1024.0**3))
@@ -6,14 +6,47 @@ import multiprocessing
 import os
 import sys
 import imp
+import time
+import resource
 import numpy as np
 import shutil
+import Queue
 from collections import Counter
 from factor.lib.context import Timer
+import factor.cluster
+from factor.lib.state import get_state_store
 
 log = logging.getLogger('factor:scheduler')
 
 
+# The genericpipeline module, loaded once per worker process by init_worker()
+_genericpipeline = None
+
+
+def init_worker(genericpipeline_executable):
+    """
+    Loads the LOFAR pipeline framework in a worker process
+
+    This function is called by call_generic_pipeline() for the first operation
+    run by a worker, so that the framework is loaded only once per worker
+    instead of once per operation. It is not used as the initializer of the
+    worker pool, as an error raised there would make the pool restart its
+    workers endlessly instead of reporting the error as a failed operation
+
+    Parameters
+    ----------
+    genericpipeline_executable : str
+        Path to genericpipeline.py executable
+
+    """
+    global _genericpipeline
+
+    genericpipeline_path = os.path.dirname(genericpipeline_executable)
+    loader = imp.load_source('loader', os.path.join(genericpipeline_path,
+        'loader.py'))
+    _genericpipeline = imp.load_source('gp', genericpipeline_executable)
+
+
 def call_generic_pipeline(op_name, direction_name, parset, config, logbasename,
     genericpipeline_executable):
     """
@@ -34,42 +67,139 @@ def call_generic_pipeline(op_name, direction_name, parset, config, logbasename,
     genericpipeline_executable : str
         Path to genericpipeline.py executable
 
+    Returns
+    -------
+    result : tuple
+        Tuple of (op_name, direction_name, status, stats), where stats is a dict
+        with the wall time (s), CPU time (s) and peak memory (MB) of the
+        pipeline and its local child processes (None if the pipeline could not
+        be run). The peak memory is the largest of the step peaks measured by
+        the step profiler
+
     """
-    from lofarpipe.support.pipelinelogging import getSearchingLogger
-    from factor.lib.context import RedirectStdStreams
-    import time
+    try:
+        from lofarpipe.support.pipelinelogging import getSearchingLogger
+        from factor.lib.context import RedirectStdStreams
+        from factor.lib.profiler import StepProfiler
 
-    genericpipeline_path = os.path.dirname(genericpipeline_executable)
-    loader = imp.load_source('loader', os.path.join(genericpipeline_path,
-        'loader.py'))
-    gp = imp.load_source('gp', genericpipeline_executable)
+        if _genericpipeline is None:
+            init_worker(genericpipeline_executable)
+
+        # Initalize pipeline object
+        pipeline = _genericpipeline.GenericPipeline()
 
-    # Initalize pipeline object
-    pipeline = gp.GenericPipeline()
+        # Add needed attr/methods
+        pipeline.name = '{0}_{1}'.format(op_name, direction_name)
+        pipeline.logger = getSearchingLogger(pipeline.name)
+        pipeline.inputs['args'] = [parset]
+        pipeline.inputs['config'] = config
+        pipeline.inputs['job_name'] = direction_name
 
-    # Add needed attr/methods
-    pipeline.name = '{0}_{1}'.format(op_name, direction_name)
-    pipeline.logger = getSearchingLogger(pipeline.name)
-    pipeline.inputs['args'] = [parset]
-    pipeline.inputs['config'] = config
-    pipeline.inputs['job_name'] = direction_name
+        # Set pipeline logging to DEBUG level
+        logging.root.setLevel(logging.DEBUG)
+        pipeline.logger.setLevel(logging.DEBUG)
+        for handler in pipeline.logger.handlers:
+            handler.setLevel(logging.DEBUG)
 
-    # Set pipeline logging to DEBUG level
-    logging.root.setLevel(logging.DEBUG)
-    pipeline.logger.setLevel(logging.DEBUG)
-    for handler in pipeline.logger.handlers:
-        handler.setLevel(logging.DEBUG)
+        # Profile each step of the pipeline
+        profiler = StepProfiler(op_name, direction_name,
+            '{0}.profile.json'.format(logbasename))
+        profiler.attach(pipeline)
 
-    # Run the pipeline, redirecting screen output to log files
-    time.sleep(2.0) # pause to allow result_callback() to transfer resources
-    log.info('<-- Operation {0} started (direction: {1})'.format(op_name,
-        direction_name))
-    with open("{0}.out.log".format(logbasename), "wb") as out, \
-        open("{0}.err.log".format(logbasename), "wb") as err:
-        with RedirectStdStreams(stdout=out, stderr=err):
-            status = pipeline.run(pipeline.name)
+        # Run the pipeline, redirecting screen output to log files
+        log.info('<-- Operation {0} started (direction: {1})'.format(op_name,
+            direction_name))
+        usage_start = [resource.getrusage(who) for who in (resource.RUSAGE_SELF,
+            resource.RUSAGE_CHILDREN)]
+        start = time.time()
+        with open("{0}.out.log".format(logbasename), "wb") as out, \
+            open("{0}.err.log".format(logbasename), "wb") as err:
+            with RedirectStdStreams(stdout=out, stderr=err):
+                try:
+                    status = pipeline.run(pipeline.name)
+                finally:
+                    profiler.save()
+        usage_end = [resource.getrusage(who) for who in (resource.RUSAGE_SELF,
+            resource.RUSAGE_CHILDREN)]
 
-    return (op_name, direction_name, status)
+        # Note: the peak memory is taken from the step profiles rather than from
+        # ru_maxrss, as the latter is the maximum over the lifetime of the worker
+        # process and so may include earlier operations run by the same worker
+        stats = {'wall_time': time.time() - start,
+            'cpu_time': sum([(u1.ru_utime + u1.ru_stime) - (u0.ru_utime + u0.ru_stime)
+                for u0, u1 in zip(usage_start, usage_end)]),
+            'peak_memory_mb': max([record['peak_rss_mb'] for record in
+                profiler.records] + [0.0])}
+    except BaseException as e:
+        # Report the error (including SystemExit, e.g., from a pipeline step)
+        # as a failed run, as the scheduler waits for a result from every
+        # operation it starts
+        log.error('Operation {0} raised an exception (direction: {1}): '
+            '{2}'.format(op_name, direction_name, e))
+        return (op_name, direction_name, 1, None)
+
+    return (op_name, direction_name, status, stats)
+
+
+def divide_nodes(costs, node_list):
+    """
+    Divides nodes among operations in proportion to their cost
+
+    Each operation gets at least one node. The remaining nodes are given one by
+    one to the operation with the highest cost per node, which minimizes the
+    largest cost per node (i.e., the estimated time until all operations are
+    done)
+
+    Parameters
+    ----------
+    costs : list of float
+        Costs of the operations. There must be no more operations than nodes
+    node_list : list of str
+        Nodes to divide
+
+    Returns
+    -------
+    hosts : list of lists of str
+        Nodes given to each operation
+
+    """
+    nnodes = [1] * len(costs)
+    for i in range(len(node_list) - len(costs)):
+        j = max(range(len(costs)), key=lambda k: costs[k] / float(nnodes[k]))
+        nnodes[j] += 1
+
+    hosts = []
+    start = 0
+    for n in nnodes:
+        hosts.append(node_list[start:start+n])
+        start += n
+
+    return hosts
+
+
+class OperationNode(object):
+    """
+    A node of the operation dependency graph run by Scheduler.run_graph()
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the node
+    make_operation : function
+        Function that takes no arguments and returns the Operation instance to
+        run for this node (or None if there is nothing to run). It is called
+        only once all the nodes this node depends on have finished, so that the
+        operation is set up with their results
+    depends_on : list of str, optional
+        Names of the nodes that must finish before this node is started
+
+    """
+    def __init__(self, name, make_operation, depends_on=None):
+        self.name = name
+        self.make_operation = make_operation
+        if depends_on is None:
+            depends_on = []
+        self.depends_on = depends_on
 
 
 class Scheduler(object):
@@ -87,15 +217,26 @@ class Scheduler(object):
     dry_run : bool, optional
         If True, the pipelines are not run but all parsets and config files
         are made as normal
+    history : RuntimeHistory instance, optional
+        History of the run times of earlier operations. If given, the run times
+        of new operations are recorded in it and it is used to predict the
+        costs of the operations
+    simulator : CostSimulator instance, optional
+        Simulator to which the operations that are not yet done are added in
+        dry-run mode
 
     """
     def __init__(self, genericpipeline_executable, max_procs=1, name='scheduler',
-        dry_run=False):
+        dry_run=False, history=None, simulator=None):
         self.genericpipeline_executable = genericpipeline_executable
         self.max_procs = max_procs
         self.name = name
         self.dry_run = dry_run
+        self.history = history
+        self.simulator = simulator
         self.success = True
+        self.pool = None
+        self.result_queue = Queue.Queue()
 
 
     def allocate_resources(self, operation_list=None):
@@ -112,14 +253,9 @@ class Scheduler(object):
         if operation_list is None:
             operation_list = self.operation_list
 
-        node_list = self.operation_list[0].node_list
-        ncpu_max = self.operation_list[0].parset['cluster_specific']['ncpu']
-        nthread_io = self.operation_list[0].parset['cluster_specific']['nthread_io']
-        fmem_max = self.operation_list[0].parset['cluster_specific']['wsclean_fmem']
-        ndir_per_node = self.operation_list[0].parset['cluster_specific']['ndir_per_node']
-        nbands = len(self.operation_list[0].bands)
-        ntimes = len(self.operation_list[0].bands[0].files)
-        nfiles = ntimes * nbands
+        node_list = self.operation_list[0].node_list[:]
+        parset = self.operation_list[0].parset
+        ndir_per_node = parset['cluster_specific']['ndir_per_node']
         nops_simul = self.max_procs
 
         for i in range(int(np.ceil(len(operation_list)/float(nops_simul)))):
@@ -130,9 +266,9 @@ class Scheduler(object):
                     node_list.append(node_list[i])
                 hosts = [[n] for n in node_list]
             else:
-                parts = len(op_group)
-                hosts = [node_list[i*len(node_list)//parts:
-                    (i+1)*len(node_list)//parts] for i in range(parts)]
+                # Give more nodes to the more expensive operations, so that
+                # they finish at about the same time
+                hosts = self.divide_nodes(op_group, node_list)
 
             # Find duplicates and divide up available nodes and cores
             h_flat = []
@@ -140,79 +276,403 @@ class Scheduler(object):
                 h_flat.extend(h)
             c = Counter(h_flat)
 
+            nops_per_node_list = []
             for op, h in zip(op_group, hosts):
                 if len(h) == 1:
                     nops_per_node = min(ndir_per_node, c[h[0]])
                 else:
                     nops_per_node = 1
+                nops_per_node_list.append(nops_per_node)
                 op.direction.hosts = h
 
                 # Maximum number of normal and IO-intensive processes that the
-                # pipeline should run at once
-                op.direction.max_proc_per_node =  max(1, int(np.ceil(ncpu_max /
+                # pipeline should run at once (limited by the smallest of the
+                # operation's nodes)
+                resources = factor.cluster.get_node_resources(parset, h)
+                op.direction.max_proc_per_node =  max(1, int(np.ceil(resources['ncpu'] /
                     float(nops_per_node))))
-                op.direction.max_io_proc_per_node = max(1, int(np.ceil(nthread_io /
+                op.direction.max_io_proc_per_node = max(1, int(np.ceil(resources['nthread_io'] /
                     float(nops_per_node))))
 
-            # Adjust resources to stay within limits for each node by adding or
-            # subtracting CPUs from the most appropriate operation(s). For now,
-            # we use the size of the facet image to determine the weights
-            resource_weights = [op.direction.facet_imsize if op.direction.facet_imsize is
-                not None else 0.0 for op in op_group]
-            j = 0
-            while sum([op.direction.max_proc_per_node for op in op_group]) > ncpu_max * len(hosts):
-                op_take = op_group[resource_weights.index(sorted(resource_weights)[j])]
-                op_take.direction.max_proc_per_node -= 1
-                op_take.direction.save_state()
-                if j < len(op_group)-1:
-                    j += 1
-                else:
-                    j = 0
+            # Adjust resources to stay within the CPU limit of each node by
+            # subtracting CPUs from the operation(s) on it. We use the
+            # estimated cost of each operation to determine the weights, so
+            # that CPUs are taken from the cheapest operations first
+            resource_weights = [self.estimate_cost(op) for op in op_group]
+            for node in set(h_flat):
+                ncpu_node = factor.cluster.get_node_resources(parset, [node])['ncpu']
+                node_ops = sorted([(w, i) for i, (w, op) in enumerate(zip(
+                    resource_weights, op_group)) if node in op.direction.hosts])
+                node_ops = [op_group[i] for w, i in node_ops]
+                j = 0
+                while (sum([op.direction.max_proc_per_node for op in node_ops]) > ncpu_node
+                    and any([op.direction.max_proc_per_node > 1 for op in node_ops])):
+                    op_take = node_ops[j]
+                    if op_take.direction.max_proc_per_node > 1:
+                        op_take.direction.max_proc_per_node -= 1
+                    if j < len(node_ops)-1:
+                        j += 1
+                    else:
+                        j = 0
 
-            for op in op_group:
-                # Set maximum number of threads for normal and IO-intensive
-                # multithreaded processes (e.g., DPPP jobs) when run once,
-                # nfiles, and ntimes times per step (the most common cases)
-                op.direction.max_cpus_per_proc_single = op.direction.max_proc_per_node
-                op.direction.max_cpus_per_proc_ntimes = int(np.ceil(
-                    op.direction.max_proc_per_node /
-                    float(min(ntimes, op.direction.max_proc_per_node))))
-                op.direction.max_cpus_per_io_proc_ntimes = int(np.ceil(
-                    op.direction.max_proc_per_node /
-                    float(min(ntimes, op.direction.max_io_proc_per_node))))
-                op.direction.max_cpus_per_proc_nfiles = int(np.ceil(
-                    op.direction.max_proc_per_node /
-                    float(min(nfiles, op.direction.max_proc_per_node))))
-                op.direction.max_cpus_per_io_proc_nfiles = int(np.ceil(
-                    op.direction.max_proc_per_node /
-                    float(min(nfiles, op.direction.max_io_proc_per_node))))
-
-                # Maximum percentage of memory to give to jobs that allow memory
-                # limits (e.g., WSClean jobs)
-                op.direction.max_percent_memory_per_proc_single = (fmem_max /
-                    float(nops_per_node) * 100.0)
-                op.direction.max_percent_memory_per_proc_ntimes = (fmem_max /
-                    float(nops_per_node) * 100.0 /
-                    float(min(ntimes, op.direction.max_proc_per_node)))
-                op.direction.max_percent_memory_per_io_proc_ntimes = (fmem_max /
-                    float(nops_per_node) * 100.0 /
-                    float(min(ntimes, op.direction.max_io_proc_per_node)))
-                op.direction.max_percent_memory_per_proc_nfiles = (fmem_max /
-                    float(nops_per_node) * 100.0 /
-                    float(min(nfiles, op.direction.max_proc_per_node)))
-                op.direction.max_percent_memory_per_io_proc_nfiles = (fmem_max /
-                    float(nops_per_node) * 100.0 /
-                    float(min(nfiles, op.direction.max_io_proc_per_node)))
-
-                # Save the state
-                op.direction.save_state()
+            # Reduce the number of processes of operations whose predicted
+            # memory use would exceed that of their nodes
+            self.limit_memory(op_group)
+
+            for op, nops_per_node in zip(op_group, nops_per_node_list):
+                self.set_process_limits(op, nops_per_node)
+
+
+    def limit_memory(self, op_group):
+        """
+        Reduces the number of processes of operations to fit their nodes' memory
+
+        The memory per process of each operation is predicted from its last
+        run (see RuntimeHistory.predict_memory_per_process()). If the predicted
+        memory of the operations on a node exceeds the node's memory, the
+        max_proc_per_node (and max_io_proc_per_node) of the operations with a
+        prediction are scaled down to fit. Operations without a history, and
+        nodes of unknown memory, are not changed
+
+        Parameters
+        ----------
+        op_group : list of Operation objects
+            Operations whose resources were set by allocate_resources() or
+            allocate_free_resources()
+
+        """
+        if self.history is None:
+            return
+        parset = op_group[0].parset
+        memory_per_proc = {}
+        for op in op_group:
+            memory_mb = self.history.predict_memory_per_process(op)
+            if memory_mb is not None and memory_mb > 0.0:
+                memory_per_proc[op.direction.name] = memory_mb
+
+        nodes = set()
+        for op in op_group:
+            nodes.update(op.direction.hosts)
+        for node in nodes:
+            node_memory_mb = factor.cluster.get_node_resources(parset,
+                [node])['memory_mb']
+            node_ops = [op for op in op_group if node in op.direction.hosts and
+                op.direction.name in memory_per_proc]
+            if node_memory_mb is None or len(node_ops) == 0:
+                continue
+            needed_mb = sum([memory_per_proc[op.direction.name] *
+                op.direction.max_proc_per_node for op in node_ops])
+            if needed_mb <= node_memory_mb:
+                continue
+            scale = node_memory_mb / needed_mb
+            for op in node_ops:
+                op.direction.max_proc_per_node = max(1, int(
+                    op.direction.max_proc_per_node * scale))
+                op.direction.max_io_proc_per_node = min(
+                    op.direction.max_io_proc_per_node,
+                    op.direction.max_proc_per_node)
+                log.debug('Limiting operation {0} (direction: {1}) to {2} '
+                    'process(es) per node to fit in the memory of node '
+                    '{3}'.format(op.name, op.direction.name,
+                    op.direction.max_proc_per_node, node))
+
+
+    def estimate_cost(self, op):
+        """
+        Estimates the relative processing cost of an operation
+
+        If there is a runtime history, the cost is the predicted work in
+        CPU-seconds (see RuntimeHistory.predict()). Otherwise, the cost from
+        estimate_data_cost() is used
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation for which to estimate the cost
+
+        Returns
+        -------
+        cost : float
+            Estimated cost
+
+        """
+        cost = self.estimate_data_cost(op)
+        if self.history is not None:
+            work = self.history.predict(op, cost)
+            if work is not None:
+                cost = work
+
+        return cost
+
+
+    def estimate_data_cost(self, op):
+        """
+        Estimates the relative processing cost of an operation from its data
+
+        The cost scales with the amount of data (the number of bands times the
+        number of time chunks), the number of pixels of the facet image, and,
+        for selfcal operations, the maximum number of selfcal loops
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation for which to estimate the cost
+
+        Returns
+        -------
+        cost : float
+            Estimated cost in arbitrary units
+
+        """
+        nbands = len(op.bands)
+        nchunks = len(op.bands[0].files)
+        if op.direction.facet_imsize is not None:
+            imsize = op.direction.facet_imsize
+        else:
+            imsize = op.direction.cal_imsize
+        if op.name == 'facetselfcal':
+            if op.direction.contains_target:
+                nloops = max(1, op.parset['calibration_specific']['target_max_selfcal_loops'])
+            else:
+                nloops = max(1, op.parset['calibration_specific']['max_selfcal_loops'])
+        else:
+            nloops = 1
+
+        return nbands * nchunks * (1.0 + (imsize / 512.0)**2) * nloops
+
+
+    def sort_operations(self, operation_list):
+        """
+        Sorts operations by decreasing estimated cost
+
+        Starting the longest operations first (the longest-processing-time-first
+        rule) keeps the total run time of a list of operations close to the
+        minimum when there are more operations than can be run at once
+
+        Parameters
+        ----------
+        operation_list : list of Operation objects
+            Operations to sort
+
+        Returns
+        -------
+        sorted_list : list of Operation objects
+            Sorted operations. Operations of equal cost keep their input order
+
+        """
+        costs = [self.estimate_cost(op) for op in operation_list]
+        for op, cost in zip(operation_list, costs):
+            log.debug('Estimated cost of operation {0} (direction: {1}): '
+                '{2:.1f}'.format(op.name, op.direction.name, cost))
+            if self.history is not None:
+                peak_memory_mb = self.history.predict_peak_memory(op)
+                if peak_memory_mb is not None:
+                    log.debug('Peak memory of last run of operation {0} '
+                        '(direction: {1}): {2:.0f} MB'.format(op.name,
+                        op.direction.name, peak_memory_mb))
+        indx = sorted(range(len(operation_list)), key=lambda i: -costs[i])
+
+        return [operation_list[i] for i in indx]
+
+
+    def divide_nodes(self, op_group, node_list):
+        """
+        Divides nodes among operations in proportion to their estimated cost
+
+        See divide_nodes() for details
+
+        Parameters
+        ----------
+        op_group : list of Operation objects
+            Operations over which to divide the nodes. There must be no more
+            operations than nodes
+        node_list : list of str
+            Nodes to divide
+
+        Returns
+        -------
+        hosts : list of lists of str
+            Nodes given to each operation
+
+        """
+        return divide_nodes([self.estimate_cost(op) for op in op_group],
+            node_list)
+
+
+    def set_process_limits(self, op, nops_per_node):
+        """
+        Sets the per-process CPU and memory limits of an operation
+
+        The limits are derived from the operation's direction.max_proc_per_node
+        and direction.max_io_proc_per_node, which must be set beforehand
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation for which to set the limits
+        nops_per_node : int
+            Number of operations that share each of the operation's nodes
+
+        """
+        fmem_max = factor.cluster.get_node_resources(op.parset,
+            op.direction.hosts)['wsclean_fmem']
+        nbands = len(op.bands)
+        ntimes = len(op.bands[0].files)
+        nfiles = ntimes * nbands
+
+        # Set maximum number of threads for normal and IO-intensive
+        # multithreaded processes (e.g., DPPP jobs) when run once,
+        # nfiles, ntimes, and nbands times per step (the most common cases)
+        op.direction.max_cpus_per_proc_single = op.direction.max_proc_per_node
+        op.direction.max_cpus_per_proc_ntimes = int(np.ceil(
+            op.direction.max_proc_per_node /
+            float(min(ntimes, op.direction.max_proc_per_node))))
+        op.direction.max_cpus_per_io_proc_ntimes = int(np.ceil(
+            op.direction.max_proc_per_node /
+            float(min(ntimes, op.direction.max_io_proc_per_node))))
+        op.direction.max_cpus_per_proc_nfiles = int(np.ceil(
+            op.direction.max_proc_per_node /
+            float(min(nfiles, op.direction.max_proc_per_node))))
+        op.direction.max_cpus_per_io_proc_nfiles = int(np.ceil(
+            op.direction.max_proc_per_node /
+            float(min(nfiles, op.direction.max_io_proc_per_node))))
+        op.direction.max_cpus_per_proc_nbands = int(np.ceil(
+            op.direction.max_proc_per_node /
+            float(min(nbands, op.direction.max_proc_per_node))))
+
+        # Maximum percentage of memory to give to jobs that allow memory
+        # limits (e.g., WSClean jobs)
+        op.direction.max_percent_memory_per_proc_single = (fmem_max /
+            float(nops_per_node) * 100.0)
+        op.direction.max_percent_memory_per_proc_ntimes = (fmem_max /
+            float(nops_per_node) * 100.0 /
+            float(min(ntimes, op.direction.max_proc_per_node)))
+        op.direction.max_percent_memory_per_io_proc_ntimes = (fmem_max /
+            float(nops_per_node) * 100.0 /
+            float(min(ntimes, op.direction.max_io_proc_per_node)))
+        op.direction.max_percent_memory_per_proc_nfiles = (fmem_max /
+            float(nops_per_node) * 100.0 /
+            float(min(nfiles, op.direction.max_proc_per_node)))
+        op.direction.max_percent_memory_per_io_proc_nfiles = (fmem_max /
+            float(nops_per_node) * 100.0 /
+            float(min(nfiles, op.direction.max_io_proc_per_node)))
+        op.direction.max_percent_memory_per_proc_nbands = (fmem_max /
+            float(nops_per_node) * 100.0 /
+            float(min(nbands, op.direction.max_proc_per_node)))
+
+        # Save the state
+        op.direction.save_state()
+
+
+    def record_runtime(self, op, stats):
+        """
+        Adds the measured run time of a successful operation to the history
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation that was run
+        stats : dict
+            Measurements returned by call_generic_pipeline()
+
+        """
+        if self.history is None:
+            return
+        self.history.add(op, stats, self.estimate_data_cost(op))
+
+
+    def get_pool(self):
+        """
+        Returns the worker pool, starting it if needed
+
+        The pool is started once and reused by all later calls to run() and
+        run_graph(), so that its workers load the pipeline framework only once
+        (see init_worker())
+
+        Returns
+        -------
+        pool : multiprocessing.Pool instance
+            The worker pool
+
+        """
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(processes=self.max_procs)
+
+        return self.pool
+
+
+    def close(self):
+        """
+        Stops the worker pool (if any)
+
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+    def start_operation(self, op):
+        """
+        Sets up an operation and sends it to the worker pool
+
+        The operation must already have its resources (hosts, etc.), as they
+        are written to its pipeline parset by its setup() method
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation to start
+
+        """
+        op.setup()
+        op.set_started()
+        self.get_pool().apply_async(call_generic_pipeline, (op.name,
+            op.direction.name, op.pipeline_parset_file,
+            op.pipeline_config_file, op.logbasename,
+            self.genericpipeline_executable),
+            callback=self.result_callback)
 
 
     def result_callback(self, result):
         """
         Callback function for apply_async result
+
+        The result is passed to the main thread, which hands the resources of
+        the finished operation over to the next one and finalizes it
+        """
+        self.result_queue.put(result)
+
+
+    def get_results(self):
+        """
+        Waits for one or more operations to finish
+
+        Returns
+        -------
+        results : list of tuples
+            Results returned by call_generic_pipeline()
+
+        """
+        # Note: a timeout is used so that the wait can be interrupted
+        results = [self.result_queue.get(True, 1e9)]
+        while not self.result_queue.empty():
+            results.append(self.result_queue.get())
+
+        return results
+
+
+    def process_result(self, result):
+        """
+        Processes the result of a finished operation started by run()
+
+        Parameters
+        ----------
+        result : tuple
+            Result returned by call_generic_pipeline()
+
         """
-        op_name, direction_name, status = result
+        op_name, direction_name, status, stats = result
 
         # Identify the current operation from the direction name
         try:
@@ -224,17 +684,19 @@ class Scheduler(object):
                 format(op_name, direction_name))
             return
 
-        # Reallocate resources
-        if len(self.queued_ops) > 0:
-            # Give the completed op's resources to the next one in line (if any)
-            next_op = self.queued_ops.pop(0)
-            next_op.direction.hosts = this_op.direction.hosts[:]
-            next_op.setup()
+        # Release the completed op's resources. They are given to the queued
+        # ops by self.start_queued_operations()
+        self.free_slots.update(self.op_slots.pop(direction_name))
+
+        # Record the outputs of the completed pipeline steps, so that the op can
+        # be resumed if needed
+        this_op.save_step_state()
 
         # Finalize the operation
         if status == 0:
             log.info('--> Operation {0} completed (direction: '
                 '{1})'.format(op_name, direction_name))
+            self.record_runtime(this_op, stats)
             this_op.finalize()
             this_op.set_completed()
         else:
@@ -243,6 +705,77 @@ class Scheduler(object):
             self.success = False
 
 
+    def get_slots(self, op_group):
+        """
+        Returns the node slots taken by operations with allocated resources
+
+        Each node provides ndir_per_node slots. An operation that has one or
+        more nodes to itself takes all of their slots, and operations that
+        share a node divide its slots. If more operations share a node than it
+        has slots, the extra operations take no slots, so that the number of
+        free slots never becomes negative
+
+        Parameters
+        ----------
+        op_group : list of Operation objects
+            Operations whose resources were set by allocate_resources()
+
+        Returns
+        -------
+        free_slots : Counter
+            Number of slots on each node not taken by the operations
+        op_slots : dict
+            Slots (as a Counter) taken by each operation, keyed by direction
+            name
+
+        """
+        node_list = op_group[0].node_list
+        ndir_per_node = op_group[0].parset['cluster_specific']['ndir_per_node']
+
+        c = Counter([op.direction.hosts[0] for op in op_group if
+            len(op.direction.hosts) == 1])
+        free_slots = Counter(dict([(n, ndir_per_node) for n in node_list]))
+        op_slots = {}
+        nshared = Counter()
+        for op in op_group:
+            h = op.direction.hosts
+            if len(h) == 1 and c[h[0]] > 1:
+                # Divide the node's slots as evenly as possible
+                nslots = ndir_per_node // c[h[0]]
+                if nshared[h[0]] < ndir_per_node % c[h[0]]:
+                    nslots += 1
+                nshared[h[0]] += 1
+                slots = Counter({h[0]: nslots})
+            else:
+                slots = Counter(dict([(n, ndir_per_node) for n in h]))
+            op_slots[op.direction.name] = slots
+            free_slots.subtract(slots)
+
+        return free_slots, op_slots
+
+
+    def start_queued_operations(self):
+        """
+        Starts as many queued operations as the free resources allow
+
+        The free nodes are divided among the started operations according to
+        their estimated cost, so the nodes released by an operation that
+        finishes early are not limited to a single queued operation
+
+        """
+        nstart = min(len(self.queued_ops), sum(self.free_slots.values()),
+            self.max_procs - self.nrunning)
+        if nstart <= 0:
+            return
+        to_start = self.queued_ops[:nstart]
+        self.queued_ops = self.queued_ops[nstart:]
+        op_slots = self.allocate_free_resources(to_start, self.free_slots)
+        for op, slots in zip(to_start, op_slots):
+            self.op_slots[op.direction.name] = slots
+            self.start_operation(op)
+            self.nrunning += 1
+
+
     def run(self, operation_list):
         """
         Runs a list of operations in parallel
@@ -255,41 +788,271 @@ class Scheduler(object):
         """
         if type(operation_list) != list:
             operation_list = [operation_list]
+        if len(operation_list) == 0:
+            return
+
+        # Find the completed ops from the state of all directions at once
+        store = get_state_store(operation_list[0].factor_working_dir)
+        operations = store.get_operations()
+        incomplete_ops = []
+        for op in operation_list:
+            if op.direction.name in operations:
+                op.direction.started_operations = operations[op.direction.name]['started']
+                op.direction.completed_operations = operations[op.direction.name]['completed']
+                if op.name not in op.direction.completed_operations:
+                    incomplete_ops.append(op)
+            elif not op.check_completed():
+                incomplete_ops.append(op)
+
+        # In dry-run mode, add the incomplete ops to the simulation (if any)
+        # before they are finalized
+        if self.dry_run and self.simulator is not None:
+            self.simulator.start_batch()
+            for op in incomplete_ops:
+                self.simulator.add_operation(op)
 
         # Finalize completed ops (so that various attributes are set correctly).
-        # The incomplete ops are finalized when complete in self.result_callback()
+        # The incomplete ops are finalized when complete in self.process_result()
         if self.dry_run:
             completed_ops = operation_list
+            incomplete_ops = []
         else:
-            completed_ops = [op for op in operation_list if op.check_completed()]
+            completed_ops = [op for op in operation_list if op not in incomplete_ops]
         for op in completed_ops:
             op.finalize()
             op.set_completed()
 
         # Filter out completed ops
-        self.operation_list = [op for op in operation_list if not op.check_completed()]
+        self.operation_list = incomplete_ops
         if len(self.operation_list) == 0 or self.dry_run:
             return
 
-        # Run the operation(s)
-        self.allocate_resources()
+        # Start the most expensive ops first, so that the queued (cheaper) ops
+        # fill in the gaps as resources become free
+        self.operation_list = self.sort_operations(self.operation_list)
+
+        # Run the operation(s). The queued ops are started only when running
+        # ops finish and release their resources, and they get their resources
+        # then (in self.start_queued_operations()), so only the first batch is
+        # allocated here
         with Timer(log, 'operation'):
-            pool = multiprocessing.Pool(processes=self.max_procs)
+            first_ops = self.operation_list[:self.max_procs]
+            self.allocate_resources(first_ops)
             self.queued_ops = self.operation_list[self.max_procs:]
-            for op in self.operation_list:
-                op.setup()
-                op.set_started()
-                pool.apply_async(call_generic_pipeline, (op.name,
-                    op.direction.name, op.pipeline_parset_file,
-                    op.pipeline_config_file, op.logbasename,
-                    self.genericpipeline_executable),
-                    callback=self.result_callback)
-            pool.close()
-            pool.join()
+            self.free_slots, self.op_slots = self.get_slots(first_ops)
+            self.nrunning = 0
+            for op in first_ops:
+                self.start_operation(op)
+                self.nrunning += 1
+            while self.nrunning > 0:
+                for result in self.get_results():
+                    self.nrunning -= 1
+                    self.process_result(result)
+                self.start_queued_operations()
 
         if not self.success:
             for op in self.operation_list:
                 # Remove any temp data left by failure
                 op.cleanup()
             log.error('One or more operations failed due to an error. Exiting...')
+            self.close()
+            sys.exit(1)
+
+
+    def allocate_free_resources(self, op_group, free_slots):
+        """
+        Divide up the free nodes and cpus among operations to be started
+
+        Each node provides ndir_per_node slots. If there are enough idle nodes,
+        each operation gets one or more whole nodes (the number depending on its
+        estimated cost); otherwise, each operation gets a single slot on the
+        node with the most free slots. This method is used to start operations
+        as resources are released by finished ones, both by run() (after the
+        first batch) and by run_graph()
+
+        Parameters
+        ----------
+        op_group : list of Operation objects
+            Operations to be started. There must be at least one free slot per
+            operation
+        free_slots : Counter
+            Number of free slots on each node. It is updated with the slots
+            taken by the operations
+
+        Returns
+        -------
+        op_slots : list of Counter
+            Slots taken by each operation, to be returned to free_slots when
+            the operation is done
+
+        """
+        node_list = op_group[0].node_list
+        parset = op_group[0].parset
+        ndir_per_node = parset['cluster_specific']['ndir_per_node']
+
+        idle_nodes = [n for n in node_list if free_slots[n] == ndir_per_node]
+        op_slots = []
+        if len(op_group) <= len(idle_nodes):
+            hosts = self.divide_nodes(op_group, idle_nodes)
+            for h in hosts:
+                op_slots.append(Counter(dict([(n, ndir_per_node) for n in h])))
+                free_slots.subtract(op_slots[-1])
+            nops_per_node = 1
+        else:
+            for op in op_group:
+                node = max(node_list, key=lambda n: free_slots[n])
+                op_slots.append(Counter({node: 1}))
+                free_slots.subtract(op_slots[-1])
+            nops_per_node = ndir_per_node
+
+        for op, slots in zip(op_group, op_slots):
+            op.direction.hosts = [n for n in node_list if n in slots]
+            resources = factor.cluster.get_node_resources(parset, op.direction.hosts)
+            op.direction.max_proc_per_node = max(1, int(np.ceil(resources['ncpu'] /
+                float(nops_per_node))))
+            op.direction.max_io_proc_per_node = max(1, int(np.ceil(resources['nthread_io'] /
+                float(nops_per_node))))
+        self.limit_memory(op_group)
+        for op in op_group:
+            self.set_process_limits(op, nops_per_node)
+
+        return op_slots
+
+
+    def run_graph(self, nodes):
+        """
+        Runs a graph of operations in parallel
+
+        Unlike run(), which processes a list of operations as a single batch,
+        each operation is started as soon as the operations it depends on have
+        finished and there are free resources for it
+
+        Parameters
+        ----------
+        nodes : list of OperationNode instances
+            Nodes of the graph. Operations that are ready at the same time are
+            started in order of decreasing estimated cost
+
+        """
+        # Check that the graph is complete and has no cycles
+        node_names = [node.name for node in nodes]
+        for node in nodes:
+            for name in node.depends_on:
+                if name not in node_names:
+                    log.error('Operation node {0} depends on unknown node '
+                        '{1}. Exiting...'.format(node.name, name))
+                    sys.exit(1)
+        resolved = set()
+        unresolved = nodes[:]
+        while len(unresolved) > 0:
+            ready = [node for node in unresolved if
+                all([name in resolved for name in node.depends_on])]
+            if len(ready) == 0:
+                log.error('Circular dependency found among operation nodes '
+                    '{0}. Exiting...'.format(', '.join([node.name for node in
+                    unresolved])))
+                sys.exit(1)
+            for node in ready:
+                resolved.add(node.name)
+                unresolved.remove(node)
+
+        finished = set()
+        waiting = nodes[:]
+        queued = [] # (node, op) pairs that are waiting for resources
+        running = [] # (node, op, slots) tuples
+        failed_ops = []
+        free_slots = None
+        sim_jobs = {} # simulation jobs that each node waits for (dry-run mode)
+        if self.dry_run and self.simulator is not None:
+            self.simulator.start_batch()
+        self.success = True
+        with Timer(log, 'operation graph'):
+            while True:
+                if self.success:
+                    # Make the operations of the nodes whose dependencies are
+                    # all done. Nodes without an operation (or with one that
+                    # was completed in a previous run) finish immediately and
+                    # may make other nodes ready, so repeat until nothing
+                    # changes
+                    progress = True
+                    while progress:
+                        progress = False
+                        for node in waiting[:]:
+                            if not all([name in finished for name in node.depends_on]):
+                                continue
+                            waiting.remove(node)
+                            op = node.make_operation()
+                            sim_jobs[node.name] = set()
+                            for name in node.depends_on:
+                                sim_jobs[node.name] |= sim_jobs.get(name, set())
+                            if (self.dry_run and self.simulator is not None and
+                                op is not None and not op.check_completed()):
+                                sim_jobs[node.name] = set([self.simulator.add_operation(
+                                    op, sim_jobs[node.name])])
+                            if op is None:
+                                finished.add(node.name)
+                                progress = True
+                            elif self.dry_run or op.check_completed():
+                                op.finalize()
+                                op.set_completed()
+                                finished.add(node.name)
+                                progress = True
+                            else:
+                                queued.append((node, op))
+
+                    # Start as many queued operations as the free resources
+                    # allow
+                    if len(queued) > 0:
+                        if free_slots is None:
+                            ndir_per_node = queued[0][1].parset['cluster_specific']['ndir_per_node']
+                            free_slots = Counter(dict([(n, ndir_per_node) for n in
+                                queued[0][1].node_list]))
+                        nstart = min(len(queued), sum(free_slots.values()),
+                            self.max_procs - len(running))
+                        if nstart > 0:
+                            costs = dict([(node.name, self.estimate_cost(op)) for
+                                node, op in queued])
+                            queued.sort(key=lambda job: -costs[job[0].name])
+                            to_start = queued[:nstart]
+                            queued = queued[nstart:]
+                            op_slots = self.allocate_free_resources([op for node, op
+                                in to_start], free_slots)
+                            for (node, op), slots in zip(to_start, op_slots):
+                                self.start_operation(op)
+                                running.append((node, op, slots))
+
+                # If nothing is running, everything that could be run is done
+                # (or, after a failure, nothing new is started)
+                if len(running) == 0:
+                    break
+
+                # Wait for running operations to finish, then finalize them and
+                # release their resources
+                for result in self.get_results():
+                    op_name, direction_name, status, stats = result
+                    job = [j for j in running if j[1].name == op_name and
+                        j[1].direction.name == direction_name][0]
+                    node, op, slots = job
+                    running.remove(job)
+                    free_slots.update(slots)
+                    op.save_step_state()
+                    if status == 0:
+                        log.info('--> Operation {0} completed (direction: '
+                            '{1})'.format(op.name, op.direction.name))
+                        self.record_runtime(op, stats)
+                        op.finalize()
+                        op.set_completed()
+                        finished.add(node.name)
+                    else:
+                        log.error('Operation {0} failed due to an error (direction: '
+                            '{1})'.format(op.name, op.direction.name))
+                        self.success = False
+                        failed_ops.append(op)
+
+        if not self.success:
+            for op in failed_ops:
+                # Remove any temp data left by failure
+                op.cleanup()
+            log.error('One or more operations failed due to an error. Exiting...')
+            self.close()
             sys.exit(1)
@@ -0,0 +1,505 @@
+"""
+Definition of the cost simulator used to predict the resources of a run
+"""
+import os
+import logging
+import numpy as np
+from collections import Counter
+import factor.cluster
+from factor.lib.history import get_work
+from factor.lib.scheduler import divide_nodes
+
+
+log = logging.getLogger('factor:simulator')
+
+
+# Work in CPU-seconds per GB of input visibility data for the pipeline step
+# types that pass over the data
+DATA_STEP_COSTS = {'dppp': 60.0, 'dppp_inplace': 120.0, 'dppp_concat': 15.0,
+    'pre_average': 60.0, 'copy_column': 15.0, 'add_subtract_columns': 15.0,
+    'make_chunk_copy': 15.0, 'sync_files': 5.0, 'wsclean_ft': 90.0,
+    'wsclean': 90.0, 'awimager': 180.0}
+
+# Work in CPU-seconds per megapixel per output channel for imaging steps
+IMAGE_STEP_COSTS = {'wsclean': 400.0, 'awimager': 800.0, 'wsclean_ft': 40.0}
+
+# Work in CPU-seconds for the other (non-plugin) step types
+OTHER_STEP_COST = 10.0
+
+# Step types that write new visibility data
+DATA_OUTPUT_STEPS = ['dppp', 'dppp_concat', 'pre_average', 'sync_files']
+
+# Step types whose jobs can use all the CPUs given to the operation (the jobs
+# of the other data steps are assumed to run one per time chunk)
+MULTITHREADED_STEPS = ['dppp', 'dppp_inplace', 'pre_average', 'wsclean_ft',
+    'wsclean', 'awimager']
+
+# Memory in MB used by each data-step process and by each imaging step in
+# addition to its images
+PROCESS_MEMORY_MB = 500.0
+IMAGER_MEMORY_MB = 2000.0
+
+
+class CostSimulator(object):
+    """
+    Class that predicts the resources needed to run a set of operations
+
+    The operations are added as they would be run (see Scheduler.run() and
+    Scheduler.run_graph() in dry-run mode). The cost of each operation is taken
+    from the runtime history if the operation was run before on the same data.
+    Otherwise, it is modeled from the steps of its rendered pipeline parset,
+    the amount of data each step reads (following the averaging done by the
+    earlier steps), and the image sizes, with steps inside loops counted the
+    maximum number of times. The modeled costs are scaled to match the
+    measured ones, if any. The operations are then scheduled on the nodes in
+    the same way as by the scheduler
+
+    Parameters
+    ----------
+    parset : dict
+        Parset with the cluster parameters (node_list, ncpu and ndir_per_node)
+    max_procs : int
+        Maximum number of operations to run at once
+    history : RuntimeHistory instance, optional
+        History of the run times of earlier operations
+
+    """
+    def __init__(self, parset, max_procs, history=None):
+        self.parset = parset
+        self.node_list = parset['cluster_specific']['node_list']
+        self.ncpu = parset['cluster_specific']['ncpu']
+        self.ndir_per_node = parset['cluster_specific']['ndir_per_node']
+        self.max_procs = max_procs
+        self.history = history
+        self.jobs = []
+        self.barrier = set()
+        self.path_sizes = {}
+
+
+    def start_batch(self):
+        """
+        Makes the operations added from now on wait for all earlier ones
+
+        """
+        self.barrier = set(range(len(self.jobs)))
+
+
+    def add_operation(self, op, depends_on=None):
+        """
+        Adds an operation to the simulation
+
+        This must be done before the operation is finalized, as finalizing may
+        change the attributes of its direction
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation to add
+        depends_on : set of int, optional
+            Indices of the added operations that must finish before this one
+            is started (in addition to those added before the last call to
+            start_batch())
+
+        Returns
+        -------
+        indx : int
+            Index of the operation
+
+        """
+        if depends_on is None:
+            depends_on = set()
+        job = {'operation': op.name, 'direction': op.direction.name,
+            'depends_on': self.barrier | depends_on}
+        job.update(self.estimate_operation(op))
+        last_run = None
+        if self.history is not None:
+            last_run = self.history.get_last_run(op)
+        if last_run is not None:
+            job['measured_work'] = get_work(last_run)
+            job['memory_mb'] = last_run['peak_memory_mb']
+        else:
+            job['measured_work'] = None
+        self.jobs.append(job)
+
+        return len(self.jobs) - 1
+
+
+    def estimate_operation(self, op):
+        """
+        Models the work, memory and disk use of an operation
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation to model
+
+        Returns
+        -------
+        estimate : dict
+            Dict with the steps as a list of (work in CPU-s, number of parallel
+            jobs) tuples ('steps'), the peak memory per node in MB
+            ('memory_mb'), the size of the data and images written in GB
+            ('disk_gb'), and the peak use of the local scratch directories in
+            GB ('scratch_gb')
+
+        """
+        estimate = {'steps': [], 'memory_mb': 0.0, 'disk_gb': 0.0,
+            'scratch_gb': 0.0}
+        op.update_dicts()
+        try:
+            step_parameters, step_order = op.get_pipeline_steps()
+        except Exception as e:
+            log.warn('Could not render the pipeline parset of operation {0} '
+                '(direction: {1}): {2}. Its cost is not included'.format(op.name,
+                op.direction.name, e))
+            return estimate
+
+        nchunks = len(op.bands[0].files)
+        data_gb = sum([self.get_path_size(f) for band in op.bands for f in
+            band.files]) / 1024.0**3
+
+        # Find the number of times that each step in a loop is run
+        nruns = Counter()
+        for step in step_order:
+            parameters = dict(step_parameters.get(step, []))
+            loopsteps = parameters.get('{0}.control.loopsteps'.format(step))
+            if loopsteps is not None:
+                loopcount = get_number(parameters.get('{0}.control.loopcount'.format(step)), 1)
+                for s in loopsteps.strip('[]').split(','):
+                    nruns[s.strip()] = max(1, int(loopcount))
+
+        # Follow the data through the steps. The amount of data read by a step
+        # is the amount written by the step that made its input mapfile
+        volumes = {}
+        synced_gb = 0.0
+        for step in step_order:
+            parameters = dict(step_parameters.get(step, []))
+            step_type = parameters.get('{0}.control.type'.format(step))
+            kind = parameters.get('{0}.control.kind'.format(step), 'recipe')
+            input_gb = data_gb
+            for key in ['mapfile_in', 'mapfiles_in']:
+                value = parameters.get('{0}.control.{1}'.format(step, key))
+                if value is not None:
+                    input_step = value.strip('[]').split(',')[0].split('.output')[0].strip()
+                    input_gb = volumes.get(input_step, data_gb)
+                    break
+            avg_factor = 1.0
+            for key, value in parameters.iteritems():
+                if key.endswith('.freqstep') or key.endswith('.timestep'):
+                    avg_factor *= max(1.0, get_number(value, 1.0))
+            volumes[step] = input_gb / avg_factor
+            if kind in ['plugin', 'loop'] or step_type is None:
+                continue
+
+            # Work and memory
+            n = nruns.get(step, 1)
+            if step_type in MULTITHREADED_STEPS:
+                njobs = None
+            else:
+                njobs = nchunks
+            work = DATA_STEP_COSTS.get(step_type, 0.0) * input_gb
+            if step_type not in DATA_STEP_COSTS:
+                work += OTHER_STEP_COST
+            memory_mb = PROCESS_MEMORY_MB * min(self.ncpu, len(op.bands) * nchunks)
+            image_gb = 0.0
+            if step_type in IMAGE_STEP_COSTS:
+                imsize = get_number(parameters.get('{0}.argument.size'.format(step),
+                    parameters.get('{0}.argument.npix'.format(step))), 0.0)
+                nchan = max(1.0, get_number(parameters.get(
+                    '{0}.argument.channelsout'.format(step)), 1.0))
+                work += IMAGE_STEP_COSTS[step_type] * (imsize / 1000.0)**2 * nchan
+                image_gb = imsize**2 * 4.0 * (nchan + 1) * 5.0 / 1024.0**3
+                memory_mb = IMAGER_MEMORY_MB + image_gb * 1024.0
+            estimate['steps'].append((work * n, njobs))
+            estimate['memory_mb'] = max(estimate['memory_mb'], memory_mb)
+
+            # Disk and scratch use
+            output_gb = 0.0
+            if step_type in DATA_OUTPUT_STEPS:
+                output_gb = volumes[step]
+            if step_type in ['wsclean', 'awimager']:
+                output_gb = image_gb
+            if step_type == 'sync_files':
+                synced_gb += output_gb
+                estimate['scratch_gb'] = max(estimate['scratch_gb'], synced_gb)
+            elif ('{0}.argument.local_scratch_dir'.format(step) in parameters or
+                '{0}.argument.tempdir'.format(step) in parameters):
+                estimate['scratch_gb'] = max(estimate['scratch_gb'], synced_gb +
+                    max(output_gb, input_gb))
+            estimate['disk_gb'] += output_gb * n
+
+        return estimate
+
+
+    def get_path_size(self, path):
+        """
+        Returns the size on disk of a file or directory (e.g., an MS)
+
+        Parameters
+        ----------
+        path : str
+            Path of file or directory
+
+        Returns
+        -------
+        size : int
+            Size in bytes
+
+        """
+        if path not in self.path_sizes:
+            size = 0
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    for f in files:
+                        try:
+                            size += os.path.getsize(os.path.join(root, f))
+                        except OSError:
+                            pass
+            elif os.path.exists(path):
+                size = os.path.getsize(path)
+            self.path_sizes[path] = size
+
+        return self.path_sizes[path]
+
+
+    def get_ncpu(self, node):
+        """
+        Returns the number of CPUs to use on a node
+
+        Parameters
+        ----------
+        node : str
+            Name of node
+
+        Returns
+        -------
+        ncpu : int
+            Number of CPUs
+
+        """
+        return factor.cluster.get_node_resources(self.parset, [node])['ncpu']
+
+
+    def get_wall_time(self, job, ncpu, scale):
+        """
+        Returns the predicted wall time of an operation
+
+        Parameters
+        ----------
+        job : dict
+            Operation, as added by add_operation()
+        ncpu : int
+            Number of CPUs given to the operation
+        scale : float
+            Factor by which modeled costs are multiplied
+
+        Returns
+        -------
+        wall_time : float
+            Wall time in s
+
+        """
+        if job['measured_work'] is not None:
+            return job['measured_work'] / float(ncpu)
+
+        wall_time = 0.0
+        for work, njobs in job['steps']:
+            if njobs is None:
+                wall_time += work / float(ncpu)
+            else:
+                wall_time += work / float(min(ncpu, njobs))
+
+        return wall_time * scale
+
+
+    def get_scale(self):
+        """
+        Returns the factor by which modeled costs are multiplied
+
+        The factor is the median ratio of the measured to the modeled work of
+        the operations that were run before (1 if there are none)
+
+        Returns
+        -------
+        scale : float
+            Scale factor
+
+        """
+        ratios = []
+        for job in self.jobs:
+            modeled_work = sum([work for work, njobs in job['steps']])
+            if job['measured_work'] is not None and modeled_work > 0.0:
+                ratios.append(job['measured_work'] / modeled_work)
+        if len(ratios) == 0:
+            return 1.0
+
+        return float(np.median(ratios))
+
+
+    def simulate(self):
+        """
+        Schedules the operations on the nodes
+
+        Operations whose dependencies are done are started in order of
+        decreasing cost. If there are enough idle nodes, each one gets whole
+        nodes (the number depending on its cost); otherwise, each gets one of
+        the ndir_per_node slots of a node and its share of the node's CPUs
+
+        Returns
+        -------
+        result : dict
+            Dict with the total wall time in s ('wall_time'), the peak memory in
+            MB ('memory_mb') and peak scratch use in GB ('scratch_gb') on each
+            node, the total size of the data and images written in GB
+            ('disk_gb'), the scale factor of the modeled costs ('scale'), and
+            the start and end times of each operation ('times')
+
+        """
+        scale = self.get_scale()
+        free_slots = Counter(dict([(n, self.ndir_per_node) for n in self.node_list]))
+        memory_mb = Counter()
+        scratch_gb = Counter()
+        peak_memory_mb = Counter()
+        peak_scratch_gb = Counter()
+        times = [None] * len(self.jobs)
+        waiting = range(len(self.jobs))
+        running = [] # (end time, job index, slots) tuples
+        finished = set()
+        now = 0.0
+        while len(waiting) > 0 or len(running) > 0:
+            ready = [i for i in waiting if self.jobs[i]['depends_on'] <= finished]
+            nstart = min(len(ready), sum(free_slots.values()), self.max_procs -
+                len(running))
+            if nstart > 0:
+                costs = dict([(i, self.get_wall_time(self.jobs[i], self.ncpu, scale))
+                    for i in ready])
+                ready.sort(key=lambda i: -costs[i])
+                to_start = ready[:nstart]
+                idle_nodes = [n for n in self.node_list if free_slots[n] ==
+                    self.ndir_per_node]
+                if len(to_start) <= len(idle_nodes):
+                    hosts = divide_nodes([costs[i] for i in to_start], idle_nodes)
+                    op_slots = [Counter(dict([(n, self.ndir_per_node) for n in h]))
+                        for h in hosts]
+                    ncpus = [sum([self.get_ncpu(n) for n in h]) for h in hosts]
+                else:
+                    op_slots = []
+                    slots_left = free_slots.copy()
+                    for i in to_start:
+                        node = max(self.node_list, key=lambda n: slots_left[n])
+                        op_slots.append(Counter({node: 1}))
+                        slots_left.subtract(op_slots[-1])
+                    ncpus = [max(1, int(np.ceil(self.get_ncpu(slots.keys()[0]) /
+                        float(self.ndir_per_node)))) for slots in op_slots]
+                for i, slots, ncpu in zip(to_start, op_slots, ncpus):
+                    job = self.jobs[i]
+                    waiting.remove(i)
+                    free_slots.subtract(slots)
+                    end = now + self.get_wall_time(job, ncpu, scale)
+                    times[i] = (now, end)
+                    running.append((end, i, slots))
+                    for n in slots:
+                        memory_mb[n] += job['memory_mb']
+                        scratch_gb[n] += job['scratch_gb'] / len(slots)
+                        peak_memory_mb[n] = max(peak_memory_mb[n], memory_mb[n])
+                        peak_scratch_gb[n] = max(peak_scratch_gb[n], scratch_gb[n])
+                continue
+
+            if len(running) == 0:
+                # Should not happen, as the operations are added in an order
+                # in which they can be run
+                log.warn('{0} operation(s) could not be scheduled'.format(len(waiting)))
+                break
+
+            # Finish the next operation
+            running.sort()
+            end, i, slots = running.pop(0)
+            now = end
+            finished.add(i)
+            free_slots.update(slots)
+            for n in slots:
+                memory_mb[n] -= self.jobs[i]['memory_mb']
+                scratch_gb[n] -= self.jobs[i]['scratch_gb'] / len(slots)
+
+        return {'wall_time': now, 'memory_mb': peak_memory_mb,
+            'scratch_gb': peak_scratch_gb, 'scale': scale, 'times': times,
+            'disk_gb': sum([job['disk_gb'] for job in self.jobs])}
+
+
+    def report(self, bands=None):
+        """
+        Logs the predicted wall time, memory and disk use
+
+        Parameters
+        ----------
+        bands : list of Band instances, optional
+            Bands of the run. If given, the size of their data is included in
+            the disk use
+
+        """
+        if len(self.jobs) == 0:
+            log.info('Simulation: all operations are already done')
+            return
+        result = self.simulate()
+        nmeasured = len([job for job in self.jobs if job['measured_work'] is not None])
+
+        log.info('Simulation of {0} operation(s) on {1} node(s) with ncpu = {2} '
+            'and ndir_per_node = {3}:'.format(len(self.jobs), len(self.node_list),
+            self.ncpu, self.ndir_per_node))
+        log.info('{0} operation(s) timed from earlier runs, {1} modeled (model '
+            'scale factor: {2:.2f})'.format(nmeasured, len(self.jobs) - nmeasured,
+            result['scale']))
+
+        # Sum the wall times per type of operation
+        op_times = {}
+        for job, (start, end) in zip(self.jobs, result['times']):
+            if job['operation'] not in op_times:
+                op_times[job['operation']] = [0, 0.0]
+            op_times[job['operation']][0] += 1
+            op_times[job['operation']][1] += end - start
+        log.info('{0:<16} {1:>5} {2:>12}'.format('Operation', 'Runs', 'Wall (h)'))
+        for op_name, (nruns, wall_time) in sorted(op_times.iteritems(),
+            key=lambda item: -item[1][1]):
+            log.info('{0:<16} {1:>5} {2:>12.2f}'.format(op_name, nruns,
+                wall_time / 3600.0))
+
+        log.info('Predicted total wall time: {0:.1f} h'.format(result['wall_time'] /
+            3600.0))
+        log.info('{0:<24} {1:>16} {2:>16}'.format('Node', 'Peak memory (GB)',
+            'Peak scratch (GB)'))
+        for node in self.node_list:
+            log.info('{0:<24} {1:>16.1f} {2:>16.1f}'.format(node,
+                result['memory_mb'][node] / 1024.0, result['scratch_gb'][node]))
+        if bands is not None:
+            data_gb = sum([self.get_path_size(f) for band in bands for f in
+                band.files]) / 1024.0**3
+            log.info('Predicted disk use: {0:.1f} GB of input data and up to '
+                '{1:.1f} GB of pipeline output'.format(data_gb, result['disk_gb']))
+        else:
+            log.info('Predicted disk use: up to {0:.1f} GB of pipeline '
+                'output'.format(result['disk_gb']))
+
+
+def get_number(value, default=0.0):
+    """
+    Returns the first number in a parset value
+
+    Parameters
+    ----------
+    value : str or None
+        Parset value (e.g., '4' or '2048 2048')
+    default : float, optional
+        Value returned if no number is found
+
+    Returns
+    -------
+    number : float
+        The number
+
+    """
+    if value is None:
+        return default
+    try:
+        return float(value.strip('[]').split()[0].split(',')[0])
+    except (ValueError, IndexError):
+        return default
@@ -0,0 +1,74 @@
+"""
+Functions for handling calibration solutions stored in parmdbs
+"""
+import numpy as np
+
+
+def convert_realimag_to_phasors(parms):
+    """
+    Converts real/imaginary gain solutions to amplitudes and phases
+
+    The amplitudes and phases of all solutions are calculated at once from
+    stacked arrays (per shape of the solution grid), so that the conversion of
+    parmdbs with many stations and long solution grids is fast
+
+    Parameters
+    ----------
+    parms : dict
+        Solutions as returned by parmdb.getValuesGrid() or parmdb.getValues(),
+        with the real and imaginary parts as 'Gain:x:y:Real:station' and
+        'Gain:x:y:Imag:station'
+
+    Returns
+    -------
+    phasors : dict
+        Solutions with the amplitudes and phases as 'Gain:x:y:Ampl:station' and
+        'Gain:x:y:Phase:station', on the grids of the input solutions. Entries
+        other than Real and Imag are not included
+
+    """
+    # Group the solutions by the shape of their values
+    groups = {}
+    for name in parms:
+        if ':Real:' not in name:
+            continue
+        imag_name = name.replace(':Real:', ':Imag:')
+        if imag_name not in parms:
+            continue
+        shape = np.shape(parms[name]['values'])
+        groups.setdefault(shape, []).append(name)
+
+    phasors = {}
+    for names in groups.itervalues():
+        real = np.array([parms[name]['values'] for name in names])
+        imag = np.array([parms[name.replace(':Real:', ':Imag:')]['values'] for name
+            in names])
+        amp = np.hypot(real, imag)
+        phase = np.arctan2(imag, real)
+        for i, name in enumerate(names):
+            grid = dict([(key, value) for key, value in parms[name].iteritems() if
+                key != 'values'])
+            phasors[name.replace(':Real:', ':Ampl:')] = dict(grid, values=amp[i])
+            phasors[name.replace(':Real:', ':Phase:')] = dict(grid, values=phase[i])
+
+    return phasors
+
+
+def convert_parmdb_to_phasors(pdb_in, pdb_out):
+    """
+    Converts a parmdb with real/imaginary gain solutions to one with phasors
+
+    The input parmdb is read once, and all converted solutions are written with
+    a single call to addValues()
+
+    Parameters
+    ----------
+    pdb_in : parmdb instance
+        Input parmdb with real/imaginary solutions
+    pdb_out : parmdb instance
+        Output parmdb to which the amplitude/phase solutions are written
+
+    """
+    phasors = convert_realimag_to_phasors(pdb_in.getValuesGrid('*'))
+    pdb_out.addValues(phasors)
+    pdb_out.flush()
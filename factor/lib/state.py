@@ -0,0 +1,265 @@
+"""
+Definition of the state store that holds the state of the bands, directions
+and operations
+"""
+import os
+import logging
+import pickle
+import sqlite3
+
+
+log = logging.getLogger('factor:state')
+
+
+class StateStore(object):
+    """
+    Class that stores the state of a run in a SQLite database
+
+    The state of each band and direction is stored as a pickled dict, and the
+    status (started or completed) of each operation of each direction is stored
+    in an indexed table, so that it can be queried without loading the
+    directions. Each update is done in a single transaction, so an interrupted
+    update leaves the previous state intact. The database also caches the
+    metadata of the measurement sets and the results of the checks of their
+    parmdbs
+
+    Parameters
+    ----------
+    working_dir : str
+        Factor working directory. The database is stored in the state
+        subdirectory
+
+    """
+    def __init__(self, working_dir):
+        self.state_dir = os.path.join(working_dir, 'state')
+        self.db_file = os.path.join(self.state_dir, 'state.db')
+        self.conn = None
+        self.pid = None
+
+
+    def connect(self):
+        """
+        Returns the connection to the database, opening it if needed
+
+        A new connection is opened in each process, as connections cannot be
+        shared with forked processes
+
+        Returns
+        -------
+        conn : sqlite3.Connection instance
+            Connection to the database
+
+        """
+        if self.conn is None or self.pid != os.getpid():
+            if not os.path.exists(self.state_dir):
+                os.makedirs(self.state_dir)
+            self.conn = sqlite3.connect(self.db_file, timeout=60.0)
+            self.conn.text_factory = str
+            self.pid = os.getpid()
+            with self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS objects (kind TEXT, '
+                    'name TEXT, state BLOB, PRIMARY KEY (kind, name))')
+                self.conn.execute('CREATE TABLE IF NOT EXISTS operations (direction '
+                    'TEXT, operation TEXT, status TEXT, PRIMARY KEY (direction, '
+                    'operation, status))')
+                self.conn.execute('CREATE INDEX IF NOT EXISTS operations_status ON '
+                    'operations (status, operation)')
+                self.conn.execute('CREATE TABLE IF NOT EXISTS ms_metadata (path TEXT '
+                    'PRIMARY KEY, signature TEXT, metadata BLOB)')
+
+        return self.conn
+
+
+    def save(self, kind, name, state, started_operations=None,
+        completed_operations=None):
+        """
+        Saves the state of an object
+
+        Parameters
+        ----------
+        kind : str
+            Kind of object (e.g., 'band' or 'direction')
+        name : str
+            Name of object
+        state : dict
+            State to save
+        started_operations : list of str, optional
+            Names of the started operations of a direction. If given, they
+            replace the stored ones
+        completed_operations : list of str, optional
+            Names of the completed operations of a direction. If given, they
+            replace the stored ones
+
+        """
+        conn = self.connect()
+        blob = sqlite3.Binary(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?)', (kind,
+                name, blob))
+            for status, op_names in [('started', started_operations),
+                ('completed', completed_operations)]:
+                if op_names is None:
+                    continue
+                conn.execute('DELETE FROM operations WHERE direction = ? AND '
+                    'status = ?', (name, status))
+                conn.executemany('INSERT OR IGNORE INTO operations VALUES (?, ?, ?)',
+                    [(name, op_name, status) for op_name in op_names])
+
+
+    def load(self, kind, name, legacy_file=None):
+        """
+        Loads the state of an object
+
+        Parameters
+        ----------
+        kind : str
+            Kind of object (e.g., 'band' or 'direction')
+        name : str
+            Name of object
+        legacy_file : str, optional
+            Pickle file from which the state is loaded if it is not in the
+            database (as saved by earlier versions of Factor)
+
+        Returns
+        -------
+        state : dict or None
+            The state, or None if no state was found
+
+        """
+        row = self.connect().execute('SELECT state FROM objects WHERE kind = ? AND '
+            'name = ?', (kind, name)).fetchone()
+        if row is not None:
+            return pickle.loads(str(row[0]))
+
+        if legacy_file is not None and os.path.exists(legacy_file):
+            try:
+                with open(legacy_file, 'r') as f:
+                    return pickle.load(f)
+            except Exception:
+                log.warn('Could not read state file {0}'.format(legacy_file))
+
+        return None
+
+
+    def get_operations(self, direction_name=None):
+        """
+        Returns the started and completed operations
+
+        Parameters
+        ----------
+        direction_name : str, optional
+            Name of direction. If None, the operations of all directions are
+            returned
+
+        Returns
+        -------
+        operations : dict
+            Dict with the lists of started and completed operations as a dict
+            (with keys 'started' and 'completed') for each direction
+
+        """
+        query = 'SELECT direction, operation, status FROM operations'
+        args = ()
+        if direction_name is not None:
+            query += ' WHERE direction = ?'
+            args = (direction_name,)
+        query += ' ORDER BY rowid'
+        operations = {}
+        for direction, operation, status in self.connect().execute(query, args):
+            if direction not in operations:
+                operations[direction] = {'started': [], 'completed': []}
+            operations[direction][status].append(operation)
+
+        return operations
+
+
+    def get_names(self, kind):
+        """
+        Returns the names of the objects of a kind with a saved state
+
+        Parameters
+        ----------
+        kind : str
+            Kind of object (e.g., 'band' or 'direction')
+
+        Returns
+        -------
+        names : list of str
+            Names of the objects
+
+        """
+        return [row[0] for row in self.connect().execute('SELECT name FROM '
+            'objects WHERE kind = ?', (kind,))]
+
+
+    def load_ms_metadata(self, path, signature):
+        """
+        Loads the cached metadata of an MS
+
+        Parameters
+        ----------
+        path : str
+            Path of the MS
+        signature : str
+            Signature of the current version of the MS (see
+            factor.lib.band.get_ms_signature())
+
+        Returns
+        -------
+        metadata : dict or None
+            The metadata, or None if there is no entry for the MS or if the
+            entry was made for a different version of the MS
+
+        """
+        row = self.connect().execute('SELECT signature, metadata FROM ms_metadata '
+            'WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] != signature:
+            return None
+
+        return pickle.loads(str(row[1]))
+
+
+    def save_ms_metadata(self, path, signature, metadata):
+        """
+        Saves the metadata of an MS to the cache
+
+        Parameters
+        ----------
+        path : str
+            Path of the MS
+        signature : str
+            Signature of the current version of the MS
+        metadata : dict
+            Metadata to save
+
+        """
+        conn = self.connect()
+        blob = sqlite3.Binary(pickle.dumps(metadata, pickle.HIGHEST_PROTOCOL))
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO ms_metadata VALUES (?, ?, ?)',
+                (path, signature, blob))
+
+
+_stores = {}
+
+
+def get_state_store(working_dir):
+    """
+    Returns the state store of a working directory
+
+    Parameters
+    ----------
+    working_dir : str
+        Factor working directory
+
+    Returns
+    -------
+    store : StateStore instance
+        The state store
+
+    """
+    working_dir = os.path.abspath(working_dir)
+    if working_dir not in _stores:
+        _stores[working_dir] = StateStore(working_dir)
+
+    return _stores[working_dir]
@@ -140,9 +140,13 @@ def get_global_options(parset):
 
     # Size of time chunks in seconds (default = 2400; minimum allowed value is
     # 1200). Generally, the number of chunks should be at least the number of
-    # available CPUs.
+    # available CPUs. If auto, the size is set from the number of CPUs and the
+    # memory of the nodes (see factor.cluster.get_chunk_size())
     if 'chunk_size_sec' in parset_dict:
-        parset_dict['chunk_size_sec'] = parset.getfloat('global', 'chunk_size_sec')
+        if parset_dict['chunk_size_sec'].lower() == 'auto':
+            parset_dict['chunk_size_sec'] = None
+        else:
+            parset_dict['chunk_size_sec'] = parset.getfloat('global', 'chunk_size_sec')
     else:
         parset_dict['chunk_size_sec'] = 2400.0
 
@@ -157,6 +161,22 @@ def get_global_options(parset):
     else:
         parset_dict['use_compression'] = False
 
+    # Make the chunks as reference tables (default = False). Enabling this
+    # option will result in less storage usage and I/O, as the chunks refer to
+    # the rows of the input data instead of copying them. A chunk is copied
+    # only before it is first written to (i.e., before the first subtraction).
+    # Reference chunks cannot be compressed, so this option is ignored if
+    # use_compression is enabled
+    if 'use_reference_chunks' in parset_dict:
+        parset_dict['use_reference_chunks'] = parset.getboolean('global',
+            'use_reference_chunks')
+    else:
+        parset_dict['use_reference_chunks'] = False
+    if parset_dict['use_reference_chunks'] and parset_dict['use_compression']:
+        log.warning('Reference chunks cannot be used with compression. Chunks '
+            'will be copied')
+        parset_dict['use_reference_chunks'] = False
+
     # Use interactive mode (default = False). Factor will ask for confirmation of
     # internally derived DDE calibrators and facets
     if 'interactive' in parset_dict:
@@ -257,7 +277,8 @@ def get_global_options(parset):
         'peel_flux_jy', 'keep_unavg_facet_data', 'max_selfcal_loops',
         'preaverage_flux_jy', 'multiscale_selfcal', 'skymodel_extension',
         'max_peak_smearing', 'tec_block_mhz', 'selfcal_cellsize_arcsec',
-        'selfcal_robust', 'use_compression', 'flag_abstime', 'flag_baseline']
+        'selfcal_robust', 'use_compression', 'use_reference_chunks',
+        'flag_abstime', 'flag_baseline']
     allowed_options.extend(['direction_specific', 'calibration_specific',
         'imaging_specific', 'cluster_specific']) # add dicts needed for deprecated options
     deprecated_options_imaging = ['make_mosaic', 'facet_imager',
@@ -917,6 +938,31 @@ def get_cluster_options(parset):
     log.info("Running up to %i IO-intensive job(s) in parallel per node" %
         (parset_dict['nthread_io']))
 
+    # Run the operations as a dependency graph (default = False). If True, each
+    # operation is started as soon as the operations whose results it needs have
+    # finished. Selfcal and subtraction still run group by group (as each
+    # subtraction writes the data that later selfcal and imaging read), so only
+    # the imaging and mosaicking are sped up
+    if 'dependency_scheduling' in parset_dict:
+        parset_dict['dependency_scheduling'] = parset.getboolean('cluster',
+            'dependency_scheduling')
+    else:
+        parset_dict['dependency_scheduling'] = False
+
+    # Probe the hardware of each node at startup (default = False). If True, the
+    # number of CPUs, the number of IO-intensive threads, and the fraction of
+    # memory that WSClean may use are derived for each node from its cores,
+    # memory, scratch-disk throughput, and ram-drive size. Any ncpu, nthread_io,
+    # and wsclean_fmem values given above are then used as upper limits
+    if 'probe_nodes' in parset_dict:
+        parset_dict['probe_nodes'] = parset.getboolean('cluster', 'probe_nodes')
+    else:
+        parset_dict['probe_nodes'] = False
+    parset_dict['probe_limits'] = {}
+    for key in ['ncpu', 'nthread_io', 'wsclean_fmem']:
+        if key in given_options or (key == 'wsclean_fmem' and 'fmem' in given_options):
+            parset_dict['probe_limits'][key] = parset_dict[key]
+
     # Full path to cluster description file. Use clusterdesc_file = PBS to use
     # the PBS / torque reserved nodes and clusterdesc_file = SLURM to use SLURM
     # reserved ones. If not given, the clusterdesc file for a single (i.e.,
@@ -939,7 +985,8 @@ def get_cluster_options(parset):
     # Check for unused options
     allowed_options = ['ncpu', 'fmem', 'wsclean_fmem', 'ndir_per_node',
         'clusterdesc_file', 'cluster_type', 'dir_local', 'dir_local_selfcal',
-        'node_list', 'lofarroot', 'lofarpythonpath', 'nthread_io']
+        'node_list', 'lofarroot', 'lofarpythonpath', 'nthread_io',
+        'dependency_scheduling', 'probe_nodes']
     for option in given_options:
         if option not in allowed_options:
             log.warning('Option "{}" was given in the [cluster] section of the '
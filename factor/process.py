@@ -8,7 +8,8 @@ import numpy as np
 import logging
 import pickle
 import collections
-import casacore.tables as pt
+import multiprocessing
+import multiprocessing.pool
 from lofarpipe.support.data_map import DataMap
 import factor
 import factor.directions
@@ -17,16 +18,19 @@ import factor.cluster
 from factor.operations.outlier_ops import *
 from factor.operations.field_ops import *
 from factor.operations.facet_ops import *
-from factor.lib.scheduler import Scheduler
+from factor.lib.scheduler import Scheduler, OperationNode
+from factor.lib.history import RuntimeHistory
+from factor.lib.simulator import CostSimulator
 from factor.lib.direction import Direction
-from factor.lib.band import Band
+from factor.lib.band import Band, get_ms_metadata
+from factor.lib.state import get_state_store
 
 
 log = logging.getLogger('factor')
 
 
 def run(parset_file, logging_level='info', dry_run=False, test_run=False,
-    reset_directions=[], reset_operations=[]):
+    reset_directions=[], reset_operations=[], simulate=False):
     """
     Processes a dataset using facet calibration
 
@@ -53,8 +57,14 @@ def run(parset_file, logging_level='info', dry_run=False, test_run=False,
         List of names of directions to be reset
     reset_operations : list of str, optional
         Llist of operations to be reset
+    simulate : bool, optional
+        If True, do not run pipelines (as with dry_run) but predict the wall
+        time, memory and disk use of the operations that are not yet done
 
     """
+    if simulate:
+        dry_run = True
+
     # Read parset
     parset = factor.parset.parset_read(parset_file)
 
@@ -67,6 +77,9 @@ def run(parset_file, logging_level='info', dry_run=False, test_run=False,
 
     # Prepare vis data
     bands = _set_up_bands(parset, test_run)
+    if simulate:
+        scheduler.simulator = CostSimulator(parset, scheduler.max_procs,
+            history=scheduler.history)
 
     # Set up directions and groups
     directions, direction_groups = _set_up_directions(parset, bands, dry_run,
@@ -88,22 +101,8 @@ def run(parset_file, logging_level='info', dry_run=False, test_run=False,
                 break
 
         # Reset if needed
-        direction_group_reset = [d for d in peel_directions if d.do_reset]
-        direction_group_reset_facetsub = [d for d in direction_group_reset if
-            'facetsub' in d.reset_operations]
-        if len(direction_group_reset_facetsub) > 0:
-            for d in direction_group_reset_facetsub:
-                if ('facetsubreset' in d.completed_operations or
-                    'facetsubreset' in reset_operations):
-                    # Reset a previous reset, but only if it completed successfully
-                    # or is explicitly specified for reset (to allow one to resume
-                    # facetsubreset instead of always resetting and restarting it)
-                    d.reset_state('facetsubreset')
-            ops = [FacetSubReset(parset, bands, d) for d in direction_group_reset_facetsub]
-            for op in ops:
-                scheduler.run(op)
-        for d in direction_group_reset:
-            d.reset_state(['outlierpeel', 'facetpeel', 'facetsub'])
+        _reset_direction_group(parset, bands, peel_directions, scheduler,
+            ['outlierpeel', 'facetpeel', 'facetsub'], reset_operations)
 
         # Do the peeling
         for d in peel_directions:
@@ -142,30 +141,26 @@ def run(parset_file, logging_level='info', dry_run=False, test_run=False,
                 log.info('Exiting...')
                 sys.exit(1)
 
+    if parset['cluster_specific']['dependency_scheduling']:
+        # Run the remaining operations as a dependency graph instead of group
+        # by group
+        _run_operation_graph(parset, bands, directions, direction_groups,
+            scheduler, dry_run, reset_directions, reset_operations,
+            set_sub_data_colname, set_preapply_flag)
+        if simulate:
+            scheduler.simulator.report(bands)
+        scheduler.close()
+        log.info("Factor has finished :)")
+        return
+
     # Run selfcal and subtract operations on direction groups
     for gindx, direction_group in enumerate(direction_groups):
         log.info('Self calibrating {0} direction(s) in Group {1}'.format(
             len(direction_group), gindx+1))
 
-        # Set up reset of any directions that need it. If the direction has
-        # already been through the facetsub operation, we must undo the
-        # changes with the facetsubreset operation
-        direction_group_reset = [d for d in direction_group if d.do_reset]
-        direction_group_reset_facetsub = [d for d in direction_group_reset if
-            'facetsub' in d.reset_operations]
-        if len(direction_group_reset_facetsub) > 0:
-            for d in direction_group_reset_facetsub:
-                if ('facetsubreset' in d.completed_operations or
-                    'facetsubreset' in reset_operations):
-                    # Reset a previous reset, but only if it completed successfully
-                    # or is explicitly specified for reset (to allow one to resume
-                    # facetsubreset instead of always resetting and restarting it)
-                    d.reset_state('facetsubreset')
-            ops = [FacetSubReset(parset, bands, d) for d in direction_group_reset_facetsub]
-            for op in ops:
-                scheduler.run(op)
-        for d in direction_group_reset:
-            d.reset_state(['facetselfcal', 'facetsub'])
+        # Set up reset of any directions that need it
+        _reset_direction_group(parset, bands, direction_group, scheduler,
+            ['facetselfcal', 'facetsub'], reset_operations)
 
         # Set flag for first direction to create preapply parmdb
         if set_preapply_flag:
@@ -224,27 +219,9 @@ def run(parset_file, logging_level='info', dry_run=False, test_run=False,
     min_uvs = parset['imaging_specific']['facet_min_uv_lambda']
     selfcal_robust = parset['imaging_specific']['selfcal_robust']
     nimages = len(cellsizes)
-    dirs_with_selfcal = [d for d in directions if d.selfcal_ok]
-    if parset['imaging_specific']['image_target_only']:
-        dirs_with_selfcal_to_image = [d for d in dirs_with_selfcal if not d.is_patch
-            and not d.is_outlier and d.contains_target]
-        dirs_without_selfcal_to_image = [d for d in directions if not d.selfcal_ok and not
-            d.is_patch and not d.is_outlier and d.contains_target]
-    else:
-        dirs_with_selfcal_to_image = [d for d in dirs_with_selfcal if not d.is_patch
-            and not d.is_outlier]
-        dirs_without_selfcal_to_image = [d for d in directions if not d.selfcal_ok and not
-            d.is_patch and not d.is_outlier]
-    if len(dirs_without_selfcal_to_image) > 0:
-        log.info('Imaging the following direction(s) with nearest self calibration solutions:')
-        log.info('{0}'.format([d.name for d in dirs_without_selfcal_to_image]))
-    for d in dirs_without_selfcal_to_image:
-        # Search for nearest direction with successful selfcal
-        nearest, sep = factor.directions.find_nearest(d, dirs_with_selfcal)
-        log.debug('Using solutions from direction {0} for direction {1} '
-            '(separation = {2} deg).'.format(nearest.name, d.name, sep))
-        d.converted_parmdb_mapfile = nearest.converted_parmdb_mapfile
-        d.save_state()
+    dirs_with_selfcal_to_image, dirs_without_selfcal_to_image = _get_directions_to_image(
+        parset, directions)
+    _set_nearest_selfcal_solutions(directions, dirs_without_selfcal_to_image)
     if len(dirs_with_selfcal_to_image + dirs_without_selfcal_to_image) > 0:
         for image_indx, (cellsize_arcsec, taper_arcsec, robust, min_uv_lambda) in enumerate(
             zip(cellsizes, tapers, robusts, min_uvs)):
@@ -279,19 +256,8 @@ def run(parset_file, logging_level='info', dry_run=False, test_run=False,
 
         # Mosaic the final facet images together
         if parset['imaging_specific']['make_mosaic']:
-            # Make direction object for the field and load previous state (if any)
-            field = Direction('field', bands[0].ra, bands[0].dec,
-                factor_working_dir=parset['dir_working'])
-            field.load_state()
-            if len(reset_operations) > 0:
-                field.reset_operations = reset_operations
-            else:
-                field.reset_operations = (field.completed_operations[:] +
-                    field.started_operations[:])
-
-            # Set averaging for primary beam generation
-            field.avgpb_freqstep = bands[0].nchan
-            field.avgpb_timestep = int(120.0 / bands[0].timepersample)
+            # Make direction object for the field
+            field = _make_field_direction(parset, bands, reset_operations)
 
             for i, (cellsize_arcsec, taper_arcsec, robust, min_uv_lambda) in enumerate(
                 zip(cellsizes, tapers, robusts, min_uvs)):
@@ -303,24 +269,252 @@ def run(parset_file, logging_level='info', dry_run=False, test_run=False,
                     field.reset_state(opname)
 
                 # Specify appropriate image, mask, and vertices file
-                field.facet_image_filenames = []
-                field.facet_vertices_filenames = []
                 full_res_im, opname = _get_image_type_and_name(cellsize_arcsec, taper_arcsec,
                     robust, selfcal_robust, min_uv_lambda, parset)
-                for d in dirs_to_image:
-                    if not d.is_patch:
-                        facet_image = DataMap.load(d.facet_image_mapfile[opname])[0].file
-                        field.facet_image_filenames.append(facet_image)
-                        field.facet_vertices_filenames.append(d.save_file)
+                _set_mosaic_inputs(field, dirs_to_image, opname)
 
                 # Do mosaicking
                 op = FieldMosaic(parset, bands, field, cellsize_arcsec, robust,
                         taper_arcsec, min_uv_lambda)
                 scheduler.run(op)
 
+    if simulate:
+        scheduler.simulator.report(bands)
+    scheduler.close()
     log.info("Factor has finished :)")
 
 
+def _run_operation_graph(parset, bands, directions, direction_groups, scheduler,
+    dry_run=False, reset_directions=[], reset_operations=[],
+    set_sub_data_colname=True, set_preapply_flag=True):
+    """
+    Runs the selfcal, subtract, imaging, and mosaicking operations as a graph
+
+    Each operation is started as soon as the data it needs are ready:
+
+    - the selfcal of a group needs the subtractions of all previous groups
+    - the subtractions are done one at a time, as they write to the input
+      data. Each one needs the selfcal of all directions in its group, as
+      selfcal reads the input data that the subtraction writes to
+    - the imaging of a direction needs all subtractions (as the subtracted
+      data are imaged) and its own previous imaging runs
+    - each mosaic needs all facet images made with its imaging parameters
+
+    As every subtraction writes the column that the selfcal of later groups
+    and the imaging read, these dependencies do not allow selfcal to overlap
+    with subtraction, nor imaging to start before all groups are done. The
+    gain over the group-by-group mode comes only from the imaging and
+    mosaicking: the imaging runs of different directions and imaging
+    parameters are not batched, and each mosaic starts as soon as its facet
+    images are done
+
+    Parameters
+    ----------
+    parset : dict
+        Parset containing processing parameters
+    bands : list of Band instances
+        Vis data
+    directions : list of Direction instances
+        All directions
+    direction_groups : list of lists of Direction instances
+        Groups of directions to be selfcal-ed
+    scheduler : Scheduler instance
+        The operation scheduler
+    dry_run : bool, optional
+        If True, do not run pipelines. All parsets, etc. are made as normal
+    reset_directions : list of str, optional
+        List of names of directions to be reset
+    reset_operations : list of str, optional
+        Llist of operations to be reset
+    set_sub_data_colname : bool, optional
+        If True, no subtraction has been done yet
+    set_preapply_flag : bool, optional
+        If True, the flag for preapplication of selfcal solutions still has to
+        be set
+
+    """
+    # Flags that are updated as the operations are run
+    flags = {'set_sub_data_colname': set_sub_data_colname,
+             'set_preapply_flag': set_preapply_flag}
+
+    # Do any resets first, as they modify the input data
+    for direction_group in direction_groups:
+        _reset_direction_group(parset, bands, direction_group, scheduler,
+            ['facetselfcal', 'facetsub'], reset_operations)
+
+    def make_selfcal(d, gindx, direction_group):
+        def make_operation():
+            if d is direction_group[0]:
+                log.info('Self calibrating {0} direction(s) in Group {1}'.format(
+                    len(direction_group), gindx+1))
+                if flags['set_preapply_flag']:
+                    # Set flag for first direction to create preapply parmdb
+                    d.create_preapply_parmdb = True
+            return FacetSelfcal(parset, bands, d)
+        return make_operation
+
+    def make_group_selfcal_done(direction_group):
+        def make_operation():
+            if dry_run:
+                # For dryrun, skip selfcal verification
+                for d in direction_group:
+                    d.selfcal_ok = True
+            direction_group_ok = [d for d in direction_group if d.selfcal_ok]
+            if flags['set_sub_data_colname']:
+                # Set the name of the subtracted data column for remaining
+                # directions (if needed)
+                if len(direction_group_ok) > 0:
+                    for d in directions:
+                        if d.name != direction_group_ok[0].name:
+                            d.subtracted_data_colname = 'CORRECTED_DATA '
+                    flags['set_sub_data_colname'] = False
+            if (flags['set_preapply_flag'] and
+                parset['calibration_specific']['preapply_first_cal_phases']):
+                # Set the flag for preapplication of selfcal solutions (if needed)
+                if len(direction_group_ok) > 0:
+                    for d in directions:
+                        if d.name != direction_group_ok[0].name:
+                            d.preapply_phase_cal = True
+                            d.preapply_parmdb_mapfile = direction_group_ok[0].preapply_parmdb_mapfile
+                    flags['set_preapply_flag'] = False
+            return None
+        return make_operation
+
+    def make_sub(d):
+        def make_operation():
+            if dry_run:
+                d.selfcal_ok = True
+            if not d.selfcal_ok:
+                return None
+            return FacetSub(parset, bands, d)
+        return make_operation
+
+    def make_group_done(direction_group):
+        def make_operation():
+            # Handle directions in this group for which selfcal failed
+            selfcal_ok = [d.selfcal_ok for d in direction_group]
+            for d in direction_group:
+                if not d.selfcal_ok:
+                    log.warn('Self calibration failed for direction {0}.'.format(d.name))
+            if not all(selfcal_ok) and parset['calibration_specific']['exit_on_selfcal_failure']:
+                log.info('Exiting...')
+                sys.exit(1)
+            return None
+        return make_operation
+
+    # Selfcal and subtract nodes
+    nodes = []
+    last_node = None
+    for gindx, direction_group in enumerate(direction_groups):
+        selfcal_done_name = 'group{0}_selfcal'.format(gindx+1)
+        if last_node is None:
+            group_deps = []
+        else:
+            group_deps = [last_node]
+        for d in direction_group:
+            nodes.append(OperationNode('facetselfcal_{0}'.format(d.name),
+                make_selfcal(d, gindx, direction_group), group_deps))
+        nodes.append(OperationNode(selfcal_done_name,
+            make_group_selfcal_done(direction_group), ['facetselfcal_{0}'.format(d.name)
+            for d in direction_group]))
+        sub_names = []
+        for d in direction_group:
+            sub_deps = [selfcal_done_name]
+            if len(sub_names) > 0:
+                sub_deps.append(sub_names[-1])
+            sub_names.append('facetsub_{0}'.format(d.name))
+            nodes.append(OperationNode(sub_names[-1], make_sub(d),
+                sub_deps))
+        last_node = 'group{0}_done'.format(gindx+1)
+        nodes.append(OperationNode(last_node, make_group_done(direction_group),
+            [selfcal_done_name] + sub_names))
+
+    def make_selfcal_done():
+        # Check that at least one direction went through selfcal successfully.
+        # If not, exit. Otherwise, give the directions without selfcal the
+        # solutions of the nearest direction with selfcal
+        if len([d for d in directions if d.selfcal_ok]) == 0:
+            log.error('Self calibration failed for all directions. Exiting...')
+            sys.exit(1)
+        dirs_with_selfcal_to_image, dirs_without_selfcal_to_image = _get_directions_to_image(
+            parset, directions)
+        _set_nearest_selfcal_solutions(directions, dirs_without_selfcal_to_image)
+        return None
+
+    if last_node is None:
+        nodes.append(OperationNode('selfcal_done', make_selfcal_done))
+    else:
+        nodes.append(OperationNode('selfcal_done', make_selfcal_done, [last_node]))
+
+    # Imaging and mosaicking nodes
+    cellsizes = parset['imaging_specific']['facet_cellsize_arcsec']
+    tapers = parset['imaging_specific']['facet_taper_arcsec']
+    robusts = parset['imaging_specific']['facet_robust']
+    min_uvs = parset['imaging_specific']['facet_min_uv_lambda']
+    selfcal_robust = parset['imaging_specific']['selfcal_robust']
+    dirs_with_selfcal_to_image, dirs_without_selfcal_to_image = _get_directions_to_image(
+        parset, directions)
+    dirs_to_image = dirs_without_selfcal_to_image + dirs_with_selfcal_to_image
+
+    def make_image(d, cellsize_arcsec, taper_arcsec, robust, min_uv_lambda, opname):
+        def make_operation():
+            log.info('Imaging direction {0} with cellsize = {1} arcsec, robust = '
+                '{2}, taper = {3} arcsec, min_uv = {4} lambda'.format(d.name,
+                cellsize_arcsec, robust, taper_arcsec, min_uv_lambda))
+            if d.do_reset:
+                d.reset_state(opname)
+            return FacetImage(parset, bands, d, cellsize_arcsec, robust,
+                taper_arcsec, min_uv_lambda)
+        return make_operation
+
+    def make_mosaic(field, cellsize_arcsec, taper_arcsec, robust, min_uv_lambda):
+        def make_operation():
+            # Reset the field direction if specified
+            full_res_im, opname = _get_image_type_and_name(cellsize_arcsec, taper_arcsec,
+                robust, selfcal_robust, min_uv_lambda, parset, opbase='fieldmosaic')
+            if 'field' in reset_directions:
+                field.reset_state(opname)
+
+            # Specify appropriate image, mask, and vertices file
+            full_res_im, opname = _get_image_type_and_name(cellsize_arcsec, taper_arcsec,
+                robust, selfcal_robust, min_uv_lambda, parset)
+            _set_mosaic_inputs(field, dirs_to_image, opname)
+
+            return FieldMosaic(parset, bands, field, cellsize_arcsec, robust,
+                taper_arcsec, min_uv_lambda)
+        return make_operation
+
+    if len(dirs_to_image) > 0:
+        if parset['imaging_specific']['make_mosaic']:
+            field = _make_field_direction(parset, bands, reset_operations)
+        last_image_names = dict([(d.name, 'selfcal_done') for d in dirs_to_image])
+        last_mosaic_name = None
+        for cellsize_arcsec, taper_arcsec, robust, min_uv_lambda in zip(
+            cellsizes, tapers, robusts, min_uvs):
+            full_res_im, opname = _get_image_type_and_name(cellsize_arcsec, taper_arcsec,
+                robust, selfcal_robust, min_uv_lambda, parset)
+            image_names = []
+            for d in dirs_to_image:
+                image_names.append('{0}_{1}'.format(opname, d.name))
+                nodes.append(OperationNode(image_names[-1], make_image(d,
+                    cellsize_arcsec, taper_arcsec, robust, min_uv_lambda, opname),
+                    [last_image_names[d.name]]))
+                last_image_names[d.name] = image_names[-1]
+
+            if parset['imaging_specific']['make_mosaic']:
+                full_res_im, mosaic_opname = _get_image_type_and_name(cellsize_arcsec,
+                    taper_arcsec, robust, selfcal_robust, min_uv_lambda, parset,
+                    opbase='fieldmosaic')
+                mosaic_deps = image_names[:]
+                if last_mosaic_name is not None:
+                    mosaic_deps.append(last_mosaic_name)
+                last_mosaic_name = mosaic_opname
+                nodes.append(OperationNode(mosaic_opname, make_mosaic(field,
+                    cellsize_arcsec, taper_arcsec, robust, min_uv_lambda), mosaic_deps))
+
+    scheduler.run_graph(nodes)
+
+
 def _set_up_compute_parameters(parset, dry_run=False):
     """
     Sets up compute parameters and operation scheduler
@@ -370,6 +564,10 @@ def _set_up_compute_parameters(parset, dry_run=False):
         parset['cluster_specific']['node_list'] = factor.cluster.get_compute_nodes(
             parset['cluster_specific']['clusterdesc'])
 
+    # Probe the nodes to set the resources to use on each one
+    if parset['cluster_specific']['probe_nodes']:
+        factor.cluster.set_node_resources(parset)
+
     # check ulimit(s)
     try:
         import resource
@@ -402,11 +600,53 @@ def _set_up_compute_parameters(parset, dry_run=False):
             'largest group ({1}). For best performance, these values should be '
             'equal'.format(ndir_simul, ngroup_max))
     scheduler = Scheduler(parset['genericpipeline_executable'], max_procs=ndir_simul,
-        dry_run=dry_run)
+        dry_run=dry_run, history=RuntimeHistory(parset['dir_working']))
 
     return scheduler
 
 
+class NoDaemonProcess(multiprocessing.Process):
+    """
+    Process that is never daemonic, so that it can start its own processes
+    """
+    def _get_daemon(self):
+        return False
+
+    def _set_daemon(self, value):
+        pass
+
+    daemon = property(_get_daemon, _set_daemon)
+
+
+class NoDaemonPool(multiprocessing.pool.Pool):
+    """
+    Pool of non-daemonic processes, so that the tasks can use a pool themselves
+    """
+    Process = NoDaemonProcess
+
+
+def _set_up_band(args):
+    """
+    Sets up a band in a worker process
+
+    Parameters
+    ----------
+    args : tuple
+        Tuple of the positional and keyword arguments of Band
+
+    Returns
+    -------
+    success : bool
+        True if the band was set up, False if the setup exited on an error
+
+    """
+    try:
+        Band(*args[0], **args[1])
+    except SystemExit:
+        return False
+    return True
+
+
 def _set_up_bands(parset, test_run=False):
     """
     Sets up bands for processing
@@ -430,14 +670,46 @@ def _set_up_bands(parset, test_run=False):
     msdict = {}
     for ms in parset['mss']:
         # group all found MSs by frequency
-        sw = pt.table(ms+'::SPECTRAL_WINDOW', ack=False)
-        msfreq = int(sw.col('REF_FREQUENCY')[0])
-        sw.close()
+        msfreq = int(get_ms_metadata(ms, parset['dir_working'])['freq'])
         if msfreq in msdict:
             msdict[msfreq].append(ms)
         else:
             msdict[msfreq] = [ms]
-    bands = []
+
+    # Set the chunk size from the nodes if needed. The memory needed to process
+    # a chunk is taken to be ~ 32 bytes per visibility (4 correlations), enough
+    # for steps that hold a chunk in memory (e.g., pre-averaging). The size is
+    # saved in the state store and reused on a restart, so that the existing
+    # chunks stay valid if the nodes have changed
+    chunk_size_sec = parset['chunk_size_sec']
+    store = get_state_store(parset['dir_working'])
+    if chunk_size_sec is None:
+        saved_state = store.load('global', 'chunk_size_sec')
+        if saved_state is not None:
+            chunk_size_sec = saved_state['chunk_size_sec']
+            log.info('Using time chunks of {0:.0f} s from the previous '
+                'run'.format(chunk_size_sec))
+    if chunk_size_sec is None:
+        obs_length_sec = 0.0
+        data_rate_mbps = 0.0
+        for ms in parset['mss']:
+            metadata = get_ms_metadata(ms, parset['dir_working'])
+            obs_length_sec = max(obs_length_sec, metadata['endtime'] -
+                metadata['starttime'] + metadata['exposure'])
+            data_rate_mbps = max(data_rate_mbps, float(metadata['nrows']) /
+                metadata['ntimes'] / metadata['exposure'] * metadata['nchan'] *
+                4 * 32 / 1024.0**2)
+        chunk_size_sec = factor.cluster.get_chunk_size(parset, obs_length_sec,
+            data_rate_mbps)
+        store.save('global', 'chunk_size_sec', {'chunk_size_sec': chunk_size_sec})
+
+    # The bands are checked and chunked in parallel on the local node, and the
+    # I/O-intensive chunking is divided over them
+    local_resources = factor.cluster.get_local_resources(parset)
+    nprocs = min(len(msdict), multiprocessing.cpu_count(),
+        local_resources['ncpu'])
+    nthread_io = max(1, local_resources['nthread_io'] / max(1, nprocs))
+    band_args = []
     for MSkey in msdict.keys():
         # Check for any sky models specified by user
         # there only needs to be a skymodel specyfied for one file in each band
@@ -452,10 +724,27 @@ def _set_up_bands(parset, test_run=False):
                             'not found. Exiting...'.format(msbase))
                         sys.exit(1)
                     break
-        band = Band(msdict[MSkey], parset['dir_working'], parset['parmdb_name'],
-            skymodel_dirindep, local_dir=parset['cluster_specific']['dir_local'],
-            test_run=test_run, chunk_size_sec=parset['chunk_size_sec'],
-            use_compression=parset['use_compression'])
+        band_args.append(([msdict[MSkey], parset['dir_working'],
+            parset['parmdb_name'], skymodel_dirindep], {'local_dir':
+            parset['cluster_specific']['dir_local'], 'test_run': test_run,
+            'chunk_size_sec': chunk_size_sec, 'use_compression':
+            parset['use_compression'], 'use_reference_chunks':
+            parset['use_reference_chunks'], 'nthread_io': nthread_io}))
+
+    # Each band saves its state when done, so the Band objects below are made
+    # from the saved states
+    if nprocs > 1:
+        pool = NoDaemonPool(nprocs)
+        results = pool.map(_set_up_band, band_args)
+        pool.close()
+        pool.join()
+        if not all(results):
+            log.error('Setup of one or more bands failed. Exiting...')
+            sys.exit(1)
+
+    bands = []
+    for args, kwargs in band_args:
+        band = Band(*args, **kwargs)
         if len(band.files) == 0:
             # No useable files found for this band (likely due to too little
             # unflagged data)
@@ -674,6 +963,7 @@ def _set_up_directions(parset, bands, dry_run=False, test_run=False,
         else:
             direction.subtracted_data_colname = 'SUBTRACTED_DATA_ALL'
             direction.use_compression = False
+        direction.use_reference_chunks = parset['use_reference_chunks']
 
         # Set any flagging parameters
         direction.flag_abstime = parset['flag_abstime']
@@ -776,7 +1066,7 @@ def _initialize_directions(parset, initial_skymodel, ref_band, max_radius_deg=No
                     s, dir_parset['flux_min_jy'], dir_parset['size_max_arcmin'],
                     dir_parset['separation_max_arcmin'],
                     directions_max_num=dir_parset['ndir_max'],
-                    interactive=parset['interactive'], ncpu=parset['cluster_specific']['ncpu'],
+                    interactive=parset['interactive'], ncpu=factor.cluster.get_local_resources(parset)['ncpu'],
                     flux_min_for_merging_Jy=dir_parset['flux_min_for_merging_jy'])
             else:
                 dir_parset['directions_file'] = factor.directions.make_directions_file_from_skymodel(
@@ -840,6 +1130,164 @@ def _initialize_directions(parset, initial_skymodel, ref_band, max_radius_deg=No
     return directions
 
 
+def _reset_direction_group(parset, bands, direction_group, scheduler, op_names,
+    reset_operations=[]):
+    """
+    Resets the directions of a group that need it
+
+    If a direction has already been through the facetsub operation, the
+    changes are first undone with the facetsubreset operation
+
+    Parameters
+    ----------
+    parset : dict
+        Parset containing processing parameters
+    bands : list of Band instances
+        Vis data
+    direction_group : list of Direction instances
+        Directions to check for resetting
+    scheduler : Scheduler instance
+        The operation scheduler
+    op_names : list of str
+        Names of the operations to reset
+    reset_operations : list of str, optional
+        List of operations to be reset
+
+    """
+    direction_group_reset = [d for d in direction_group if d.do_reset]
+    direction_group_reset_facetsub = [d for d in direction_group_reset if
+        'facetsub' in d.reset_operations]
+    if len(direction_group_reset_facetsub) > 0:
+        for d in direction_group_reset_facetsub:
+            if ('facetsubreset' in d.completed_operations or
+                'facetsubreset' in reset_operations):
+                # Reset a previous reset, but only if it completed successfully
+                # or is explicitly specified for reset (to allow one to resume
+                # facetsubreset instead of always resetting and restarting it)
+                d.reset_state('facetsubreset')
+        ops = [FacetSubReset(parset, bands, d) for d in direction_group_reset_facetsub]
+        for op in ops:
+            scheduler.run(op)
+    for d in direction_group_reset:
+        d.reset_state(op_names)
+
+
+def _get_directions_to_image(parset, directions):
+    """
+    Returns the directions to image
+
+    Parameters
+    ----------
+    parset : dict
+        Parset containing processing parameters
+    directions : list of Direction instances
+        All directions
+
+    Returns
+    -------
+    dirs_with_selfcal_to_image, dirs_without_selfcal_to_image : lists
+        Directions to image with and without successful selfcal
+
+    """
+    dirs_with_selfcal = [d for d in directions if d.selfcal_ok]
+    if parset['imaging_specific']['image_target_only']:
+        dirs_with_selfcal_to_image = [d for d in dirs_with_selfcal if not d.is_patch
+            and not d.is_outlier and d.contains_target]
+        dirs_without_selfcal_to_image = [d for d in directions if not d.selfcal_ok and not
+            d.is_patch and not d.is_outlier and d.contains_target]
+    else:
+        dirs_with_selfcal_to_image = [d for d in dirs_with_selfcal if not d.is_patch
+            and not d.is_outlier]
+        dirs_without_selfcal_to_image = [d for d in directions if not d.selfcal_ok and not
+            d.is_patch and not d.is_outlier]
+
+    return dirs_with_selfcal_to_image, dirs_without_selfcal_to_image
+
+
+def _set_nearest_selfcal_solutions(directions, dirs_without_selfcal_to_image):
+    """
+    Gives directions without selfcal the solutions of the nearest direction
+    with successful selfcal
+
+    Parameters
+    ----------
+    directions : list of Direction instances
+        All directions
+    dirs_without_selfcal_to_image : list of Direction instances
+        Directions without selfcal that are to be imaged
+
+    """
+    dirs_with_selfcal = [d for d in directions if d.selfcal_ok]
+    if len(dirs_without_selfcal_to_image) > 0:
+        log.info('Imaging the following direction(s) with nearest self calibration solutions:')
+        log.info('{0}'.format([d.name for d in dirs_without_selfcal_to_image]))
+    for d in dirs_without_selfcal_to_image:
+        # Search for nearest direction with successful selfcal
+        nearest, sep = factor.directions.find_nearest(d, dirs_with_selfcal)
+        log.debug('Using solutions from direction {0} for direction {1} '
+            '(separation = {2} deg).'.format(nearest.name, d.name, sep))
+        d.converted_parmdb_mapfile = nearest.converted_parmdb_mapfile
+        d.save_state()
+
+
+def _make_field_direction(parset, bands, reset_operations=[]):
+    """
+    Makes the direction object used for mosaicking the field
+
+    Parameters
+    ----------
+    parset : dict
+        Parset containing processing parameters
+    bands : list of Band instances
+        Vis data
+    reset_operations : list of str, optional
+        List of operations to be reset
+
+    Returns
+    -------
+    field : Direction instance
+        Direction object for the field, with any previous state loaded
+
+    """
+    field = Direction('field', bands[0].ra, bands[0].dec,
+        factor_working_dir=parset['dir_working'])
+    field.load_state()
+    if len(reset_operations) > 0:
+        field.reset_operations = reset_operations
+    else:
+        field.reset_operations = (field.completed_operations[:] +
+            field.started_operations[:])
+
+    # Set averaging for primary beam generation
+    field.avgpb_freqstep = bands[0].nchan
+    field.avgpb_timestep = int(120.0 / bands[0].timepersample)
+
+    return field
+
+
+def _set_mosaic_inputs(field, dirs_to_image, opname):
+    """
+    Sets the facet images and vertices files to mosaic
+
+    Parameters
+    ----------
+    field : Direction instance
+        Direction object for the field
+    dirs_to_image : list of Direction instances
+        Directions that were imaged
+    opname : str
+        Name of the FacetImage operation that made the images
+
+    """
+    field.facet_image_filenames = []
+    field.facet_vertices_filenames = []
+    for d in dirs_to_image:
+        if not d.is_patch:
+            facet_image = DataMap.load(d.facet_image_mapfile[opname])[0].file
+            field.facet_image_filenames.append(facet_image)
+            field.facet_vertices_filenames.append(d.vertices_file)
+
+
 def _get_image_type_and_name(cellsize_arcsec, taper_arcsec, robust, selfcal_robust,
     min_uv_lambda, parset, opbase='facetimage'):
     """
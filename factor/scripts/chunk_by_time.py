@@ -1,6 +1,11 @@
 #! /usr/bin/env python
 """
 Script to split a dataset into chunks of equal time
+
+The chunks can be made as reference tables (-r), and a reference chunk can be
+replaced by a real copy (-c). Factor chunks the bands itself (see
+factor.lib.band), but uses make_copy() to copy its reference chunks before they
+are written to (see make_chunk_copy.py)
 """
 import argparse
 from argparse import RawTextHelpFormatter
@@ -11,7 +16,7 @@ import os
 import shutil
 
 
-def main(dataset, blockl, local_dir=None, clobber=True):
+def main(dataset, blockl, local_dir=None, clobber=True, use_reference=False):
     """
     Split dataset into time chunks
 
@@ -26,6 +31,11 @@ def main(dataset, blockl, local_dir=None, clobber=True):
         copied to the original output directory
     clobber : bool, optional
         If True, existing files are overwritten
+    use_reference : bool, optional
+        If True, the chunks are made as reference tables (row selections of
+        the dataset) instead of copies, and local_dir is not used. Steps that
+        only read the chunks can use them directly. A chunk that is to be
+        written to must first be made into a copy with make_copy()
 
     """
     if type(clobber) is str:
@@ -33,6 +43,13 @@ def main(dataset, blockl, local_dir=None, clobber=True):
             clobber = True
         else:
             clobber = False
+    if type(use_reference) is str:
+        if use_reference.lower() == 'true':
+            use_reference = True
+        else:
+            use_reference = False
+    if use_reference:
+        local_dir = None
 
     blockl = int(blockl)
     if blockl < 1:
@@ -73,7 +90,8 @@ def main(dataset, blockl, local_dir=None, clobber=True):
             t0 = -0.1 # make sure first chunk gets first slot
         if c == nchunks-1 and t1 < tobs:
             t1 = tobs + 0.1 # make sure last chunk gets all that remains
-        split_ms(dataset, chunk_file, t0, t1, local_dir, clobber=clobber)
+        split_ms(dataset, chunk_file, t0, t1, local_dir, clobber=clobber,
+            use_reference=use_reference)
 
     if local_dir is not None and not os.path.samefile(dataset, dataset_original):
         shutil.rmtree(dataset)
@@ -81,7 +99,8 @@ def main(dataset, blockl, local_dir=None, clobber=True):
     return {'files': '[{0}]'.format(','.join(files))}
 
 
-def split_ms(msin, msout, start_out, end_out, local_dir, clobber=True):
+def split_ms(msin, msout, start_out, end_out, local_dir, clobber=True,
+    use_reference=False):
     """
     Splits an MS between start and end times in hours relative to first time
 
@@ -100,6 +119,9 @@ def split_ms(msin, msout, start_out, end_out, local_dir, clobber=True):
         copied to the original output directory
     clobber : bool, optional
         If True, existing files are overwritten
+    use_reference : bool, optional
+        If True, the output MS is made as a reference table that refers to the
+        selected rows of the input MS instead of as a copy of them
 
     """
     if os.path.exists(msout):
@@ -117,8 +139,16 @@ def split_ms(msin, msout, start_out, end_out, local_dir, clobber=True):
     t = pt.table(msin, ack=False)
     starttime = t[0]['TIME']
 
-    t1 = t.query('TIME >= ' + str(starttime+start_out*3600.0) + ' && '
-      'TIME < ' + str(starttime+end_out*3600.0), sortlist='TIME,ANTENNA1,ANTENNA2')
+    query = ('TIME >= ' + str(starttime+start_out*3600.0) + ' && '
+      'TIME < ' + str(starttime+end_out*3600.0))
+    if use_reference:
+        # Store the selection itself as the output MS
+        t1 = t.query(query, sortlist='TIME,ANTENNA1,ANTENNA2', name=msout)
+        t1.close()
+        t.close()
+        return
+
+    t1 = t.query(query, sortlist='TIME,ANTENNA1,ANTENNA2')
 
     t1.copy(msout, True)
     t1.close()
@@ -131,12 +161,69 @@ def split_ms(msin, msout, start_out, end_out, local_dir, clobber=True):
             shutil.rmtree(msout)
 
 
+def is_reference_table(msin):
+    """
+    Returns True if an MS is a reference table
+
+    Parameters
+    ----------
+    msin : str
+        Name of MS file
+
+    """
+    t = pt.table(msin, ack=False)
+    partnames = [os.path.realpath(name) for name in t.partnames()]
+    t.close()
+
+    return partnames != [os.path.realpath(msin)]
+
+
+def make_copy(msin):
+    """
+    Replaces an MS made as a reference table with a copy of it
+
+    This copy must be made before a chunk made as a reference table is written
+    to, as otherwise the rows of the original dataset would be changed. An MS
+    that is not a reference table is left as it is. Files in the MS directory
+    that are not part of the table (e.g., the direction-independent parmdb of
+    a chunk) are moved to the copy
+
+    Parameters
+    ----------
+    msin : str
+        Name of MS file
+
+    """
+    msin = msin.rstrip('/')
+    if not is_reference_table(msin):
+        return
+
+    msout = msin + '_copy'
+    if os.path.exists(msout):
+        shutil.rmtree(msout)
+    t = pt.table(msin, ack=False)
+    t.copy(msout, True)
+    t.close()
+    for name in os.listdir(msin):
+        if not os.path.exists(os.path.join(msout, name)):
+            shutil.move(os.path.join(msin, name), os.path.join(msout, name))
+    shutil.rmtree(msin)
+    os.rename(msout, msin)
+
+
 if __name__ == '__main__':
     descriptiontext = "Chunk a dataset in time.\n"
 
     parser = argparse.ArgumentParser(description=descriptiontext, formatter_class=RawTextHelpFormatter)
     parser.add_argument('ms_filename', help='Dataset name')
     parser.add_argument('-w', '--width', help='width of chunks in number of samples', type=int, default=10)
+    parser.add_argument('-r', '--reference', help='make chunks as reference tables instead of copies',
+        action='store_true', default=False)
+    parser.add_argument('-c', '--copy', help='replace the given chunk (made as a reference table) with a copy\n'
+        'instead of chunking it', action='store_true', default=False)
 
     args = parser.parse_args()
-    main(args.ms_filename, blockl=args.width)
+    if args.copy:
+        make_copy(args.ms_filename)
+    else:
+        main(args.ms_filename, blockl=args.width, use_reference=args.reference)
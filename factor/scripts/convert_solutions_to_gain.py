@@ -8,6 +8,7 @@ import lofar.parmdb as lp
 import numpy as np
 import sys
 import os
+from factor.lib.solutions import convert_realimag_to_phasors
 
 
 def main(fast_parmdb, slow_parmdb, output_file, preapply_parmdb=None):
@@ -75,6 +76,7 @@ def main(fast_parmdb, slow_parmdb, output_file, preapply_parmdb=None):
         fast_timewidths, asStartEnd=False)
     slow_soldict = slow_pdb.getValues('*', slow_freqs, slow_freqwidths, fast_times,
         fast_timewidths, asStartEnd=False)
+    slow_phasors = convert_realimag_to_phasors(slow_soldict)
 
     # Identify any gaps in time (frequency gaps are not allowed), as we need to handle
     # each section separately if gaps are present
@@ -92,10 +94,8 @@ def main(fast_parmdb, slow_parmdb, output_file, preapply_parmdb=None):
         tec_phase =  -8.44797245e9 * tec / slow_freqs
 
         for pol in pol_list:
-            slow_real = np.copy(slow_soldict['Gain:'+pol+':Real:{s}'.format(s=station)]['values'])
-            slow_imag = np.copy(slow_soldict['Gain:'+pol+':Imag:{s}'.format(s=station)]['values'])
-            slow_amp = np.sqrt((slow_real**2) + (slow_imag**2))
-            slow_phase = np.arctan2(slow_imag, slow_real)
+            slow_amp = slow_phasors['Gain:'+pol+':Ampl:{s}'.format(s=station)]['values']
+            slow_phase = slow_phasors['Gain:'+pol+':Phase:{s}'.format(s=station)]['values']
 
             if preapply_parmdb is not None:
                 fast_phase_preapply = np.copy(preapply_soldict['Gain:'+pol+':Phase:{s}'.format(s=station)]['values'])
@@ -0,0 +1,30 @@
+#! /usr/bin/env python
+"""
+Script to replace a chunk made as a reference table with a copy of it
+"""
+import argparse
+from argparse import RawTextHelpFormatter
+from factor.scripts.chunk_by_time import make_copy
+
+
+def main(ms):
+    """
+    Copy the chunk if it is a reference table
+
+    Parameters
+    ----------
+    ms : str
+        Name of input MS file
+
+    """
+    make_copy(ms)
+
+
+if __name__ == '__main__':
+    descriptiontext = "Replace a reference-table chunk with a copy.\n"
+
+    parser = argparse.ArgumentParser(description=descriptiontext, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('ms', help='name of MS file')
+    args = parser.parse_args()
+
+    main(args.ms)
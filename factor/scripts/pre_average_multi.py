@@ -10,14 +10,32 @@ import sys
 import os
 import itertools
 import pickle
+import multiprocessing
 from scipy.ndimage.filters import gaussian_filter1d as gfilter
 import casacore.tables as pt
 import lofar.parmdb
-from astropy.stats import median_absolute_deviation
+from factor.cluster import get_node_hardware
+
+
+# Memory in bytes per visibility used by the data, weights and flags of the
+# rows of a batch of baselines in BLavg_multi(), and by the arrays used to
+# smooth the data of a single baseline
+BATCH_BYTES_PER_ELEMENT = 16
+SMOOTH_BYTES_PER_ELEMENT = 64
+
+# Minimum radius in samples of the Gaussian kernels that are applied by FFT
+# convolution instead of directly
+FFT_MIN_RADIUS = 32
+
+# Shared-memory arrays with the data, weights and flags of the batch being
+# averaged by BLavg_multi(). They are set before the worker processes are
+# started, so that the workers inherit them
+_shared = {}
 
 
 def main(ms_input, parmdb_input, input_colname, output_data_colname, output_weights_colname,
-    target_rms_rad, minutes_per_block=10.0, baseline_file=None, verbose=True):
+    target_rms_rad, minutes_per_block=10.0, baseline_file=None, verbose=True,
+    max_percent_memory=None, ncpu=None):
     """
     Pre-average data using a sliding Gaussian kernel on the weights
 
@@ -36,6 +54,13 @@ def main(ms_input, parmdb_input, input_colname, output_data_colname, output_weig
         Name of the column in the MS into which the averaged data weights are written
     target_rms_rad : float (str)
         The target RMS for the phase noise in the input parmDBs. (Or whatever???)
+    max_percent_memory : float (str), optional
+        Maximum percentage of the memory of the node to use for the data
+        being averaged. If None, all data of a group of MSs are averaged at
+        once
+    ncpu : int (str), optional
+        Number of processes to use to average the baselines. If None, all
+        CPUs of the node are used
     """
 
     # convert input to needed types
@@ -47,6 +72,14 @@ def main(ms_input, parmdb_input, input_colname, output_data_colname, output_weig
 
     if type(target_rms_rad) is str:
         target_rms_rad = float(target_rms_rad)
+    max_memory_mb = None
+    if max_percent_memory is not None:
+        memory_mb = get_node_hardware()['memory_mb']
+        if memory_mb is not None:
+            max_memory_mb = float(max_percent_memory) / 100.0 * memory_mb
+    if ncpu is None:
+        ncpu = multiprocessing.cpu_count()
+    ncpu = max(1, int(ncpu))
     if baseline_file is None:
         if verbose:
             print('Calculating baseline lengths...')
@@ -75,20 +108,24 @@ def main(ms_input, parmdb_input, input_colname, output_data_colname, output_weig
         tab.close()
         t_delta = minutes_per_block * 60.0 # seconds
         t1 = 0.0
+        time_ranges = []
         while remaining_time > 0.0:
             if remaining_time < 1.5 * t_delta:
                 # If remaining time is too short, just include it all in this chunk
                 t_delta = remaining_time + 10.0
             remaining_time -= t_delta
-
-            # Find ionfactor for this period
-            ionfactors.append(find_ionfactor(parmdb_list[msind], baseline_dict, t1+start_time,
-                                             t1+start_time+t_delta, target_rms_rad=target_rms_rad))
-            if verbose:
-                print('    ionfactor (for timerange {0}-{1} sec) = {2}'.format(t1,
-                      t1+t_delta, ionfactors[-1]))
+            time_ranges.append((t1+start_time, t1+start_time+t_delta))
             t1 += t_delta
 
+        # Find ionfactors for all periods
+        ms_ionfactors = find_ionfactors(parmdb_list[msind], baseline_dict,
+            time_ranges, target_rms_rad=target_rms_rad)
+        ionfactors.extend(ms_ionfactors)
+        if verbose:
+            for (t1, t2), ionfactor in zip(time_ranges, ms_ionfactors):
+                print('    ionfactor (for timerange {0}-{1} sec) = {2}'.format(
+                      t1-start_time, t2-start_time, ionfactor))
+
     sorted_ms_tuples = sorted(zip(start_times,end_times,range(len(ms_list)),ms_list))
     sorted_ms_dict = { 'msnames' :[ms for starttime,endtime,index,ms in sorted_ms_tuples],
                        'starttimes' : [starttime for starttime,endtime,index,ms in sorted_ms_tuples],
@@ -100,7 +137,8 @@ def main(ms_input, parmdb_input, input_colname, output_data_colname, output_weig
         print('Using ionfactor = {}'.format(ionfactor_min))
         print('Averaging...')
     BLavg_multi(sorted_ms_dict, baseline_dict, input_colname, output_data_colname,
-        output_weights_colname, ionfactor_min)
+        output_weights_colname, ionfactor_min, max_memory_mb=max_memory_mb,
+        ncpu=ncpu)
 
 
 def get_baseline_lengths(ms_list, check_antennas=True):
@@ -128,14 +166,13 @@ def get_baseline_lengths(ms_list, check_antennas=True):
         ant2 = np.concatenate( (ant2,t.getcol('ANTENNA2')) )
         all_uvw = np.concatenate( (all_uvw,t.getcol('UVW')) )
         t.close()
+    order, baseline_slices = get_baseline_index(ant1, ant2)
+    all_uvw = all_uvw[order]
     baseline_dict = {}
     for ant in itertools.product(set(ant1), set(ant2)):
         if ant[0] >= ant[1]:
             continue
-        sel1 = np.where(ant1 == ant[0])[0]
-        sel2 = np.where(ant2 == ant[1])[0]
-        sel = sorted(list(frozenset(sel1).intersection(sel2)))
-        uvw = all_uvw[sel, :]
+        uvw = all_uvw[baseline_slices.get(ant, slice(0, 0)), :]
         uvw_dist = np.sqrt(uvw[:, 0]**2 + uvw[:, 1]**2 + uvw[:, 2]**2)
         baseline_dict['{0}'.format(ant[0])] = antnames[ant[0]]
         baseline_dict['{0}'.format(ant[1])] = antnames[ant[1]]
@@ -143,9 +180,72 @@ def get_baseline_lengths(ms_list, check_antennas=True):
     return baseline_dict
 
 
-def find_ionfactor(parmdb_file, baseline_dict, t1, t2, target_rms_rad=0.2):
+def get_baseline_index(ant1, ant2, times=None):
     """
-    Finds ionospheric scaling factor
+    Returns an index that groups the rows of an MS by baseline
+
+    Parameters
+    ----------
+    ant1 : array
+        ANTENNA1 column
+    ant2 : array
+        ANTENNA2 column
+    times : array, optional
+        TIME (or TIME_CENTROID) column. If given, the rows of each baseline are
+        sorted by time, else they are kept in their original order
+
+    Returns
+    -------
+    order : array
+        Row indices that sort the rows by ANTENNA1, ANTENNA2 (and time). The
+        rows of a baseline are contiguous in arrays sorted with this index
+    baseline_slices : dict
+        Slice of the sorted rows for each (ANTENNA1, ANTENNA2) pair
+
+    """
+    if times is None:
+        order = np.lexsort((ant2, ant1))
+    else:
+        order = np.lexsort((times, ant2, ant1))
+    sorted_ant1 = ant1[order]
+    sorted_ant2 = ant2[order]
+    starts = np.concatenate(([0], np.where((np.diff(sorted_ant1) != 0) |
+        (np.diff(sorted_ant2) != 0))[0] + 1))
+    ends = np.concatenate((starts[1:], [len(order)]))
+    baseline_slices = {}
+    for start, end in zip(starts, ends):
+        if end > start:
+            baseline_slices[(sorted_ant1[start], sorted_ant2[start])] = slice(start, end)
+
+    return order, baseline_slices
+
+
+def find_ionfactors(parmdb_file, baseline_dict, time_ranges, target_rms_rad=0.2):
+    """
+    Finds ionospheric scaling factors
+
+    The parmdb is read once for all time ranges. In each time range, the
+    correlation time of each long baseline is taken as the first lag at which
+    the phase structure function exceeds target_rms_rad (see
+    find_correlation_lags())
+
+    Parameters
+    ----------
+    parmdb_file : str
+        Filename of the direction-independent parmdb
+    baseline_dict : dict
+        Baseline lengths in km and station names (as returned by
+        get_baseline_lengths())
+    time_ranges : list of (float, float) tuples
+        Start and end times in s of the time ranges
+    target_rms_rad : float, optional
+        Target rms of the phase differences in rad
+
+    Returns
+    -------
+    ionfactors : list of float
+        Ionfactor for each time range
+
     """
     pdb_in = lofar.parmdb.parmdb(parmdb_file)
     parms = pdb_in.getValuesGrid('*')
@@ -171,58 +271,132 @@ def find_ionfactor(parmdb_file, baseline_dict, t1, t2, target_rms_rad=0.2):
                     ant1.append(s1_name)
                     ant2.append(s2_name)
                     dist.append(v)
+    if len(ant1) == 0:
+        print('No baselines longer than {0} km found in {1}. Exiting...'.format(
+            min_length, parmdb_file))
+        sys.exit(1)
 
-    # Find correlation times
-    rmstimes = []
+    # Unwrap the phase differences of the unflagged solutions of each
+    # baseline in each time range
+    freq = parms['Gain:0:0:Phase:{}'.format(ant1[0])]['freqs'][0]
+    times = parms['Gain:0:0:Phase:{}'.format(ant1[0])]['times']
+    timepersolution = parms['Gain:0:0:Phase:{}'.format(ant1[0])]['timewidths'][0]
+    phases = []
+    range_indices = []
     dists = []
-    freq = None
-    for a1, a2, d in zip(ant1, ant2, dist):
-        if freq is None:
-            freq = np.copy(parms['Gain:0:0:Phase:{}'.format(a1)]['freqs'])[0]
-            times = np.copy(parms['Gain:0:0:Phase:{}'.format(a1)]['times'])
-            time_ind = np.where((times >= t1) & (times < t2))[0]
-            timepersolution = np.copy(parms['Gain:0:0:Phase:{}'.format(a1)]['timewidths'])[0]
-        ph1 = np.copy(parms['Gain:0:0:Phase:{}'.format(a1)]['values'])[time_ind]
-        ph2 = np.copy(parms['Gain:0:0:Phase:{}'.format(a2)]['values'])[time_ind]
-
-        # Filter flagged solutions
-        good = np.where((~np.isnan(ph1)) & (~np.isnan(ph2)))[0]
-        if len(good) == 0:
-            continue
+    for r, (t1, t2) in enumerate(time_ranges):
+        time_ind = np.where((times >= t1) & (times < t2))[0]
+        for a1, a2, d in zip(ant1, ant2, dist):
+            ph1 = parms['Gain:0:0:Phase:{}'.format(a1)]['values'][time_ind]
+            ph2 = parms['Gain:0:0:Phase:{}'.format(a2)]['values'][time_ind]
+
+            # Filter flagged solutions
+            good = np.where((~np.isnan(ph1)) & (~np.isnan(ph2)))[0]
+            if len(good) == 0:
+                continue
+            phases.append(unwrap_fft(ph2[good] - ph1[good]))
+            range_indices.append(r)
+            dists.append(d)
 
-        rmstime = None
-        ph = unwrap_fft(ph2[good] - ph1[good])
-
-        step = 1
-        for i in range(1, len(ph)/2, step):
-            p1 = ph[i:]
-            p2 = ph[:-i]
-            rms = np.linalg.norm(p1-p2) / np.sqrt(len(p1))
-            mad = median_absolute_deviation(p1-p2)
-            mean = np.mean(p1-p2)
-            if rms + mean > target_rms_rad:
-                rmstime = i
-                break
-        if rmstime is None:
-            rmstime = len(ph)/2
-        rmstimes.append(rmstime)
-        dists.append(d)
+    # Find correlation times of all baselines and time ranges at once
+    rmstimes = find_correlation_lags(phases, target_rms_rad)
+    range_indices = np.array(range_indices, dtype=int)
+    dists = np.array(dists)
 
     # Find the mean ionfactor assuming that the correlation time goes as
     # t_corr ~ 1/sqrt(BL). The ionfactor is defined in BLavg() as:
     #
     #     ionfactor = (t_corr / 30.0 sec) / ( np.sqrt((25.0 / dist_km)) * (freq_hz / 60.e6) )
     #
-    ionfactor = np.mean(np.array(rmstimes) / 30.0 / (np.sqrt(25.0 / np.array(dists))
-        * freq / 60.0e6)) * timepersolution
+    ionfactors = []
+    for r in xrange(len(time_ranges)):
+        sel = (range_indices == r)
+        ionfactors.append(np.mean(rmstimes[sel] / 30.0 / (np.sqrt(25.0 /
+            dists[sel]) * freq / 60.0e6)) * timepersolution)
+
+    return ionfactors
+
+
+def find_correlation_lags(phases, target_rms_rad):
+    """
+    Finds the first lag at which the structure function of each phase series
+    exceeds a target
+
+    The structure function at lag i is the rms plus the mean of the
+    differences p[i:] - p[:-i]. The sums of the differences and of their
+    squares are found for all lags and all series at once, from cumulative
+    sums of the phases and from their autocorrelation (computed by FFT)
 
-    return ionfactor
+    Parameters
+    ----------
+    phases : list of arrays
+        Phase series in rad, with time along the first axis
+    target_rms_rad : float
+        Target value of the structure function in rad
+
+    Returns
+    -------
+    lags : array
+        The first lag (from 1 to n/2 - 1) at which the structure function of
+        each series (of n samples) exceeds target_rms_rad, or n/2 if it does
+        not
+
+    """
+    if len(phases) == 0:
+        return np.zeros(0, dtype=int)
+    phases = [np.reshape(ph, (len(ph), -1)) for ph in phases]
+    nsamples = np.array([ph.shape[0] for ph in phases])
+    ncols = np.array([ph.shape[1] for ph in phases])
+
+    # Stack the series, padded with zeros. Their means are subtracted to
+    # reduce round-off, as this does not change the differences
+    p = np.zeros((len(phases), nsamples.max(), ncols.max()))
+    for k, ph in enumerate(phases):
+        p[k, :ph.shape[0], :ph.shape[1]] = ph - np.mean(ph)
+
+    # Cumulative sums of the phases and of their squares, and the
+    # autocorrelation of the phases
+    csum = np.zeros((p.shape[0], p.shape[1]+1))
+    csum[:, 1:] = np.cumsum(p.sum(axis=2), axis=1)
+    csum2 = np.zeros((p.shape[0], p.shape[1]+1))
+    csum2[:, 1:] = np.cumsum((p**2).sum(axis=2), axis=1)
+    nfft = 2**int(np.ceil(np.log2(2 * p.shape[1])))
+    acorr = np.fft.irfft(np.abs(np.fft.rfft(p, nfft, axis=1))**2, nfft,
+        axis=1)[:, :p.shape[1], :].sum(axis=2)
+
+    # Sums of p[i:n] - p[:n-i] and of its square for each lag i
+    rows = np.arange(p.shape[0])[:, np.newaxis]
+    lag = np.arange(p.shape[1])[np.newaxis, :]
+    n = nsamples[:, np.newaxis]
+    late = np.minimum(lag, n)
+    early = np.maximum(n - lag, 0)
+    sum_diff = (csum[rows, n] - csum[rows, late]) - csum[rows, early]
+    sum_diff2 = ((csum2[rows, n] - csum2[rows, late]) + csum2[rows, early] -
+        2.0 * acorr)
+
+    valid = (lag >= 1) & (lag < n / 2)
+    ndiff = np.maximum(n - lag, 1)
+    rms = np.sqrt(np.maximum(sum_diff2, 0.0) / ndiff)
+    mean = sum_diff / (ndiff * ncols[:, np.newaxis])
+    exceeds = valid & (rms + mean > target_rms_rad)
+
+    return np.where(exceeds.any(axis=1), np.argmax(exceeds, axis=1), nsamples / 2)
 
 
 def BLavg_multi(sorted_ms_dict, baseline_dict, input_colname, output_data_colname,
-        output_weights_colname, ionfactor, clobber=True, maxgap_sec=1800, check_files = True):
+        output_weights_colname, ionfactor, clobber=True, maxgap_sec=1800, check_files = True,
+        max_memory_mb=None, ncpu=1):
     """
     Averages data using a sliding Gaussian kernel on the weights
+
+    The data are streamed through memory a batch of baselines at a time: the
+    rows of the baselines of a batch are read from each MS of a group,
+    smoothed, and written back before the next batch is read. If max_memory_mb
+    is given, the batches are made small enough that their data fit in that
+    amount of memory; otherwise, all baselines are done in a single batch.
+    The baselines of a batch are smoothed in parallel by ncpu processes that
+    work on the batch in shared memory (fewer if the smoothing of ncpu
+    baselines at once would not fit in max_memory_mb)
     """
 
     #### sort msnames into groups with gaps < maxgap_sec
@@ -241,23 +415,22 @@ def BLavg_multi(sorted_ms_dict, baseline_dict, input_colname, output_data_colnam
     #### loop over all groups
     msindex = 0
     for ms_names in ms_groups:
-        ### collect data from all files in this group
+        ### read the time and antenna columns (but not the data) of all files
+        ### in this group
         freqtab = pt.table(ms_names[0] + '::SPECTRAL_WINDOW', ack=False)
         freq = freqtab.getcell('REF_FREQUENCY',0)
         freqtab.close()
         timepersample = None
+        ms_list          = []
         ant1_list        = []
         ant2_list        = []
         all_time_list    = []
-        all_data_list    = []
-        all_weights_list = []
-        all_flags_list   = []
         for msfile in ms_names:
             if not os.path.exists(msfile):
                 print("Cannot find MS file: {0}.".format(msfile))
                 sys.exit(1)
             # open input/output MS
-            ms = pt.table(msfile, readonly=True, ack=False)
+            ms = pt.table(msfile, readonly=False, ack=False)
             if check_files:
                 freqtab = pt.table(msfile + '::SPECTRAL_WINDOW', ack=False)
                 if freqtab.getcell('REF_FREQUENCY',0) != freq:
@@ -274,80 +447,7 @@ def BLavg_multi(sorted_ms_dict, baseline_dict, input_colname, output_data_colnam
             all_time_list.append( ms.getcol('TIME_CENTROID') )
             ant1_list.append( ms.getcol('ANTENNA1') )
             ant2_list.append( ms.getcol('ANTENNA2') )
-            all_data_list.append( ms.getcol(input_colname) )
-            all_weights_list.append( ms.getcol('WEIGHT_SPECTRUM') )
-            all_flags_list.append( ms.getcol('FLAG') )
 
-            all_flags_list[-1][ np.isnan(all_data_list[-1]) ] = True # flag NaNs
-            all_weights_list[-1] = all_weights_list[-1] * ~all_flags_list[-1] # set weight of flagged data to 0
-
-            # Check that all NaNs are flagged
-            if np.count_nonzero(np.isnan(all_data_list[-1][~all_flags_list[-1]])) > 0:
-                logging.error('NaNs in unflagged data in {0}!'.format(msfile))
-                sys.exit(1)
-
-        ### iteration on baseline combination
-        for ant in itertools.product(set(ant1_list[0]), set(ant2_list[0])):
-            if ant[0] >= ant[1]:
-                continue
-            sel_list = []
-            weights_list = []
-            data_list = []
-            # select data from all MSs
-            for msindex in xrange(len(ms_names)):
-                sel1 = np.where(ant1_list[msindex] == ant[0])[0]
-                sel2 = np.where(ant2_list[msindex] == ant[1])[0]
-                sel_list.append( sorted(list(frozenset(sel1).intersection(sel2))) )
-
-                # # get weights and data
-                # weights_list.append( all_weights[sel_list[msindex],:,:] )
-                # data_list.append( all_data[sel_list[msindex],:,:] )
-            # combine data and weights into one array
-            data = all_data_list[0][sel_list[0],:,:]
-            weights = all_weights_list[0][sel_list[0],:,:]
-            fillshape = list(data.shape)
-            startidx = [0]
-            endidx = [data.shape[0]]
-            for msindex in xrange(1,len(ms_names)):
-                #pad gap between obs
-                filltimes = np.arange(np.max(all_time_list[msindex-1]),np.min(all_time_list[msindex]),timepersample)
-                fillshape[0] = len(filltimes)
-                data = np.concatenate( (data,np.zeros(fillshape)), axis=0 )
-                weights = np.concatenate( (weights,np.zeros(fillshape)), axis=0  )
-                startidx.append(data.shape[0])
-                data = np.concatenate( (data,all_data_list[msindex][sel_list[msindex],:,:]), axis=0  )
-                weights = np.concatenate( (weights,all_weights_list[msindex][sel_list[msindex],:,:]), axis=0  )
-                endidx.append(data.shape[0])
-
-            # compute the FWHM
-            dist = baseline_dict['{0}-{1}'.format(ant[0], ant[1])]
-            stddev = 30.0 * ionfactor * np.sqrt((25.0 / dist)) * (freq / 60.e6) # in sec
-            stddev = stddev/timepersample # in samples
-
-            #    Multiply every element of the data by the weights, convolve both
-            #    the scaled data and the weights, and then divide the convolved data
-            #    by the convolved weights (translating flagged data into weight=0).
-            #    That's basically the equivalent of a running weighted average with
-            #    a Gaussian window function.
-
-            # weigth data and set bad data to 0 so nans do not propagate
-            data = np.nan_to_num(data*weights)
-
-            # smear weighted data and weights
-            dataR = gfilter(np.real(data), stddev, axis=0)#, truncate=4.)
-            dataI = gfilter(np.imag(data), stddev, axis=0)#, truncate=4.)
-            weights = gfilter(weights, stddev, axis=0)#, truncate=4.)
-
-            # re-create data
-            data = (dataR + 1j * dataI)
-            data[(weights != 0)] /= weights[(weights != 0)] # avoid divbyzero
-            for msindex in xrange(len(ms_names)):
-                all_data_list[msindex][sel_list[msindex],:,:] = data[startidx[msindex]:endidx[msindex],:,:]
-                all_weights_list[msindex][sel_list[msindex],:,:] = weights[startidx[msindex]:endidx[msindex],:,:]
-
-        ### write the data back to the files
-        for msindex in xrange(len(ms_names)):
-            ms = pt.table(ms_names[msindex], readonly=False, ack=False)
             # Add the output columns if needed
             if output_data_colname not in ms.colnames():
                 desc = ms.getcoldesc(input_colname)
@@ -357,14 +457,317 @@ def BLavg_multi(sorted_ms_dict, baseline_dict, input_colname, output_data_colnam
                 desc = ms.getcoldesc('WEIGHT_SPECTRUM')
                 desc['name'] = output_weights_colname
                 ms.addcols(desc)
+            ms_list.append(ms)
 
-            ms.putcol(output_data_colname, all_data_list[msindex])
-            ms.putcol('FLAG', all_flags_list[msindex]) # this saves flags of nans, which is always good
-            ms.putcol(output_weights_colname, all_weights_list[msindex])
+        ### index the rows of each MS by baseline and time, so that the rows
+        ### of each baseline can be read in time order
+        order_list = []
+        slices_list = []
+        for msindex in xrange(len(ms_names)):
+            order, baseline_slices = get_baseline_index(ant1_list[msindex],
+                ant2_list[msindex], all_time_list[msindex])
+            order_list.append(order)
+            slices_list.append(baseline_slices)
+
+        ### number of samples to pad the gap before each file with
+        nfill_list = [0]
+        for msindex in xrange(1,len(ms_names)):
+            filltimes = np.arange(np.max(all_time_list[msindex-1]),np.min(all_time_list[msindex]),timepersample)
+            nfill_list.append(len(filltimes))
+
+        ### baselines that are smoothed. The rows of all other baselines (e.g.,
+        ### autocorrelations) are copied to the output columns unchanged
+        smooth_baselines = set([ant for ant in itertools.product(set(ant1_list[0]),
+            set(ant2_list[0])) if ant[0] < ant[1]])
+        baselines = sorted(set().union(*[baseline_slices.keys() for baseline_slices
+            in slices_list]))
+
+        ### divide the baselines into batches that fit in max_memory_mb
+        nprocs = ncpu
+        nbaselines_per_batch = max(1, len(baselines))
+        if max_memory_mb is not None and len(baselines) > 0:
+            cellsize = np.prod(np.shape(ms_list[0].getcell(input_colname, 0)))
+            nrows = max([sum([baseline_slices.get(ant, slice(0, 0)).stop -
+                baseline_slices.get(ant, slice(0, 0)).start for baseline_slices in
+                slices_list]) for ant in baselines]) + sum(nfill_list)
+            baseline_mb = nrows * cellsize * BATCH_BYTES_PER_ELEMENT / 1024.0**2
+            smooth_mb = nrows * cellsize * SMOOTH_BYTES_PER_ELEMENT / 1024.0**2
+            if nprocs * smooth_mb + baseline_mb > max_memory_mb:
+                ### use fewer processes, so that each one can smooth a baseline
+                ### next to a batch of at least one baseline
+                nprocs = max(1, int(max_memory_mb / (smooth_mb + baseline_mb)))
+                print "BLavg_multi: Reducing the number of processes to",nprocs,"to fit in the memory limit."
+                if smooth_mb + baseline_mb > max_memory_mb:
+                    print("BLavg_multi: WARNING: a single baseline needs {0:.0f} MB, "
+                        "more than the memory limit of {1:.0f} MB.".format(smooth_mb +
+                        baseline_mb, max_memory_mb))
+            nbaselines_per_batch = max(1, int((float(max_memory_mb) - nprocs *
+                smooth_mb) / baseline_mb))
+        batches = [baselines[b:b+nbaselines_per_batch] for b in xrange(0,
+            len(baselines), nbaselines_per_batch)]
+        print "BLavg_multi: Processing",len(baselines),"baselines in",len(batches),"batches."
+
+        ### allocate the shared arrays for the largest batch and start the
+        ### workers
+        _shared.clear()
+        for key, colname in [('data', input_colname), ('weights', 'WEIGHT_SPECTRUM'),
+            ('flags', 'FLAG')]:
+            cell = ms_list[0].getcell(colname, 0)
+            _shared[key] = []
+            for baseline_slices in slices_list:
+                nrows = max([sum([baseline_slices.get(ant, slice(0, 0)).stop -
+                    baseline_slices.get(ant, slice(0, 0)).start for ant in batch])
+                    for batch in batches] + [0])
+                _shared[key].append(make_shared_array((nrows,) + cell.shape,
+                    cell.dtype))
+        pool = None
+        if nprocs > 1:
+            pool = multiprocessing.Pool(nprocs)
+
+        for batch in batches:
+            BLavg_batch(ms_list, batch, smooth_baselines, order_list, slices_list,
+                nfill_list, baseline_dict, input_colname, output_data_colname,
+                output_weights_colname, ionfactor, freq, timepersample, pool)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _shared.clear()
+        for ms in ms_list:
             ms.close()
         print "BLavg_multi: Finished one group of measurement sets."
 
 
+def BLavg_batch(ms_list, baselines, smooth_baselines, order_list, slices_list,
+        nfill_list, baseline_dict, input_colname, output_data_colname,
+        output_weights_colname, ionfactor, freq, timepersample, pool=None):
+    """
+    Averages the data of a batch of baselines of a group of MSs
+
+    Only the rows of the batch are read from and written to the MSs. They are
+    read into the shared arrays, where the baselines are smoothed by the
+    processes of the pool (or by this process if pool is None)
+    """
+    ### read the rows of the batch from each MS, grouped by baseline and
+    ### sorted by time
+    sel_list     = []
+    batch_slices = []
+    nrows_list   = []
+    for msindex, ms in enumerate(ms_list):
+        rows = []
+        slices = {}
+        nrows = 0
+        for ant in baselines:
+            s = slices_list[msindex].get(ant, slice(0, 0))
+            rows.append(order_list[msindex][s])
+            slices[ant] = slice(nrows, nrows + s.stop - s.start)
+            nrows += s.stop - s.start
+        batch_slices.append(slices)
+        nrows_list.append(nrows)
+        if nrows == 0:
+            sel_list.append(None)
+            continue
+        data = _shared['data'][msindex][:nrows]
+        weights = _shared['weights'][msindex][:nrows]
+        flags = _shared['flags'][msindex][:nrows]
+        sel = ms.selectrows(np.concatenate(rows))
+        sel_list.append(sel)
+        sel.getcolnp(input_colname, data)
+        sel.getcolnp('WEIGHT_SPECTRUM', weights)
+        sel.getcolnp('FLAG', flags)
+
+        flags[ np.isnan(data) ] = True # flag NaNs
+        weights *= ~flags # set weight of flagged data to 0
+
+        # Check that all NaNs are flagged
+        if np.count_nonzero(np.isnan(data[~flags])) > 0:
+            print('NaNs in unflagged data in {0}!'.format(ms.name()))
+            sys.exit(1)
+
+    ### smooth the baselines
+    smooth_list = []
+    for ant in baselines:
+        if ant not in smooth_baselines:
+            continue
+
+        # compute the FWHM
+        dist = baseline_dict['{0}-{1}'.format(ant[0], ant[1])]
+        stddev = 30.0 * ionfactor * np.sqrt((25.0 / dist)) * (freq / 60.e6) # in sec
+        stddev = stddev/timepersample # in samples
+        smooth_list.append([[slices[ant] for slices in batch_slices], nfill_list,
+            stddev])
+    if pool is None:
+        map(smooth_baseline_star, smooth_list)
+    else:
+        pool.map(smooth_baseline_star, smooth_list)
+
+    ### write the batch back to the files
+    for msindex, sel in enumerate(sel_list):
+        if sel is None:
+            continue
+        nrows = nrows_list[msindex]
+        sel.putcol(output_data_colname, _shared['data'][msindex][:nrows])
+        sel.putcol('FLAG', _shared['flags'][msindex][:nrows]) # this saves flags of nans, which is always good
+        sel.putcol(output_weights_colname, _shared['weights'][msindex][:nrows])
+        sel.close()
+
+
+def smooth_baseline_star(inputs):
+    """
+    Simple helper function for pool.map
+    """
+    return smooth_baseline(*inputs)
+
+
+def smooth_baseline(sel_list, nfill_list, stddev):
+    """
+    Smooths the data and weights of one baseline in the shared arrays
+
+    The weighted data (real and imaginary parts) and the weights of all MSs
+    are gathered into a single work array, with zero-weight padding for the
+    gaps between the MSs, and smoothed together in one pass
+
+    Parameters
+    ----------
+    sel_list : list of slices
+        Rows of the baseline in the shared arrays of each MS
+    nfill_list : list of int
+        Number of samples with which to pad the gap before each MS
+    stddev : float
+        Standard deviation of the Gaussian kernel in samples
+
+    """
+    all_data_list = _shared['data']
+    all_weights_list = _shared['weights']
+
+    # Find where the data of each MS go in the work array
+    startidx = []
+    endidx = []
+    nrows = 0
+    for msindex, sel in enumerate(sel_list):
+        if msindex > 0:
+            #pad gap between obs
+            nrows += nfill_list[msindex]
+        startidx.append(nrows)
+        nrows += sel.stop - sel.start
+        endidx.append(nrows)
+
+    #    Multiply every element of the data by the weights, convolve both
+    #    the scaled data and the weights, and then divide the convolved data
+    #    by the convolved weights (translating flagged data into weight=0).
+    #    That's basically the equivalent of a running weighted average with
+    #    a Gaussian window function.
+    cellshape = all_weights_list[0].shape[1:]
+    work = np.zeros((nrows,) + cellshape + (3,))
+    for msindex, sel in enumerate(sel_list):
+        data = all_data_list[msindex][sel]
+        weights = all_weights_list[msindex][sel]
+        rows = slice(startidx[msindex], endidx[msindex])
+        np.multiply(data.real, weights, out=work[rows, ..., 0])
+        np.multiply(data.imag, weights, out=work[rows, ..., 1])
+        work[rows, ..., 2] = weights
+
+    # set bad data to 0 so nans do not propagate
+    work[np.isnan(work)] = 0.0
+
+    # smear weighted data and weights
+    gaussian_smooth(work, stddev)
+
+    # re-create data
+    nonzero = (work[..., 2] != 0) # avoid divbyzero
+    np.divide(work[..., 0], work[..., 2], out=work[..., 0], where=nonzero)
+    np.divide(work[..., 1], work[..., 2], out=work[..., 1], where=nonzero)
+    for msindex, sel in enumerate(sel_list):
+        data = all_data_list[msindex][sel]
+        rows = slice(startidx[msindex], endidx[msindex])
+        data.real = work[rows, ..., 0]
+        data.imag = work[rows, ..., 1]
+        all_weights_list[msindex][sel] = work[rows, ..., 2]
+
+
+def gaussian_smooth(work, stddev, truncate=4.0):
+    """
+    Smooths an array along its first axis with a Gaussian kernel, in place
+
+    The result is that of scipy's gaussian_filter1d (with mode 'reflect').
+    The array is smoothed one element of its last axis at a time through a
+    single preallocated buffer. Short kernels are applied directly; long ones
+    (with a radius of at least FFT_MIN_RADIUS samples) are applied by FFT
+    convolution. As with direct convolution, the result is exactly zero where
+    the input is zero over the whole kernel (e.g., in long flagged stretches)
+
+    Parameters
+    ----------
+    work : array
+        Float array to smooth
+    stddev : float
+        Standard deviation of the Gaussian kernel in samples
+    truncate : float, optional
+        Radius of the kernel in standard deviations
+
+    """
+    nrows = work.shape[0]
+    if nrows == 0:
+        return
+    buf = np.empty(work.shape[:-1])
+    radius = int(truncate * float(stddev) + 0.5)
+    if radius < FFT_MIN_RADIUS:
+        for i in xrange(work.shape[-1]):
+            gfilter(work[..., i], stddev, axis=0, output=buf, truncate=truncate)
+            work[..., i] = buf
+        return
+
+    x = np.arange(-radius, radius+1)
+    kernel = np.exp(-0.5 / float(stddev)**2 * x**2)
+    kernel /= kernel.sum()
+
+    # Convolve the reflected array with the kernel. The length of the FFT is
+    # chosen so that the convolution does not wrap around
+    nfft = 2**int(np.ceil(np.log2(nrows + 4 * radius)))
+    kernel_fft = np.fft.rfft(kernel, nfft)
+    kernel_fft.shape = kernel_fft.shape + (1,) * (work.ndim - 2)
+    padding = [(radius, radius)] + [(0, 0)] * (work.ndim - 2)
+    nnonzero = np.zeros((nrows + 2*radius + 1,) + work.shape[1:-1], dtype=np.int64)
+    for i in xrange(work.shape[-1]):
+        padded = np.pad(work[..., i], padding, mode='symmetric')
+        spectrum = np.fft.rfft(padded, nfft, axis=0)
+        spectrum *= kernel_fft
+        buf[:] = np.fft.irfft(spectrum, nfft, axis=0)[2*radius:2*radius+nrows]
+
+        # Remove the round-off of the FFT where there are no non-zero values
+        # within the kernel, as dividing the smoothed data by the smoothed
+        # weights there would give noise (and the weights could be negative)
+        np.cumsum(padded != 0, axis=0, out=nnonzero[1:])
+        buf[nnonzero[2*radius+1:] == nnonzero[:nrows]] = 0.0
+        work[..., i] = buf
+
+
+def make_shared_array(shape, dtype):
+    """
+    Returns an array in shared memory
+
+    The array is inherited by (and its contents shared with) the processes
+    forked after it is made
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the array
+    dtype : numpy dtype
+        Data type of the array
+
+    Returns
+    -------
+    array : array
+        The array
+
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buf = multiprocessing.RawArray('b', max(1, nbytes))
+    return np.frombuffer(buf, dtype=np.int8, count=nbytes).view(dtype).reshape(shape)
+
+
 def smooth(x, window_len=10, window='hanning'):
     """smooth the data using a window with requested size.
 
@@ -508,10 +911,13 @@ if __name__ == '__main__':
     parser.add_argument('output_data_colname', help='Name of output column')
     parser.add_argument('output_weights_colname', help='Name of output column')
     parser.add_argument('target_rms', help='Target rms in Jy/beam')
+    parser.add_argument('-m', '--max_percent_memory', help='Maximum percentage of memory to use', type=float, default=None)
+    parser.add_argument('-n', '--ncpu', help='Number of processes to use', type=int, default=None)
     args = parser.parse_args()
 
     ms_input = glob.glob(args.ms_file_pattern)
     parmdb_input = glob.glob(args.parmdb_file_pattern)
 
     main(ms_input, parmdb_input, args.input_colname, args.output_data_colname,
-        args.output_weights_colname, args.target_rms)
+        args.output_weights_colname, args.target_rms,
+        max_percent_memory=args.max_percent_memory, ncpu=args.ncpu)
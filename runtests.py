@@ -0,0 +1,14 @@
+#! /usr/bin/env python
+"""
+Script to run the tests in the tests directory
+"""
+import os
+import sys
+import unittest
+
+
+if __name__ == '__main__':
+    tests_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests')
+    suite = unittest.defaultTestLoader.discover(tests_dir)
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    sys.exit(not result.wasSuccessful())
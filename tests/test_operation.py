@@ -0,0 +1,136 @@
+"""
+Tests of the checks of the pipeline steps completed by a previous run
+"""
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import unittest
+from jinja2 import Template
+
+try:
+    from factor.lib.operation import Operation
+    from lofarpipe.support.data_map import DataMap, DataProduct
+    have_lofarpipe = True
+except ImportError:
+    have_lofarpipe = False
+
+
+TEMPLATE = """
+pipeline.steps = [average, subtract]
+
+average.control.type                = dppp
+average.control.selfcal_dir         = {{ pipeline_parset_dir }}
+average.argument.msin               = {{ input_mapfile }}
+average.argument.tempdir            = {{ local_dir_parent }}
+average.argument.localdir           = {{ local_dir }}
+
+subtract.control.type               = python_plugin
+subtract.argument.msin              = {{ chunk }}
+subtract.argument.freqstep          = {{ freqstep }}
+"""
+
+
+class Direction(object):
+    """
+    Minimal direction for the operation
+    """
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.__dict__.update(kwargs)
+
+
+@unittest.skipUnless(have_lofarpipe, 'lofarpipe is not available')
+class TestStepState(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.scratch_dir = os.path.join(self.working_dir, 'scratch')
+        os.mkdir(self.scratch_dir)
+
+        # Chunk MS and mapfile that lists it
+        self.chunk = os.path.join(self.working_dir, 'chunks', 'band0_chunk0.ms')
+        os.makedirs(self.chunk)
+        for table_file in ['table.dat', 'table.f0', 'table.lock']:
+            self.write_file(os.path.join(self.chunk, table_file))
+        self.input_mapfile = os.path.join(self.working_dir, 'input.mapfile')
+        DataMap([DataProduct('localhost', self.chunk, False)]).save(self.input_mapfile)
+
+        self.parset = {'logging_level': 'info', 'dir_working': self.working_dir,
+            'wsclean_executable': 'wsclean', 'image2fits_executable': 'image2fits',
+            'cluster_specific': {'node_list': ['localhost'],
+            'dir_local': self.scratch_dir, 'dir_local_selfcal': None,
+            'clusterdesc_file': 'local.clusterdesc', 'clusterdesc':
+            'local.clusterdesc', 'lofarroot': '', 'lofarpythonpath': '',
+            'clustertype': 'local', 'ncpu': 1}}
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def write_file(self, path, contents='x'):
+        with open(path, 'a') as f:
+            f.write(contents)
+
+    def make_operation(self, freqstep=1):
+        direction = Direction('facet_patch_1', input_mapfile=self.input_mapfile,
+            chunk=self.chunk, freqstep=freqstep)
+        op = Operation(self.parset, [], direction, name='facetsub')
+        op.pipeline_parset_template = Template(TEMPLATE)
+        op.update_dicts()
+        op.check_step_state()
+        return op
+
+    def run_operation(self, op):
+        """
+        Writes the outputs and statefile of a run of both steps and changes
+        the files that the steps write to
+        """
+        completed_steps = []
+        for step in ['average', 'subtract']:
+            mapfile = os.path.join(op.pipeline_mapfile_dir, step + '.mapfile')
+            DataMap([DataProduct('localhost', self.chunk, False)]).save(mapfile)
+            completed_steps.append(('dppp', {'mapfile': mapfile}))
+        with open(op.pipeline_state_file, 'w') as f:
+            pickle.dump(['pipeline', completed_steps], f)
+
+        # The subtract step writes into its input chunk, and the pipeline writes
+        # to its parset and scratch directories
+        time.sleep(0.01)
+        self.write_file(os.path.join(self.chunk, 'table.f0'))
+        self.write_file(os.path.join(self.chunk, 'table.lock'))
+        self.write_file(os.path.join(self.chunk, 'table.f1'))
+        os.makedirs(op.local_scratch_dir)
+        self.write_file(os.path.join(op.pipeline_parset_dir, 'selfcal_images'))
+        op.save_step_state()
+
+    def get_completed_steps(self, op):
+        if not os.path.exists(op.pipeline_state_file):
+            return []
+        with open(op.pipeline_state_file, 'r') as f:
+            return [outputs['mapfile'] for _, outputs in pickle.load(f)[1]]
+
+    def test_unchanged_run_keeps_steps(self):
+        self.run_operation(self.make_operation())
+        op = self.make_operation()
+        self.assertEqual(len(self.get_completed_steps(op)), 2)
+
+        # Setting it up once more must not change anything either
+        op = self.make_operation()
+        self.assertEqual(len(self.get_completed_steps(op)), 2)
+
+    def test_changed_parameter_reruns_step(self):
+        self.run_operation(self.make_operation())
+        op = self.make_operation(freqstep=2)
+        self.assertEqual(len(self.get_completed_steps(op)), 1)
+
+    def test_changed_input_reruns_steps(self):
+        self.run_operation(self.make_operation())
+        time.sleep(0.01)
+        self.write_file(os.path.join(self.chunk, 'table.dat'))
+        op = self.make_operation()
+        self.assertEqual(len(self.get_completed_steps(op)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
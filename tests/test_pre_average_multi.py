@@ -0,0 +1,425 @@
+"""
+Tests of the pre-averaging script
+
+The baseline index, the batched (and parallel) averaging, the smoothing and the
+correlation lags are checked against the straightforward versions they replace.
+The MSs are held in memory by a minimal table class that provides the casacore
+calls made by BLavg_multi(), and the parmdb by a minimal parmdb class
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+try:
+    from scipy.ndimage.filters import gaussian_filter1d as gfilter
+    from factor.scripts import pre_average_multi
+    have_dependencies = True
+except ImportError:
+    have_dependencies = False
+
+
+def make_work(nrows, cellshape, flagged_rows, seed=0):
+    """
+    Returns a work array of weighted data and weights, as made by
+    smooth_baseline(), with the weights of the given rows set to zero
+    """
+    rng = np.random.RandomState(seed)
+    weights = rng.uniform(0.5, 1.5, (nrows,) + cellshape)
+    weights[flagged_rows] = 0.0
+    work = np.empty((nrows,) + cellshape + (3,))
+    work[..., 0] = rng.normal(size=weights.shape) * weights
+    work[..., 1] = rng.normal(size=weights.shape) * weights
+    work[..., 2] = weights
+    return work
+
+
+def reference_lag(ph, target_rms_rad):
+    """
+    Returns the first lag at which the structure function of a phase series
+    exceeds the target, as found by the per-lag loop that
+    find_correlation_lags() replaces
+    """
+    for i in range(1, len(ph)/2):
+        p1 = ph[i:]
+        p2 = ph[:-i]
+        rms = np.linalg.norm(p1-p2) / np.sqrt(len(p1))
+        mean = np.mean(p1-p2)
+        if rms + mean > target_rms_rad:
+            return i
+    return len(ph)/2
+
+
+def reference_ionfactor(parms, baseline_dict, t1, t2, target_rms_rad):
+    """
+    Returns the ionfactor of a time range, as found by find_ionfactor() before
+    it was vectorized (for a parmdb that has all stations of baseline_dict)
+    """
+    rmstimes = []
+    dists = []
+    for k, d in baseline_dict.iteritems():
+        if type(d) is str or '-' not in k or d <= 10.0:
+            continue
+        a1, a2 = [baseline_dict[s] for s in k.split('-')]
+        freq = parms['Gain:0:0:Phase:{}'.format(a1)]['freqs'][0]
+        times = parms['Gain:0:0:Phase:{}'.format(a1)]['times']
+        time_ind = np.where((times >= t1) & (times < t2))[0]
+        timepersolution = parms['Gain:0:0:Phase:{}'.format(a1)]['timewidths'][0]
+        ph1 = parms['Gain:0:0:Phase:{}'.format(a1)]['values'][time_ind]
+        ph2 = parms['Gain:0:0:Phase:{}'.format(a2)]['values'][time_ind]
+        good = np.where((~np.isnan(ph1)) & (~np.isnan(ph2)))[0]
+        if len(good) == 0:
+            continue
+        ph = pre_average_multi.unwrap_fft(ph2[good] - ph1[good])
+        rmstimes.append(reference_lag(ph, target_rms_rad))
+        dists.append(d)
+
+    return np.mean(np.array(rmstimes) / 30.0 / (np.sqrt(25.0 / np.array(dists))
+        * freq / 60.0e6)) * timepersolution
+
+
+class ParmDB(object):
+    """
+    In-memory parmdb with the calls made by find_ionfactors()
+    """
+    def __init__(self, parms):
+        self.parms = parms
+
+    def getValuesGrid(self, pattern):
+        return self.parms
+
+    def getNames(self):
+        return self.parms.keys()
+
+
+class ParmDBModule(object):
+    """
+    Replacement for lofar (as used for lofar.parmdb) that opens an in-memory
+    parmdb
+    """
+    def __init__(self, parms):
+        self.parmdb = self
+        self.parms = parms
+
+    def __call__(self, parmdb_file):
+        return ParmDB(self.parms)
+
+
+class Table(object):
+    """
+    In-memory table with the columns of an MS (or of its SPECTRAL_WINDOW
+    subtable)
+    """
+    def __init__(self, tablename, columns):
+        self.tablename = tablename
+        self.columns = columns
+
+    def name(self):
+        return self.tablename
+
+    def colnames(self):
+        return self.columns.keys()
+
+    def getcell(self, colname, row):
+        return self.columns[colname][row]
+
+    def getcol(self, colname):
+        return self.columns[colname].copy()
+
+    def getcoldesc(self, colname):
+        return {'name': colname, 'source': colname}
+
+    def addcols(self, desc):
+        self.columns[desc['name']] = np.zeros_like(self.columns[desc['source']])
+
+    def selectrows(self, rows):
+        return Selection(self, rows)
+
+    def close(self):
+        pass
+
+
+class Selection(object):
+    """
+    Selection of rows of a Table
+    """
+    def __init__(self, table, rows):
+        self.table = table
+        self.rows = np.array(rows)
+
+    def getcolnp(self, colname, out):
+        out[:] = self.table.columns[colname][self.rows]
+
+    def putcol(self, colname, value):
+        self.table.columns[colname][self.rows] = value
+
+    def close(self):
+        pass
+
+
+class TableModule(object):
+    """
+    Replacement for casacore.tables that opens the in-memory tables
+    """
+    def __init__(self, tables):
+        self.tables = tables
+
+    def table(self, tablename, readonly=True, ack=True):
+        return self.tables[tablename]
+
+
+def make_ms(msname, start_time, ntimes, nant, seed):
+    """
+    Returns an in-memory MS with all baselines (including autocorrelations) of
+    nant antennas, with time-major row order as in LOFAR MSs. Some data are
+    flagged (some of them also NaN), and the cross-correlations of antennas 0
+    and 1 are flagged over a long stretch
+    """
+    rng = np.random.RandomState(seed)
+    baselines = [(a1, a2) for a1 in range(nant) for a2 in range(a1, nant)]
+    times = start_time + np.repeat(np.arange(ntimes, dtype=float), len(baselines))
+    ant1 = np.tile([a1 for a1, a2 in baselines], ntimes)
+    ant2 = np.tile([a2 for a1, a2 in baselines], ntimes)
+    shape = (len(times), 3, 2)
+    data = rng.normal(size=shape) + 1j * rng.normal(size=shape)
+    weights = rng.uniform(0.5, 1.5, shape)
+    flags = rng.uniform(size=shape) < 0.05
+    data[flags & (rng.uniform(size=shape) < 0.5)] = np.nan
+    gap = (ant1 == 0) & (ant2 == 1) & (times >= start_time + 50) & (times < start_time + 350)
+    flags[gap] = True
+    return Table(msname, {'TIME_CENTROID': times, 'ANTENNA1': ant1,
+        'ANTENNA2': ant2, 'INTERVAL': np.ones(len(times)), 'DATA': data,
+        'WEIGHT_SPECTRUM': weights, 'FLAG': flags})
+
+
+def reference_average(ms_list, baseline_dict, ionfactor, freq, timepersample):
+    """
+    Averages the MSs baseline by baseline, as BLavg_multi() did before it was
+    batched (without the sort-based index, shared memory or FFT smoothing)
+
+    Returns the lists of the output data, weights and flags of the MSs
+    """
+    data_list = [ms.getcol('DATA') for ms in ms_list]
+    flags_list = [ms.getcol('FLAG') for ms in ms_list]
+    for data, flags in zip(data_list, flags_list):
+        flags[np.isnan(data)] = True
+    weights_list = [ms.getcol('WEIGHT_SPECTRUM') * ~flags for ms, flags in
+        zip(ms_list, flags_list)]
+    times_list = [ms.getcol('TIME_CENTROID') for ms in ms_list]
+    ant1_list = [ms.getcol('ANTENNA1') for ms in ms_list]
+    ant2_list = [ms.getcol('ANTENNA2') for ms in ms_list]
+
+    for ant in [(a1, a2) for a1 in set(ant1_list[0]) for a2 in set(ant2_list[0])
+        if a1 < a2]:
+        sel_list = [np.where((ant1 == ant[0]) & (ant2 == ant[1]))[0] for ant1, ant2
+            in zip(ant1_list, ant2_list)]
+        data = []
+        weights = []
+        bounds = []
+        nrows = 0
+        for msindex, sel in enumerate(sel_list):
+            if msindex > 0:
+                nfill = len(np.arange(np.max(times_list[msindex-1]),
+                    np.min(times_list[msindex]), timepersample))
+                data.append(np.zeros((nfill,) + data_list[msindex].shape[1:]))
+                weights.append(np.zeros((nfill,) + data_list[msindex].shape[1:]))
+                nrows += nfill
+            data.append(data_list[msindex][sel])
+            weights.append(weights_list[msindex][sel])
+            bounds.append((nrows, nrows + len(sel)))
+            nrows += len(sel)
+        weights = np.concatenate(weights)
+        data = np.nan_to_num(np.concatenate(data) * weights)
+
+        dist = baseline_dict['{0}-{1}'.format(ant[0], ant[1])]
+        stddev = 30.0 * ionfactor * np.sqrt((25.0 / dist)) * (freq / 60.e6)
+        stddev = stddev / timepersample
+        data = (gfilter(data.real, stddev, axis=0) + 1j * gfilter(data.imag,
+            stddev, axis=0))
+        weights = gfilter(weights, stddev, axis=0)
+        data[weights != 0] /= weights[weights != 0]
+        for msindex, sel in enumerate(sel_list):
+            data_list[msindex][sel] = data[bounds[msindex][0]:bounds[msindex][1]]
+            weights_list[msindex][sel] = weights[bounds[msindex][0]:bounds[msindex][1]]
+
+    return data_list, weights_list, flags_list
+
+
+@unittest.skipUnless(have_dependencies, 'scipy, casacore or lofar is not available')
+class TestBaselineIndex(unittest.TestCase):
+
+    def test_index(self):
+        rng = np.random.RandomState(1)
+        nrows = 500
+        ant1 = rng.randint(0, 5, nrows)
+        ant2 = rng.randint(0, 5, nrows)
+        times = rng.permutation(nrows).astype(float)
+        for use_times in [True, False]:
+            if use_times:
+                order, baseline_slices = pre_average_multi.get_baseline_index(
+                    ant1, ant2, times)
+            else:
+                order, baseline_slices = pre_average_multi.get_baseline_index(
+                    ant1, ant2)
+            self.assertEqual(sorted(order), range(nrows))
+            self.assertEqual(sorted(baseline_slices.keys()),
+                sorted(set(zip(ant1, ant2))))
+            for (a1, a2), s in baseline_slices.iteritems():
+                rows = np.where((ant1 == a1) & (ant2 == a2))[0]
+                if use_times:
+                    rows = rows[np.argsort(times[rows])]
+                self.assertEqual(list(order[s]), list(rows))
+
+
+@unittest.skipUnless(have_dependencies, 'scipy, casacore or lofar is not available')
+class TestBLavgMulti(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.freq = 60.e6
+        self.ionfactor = 1.0
+        # Baselines of antenna 0 are smoothed with a kernel of radius 120
+        # samples (by FFT), the others with radius 12 samples (directly)
+        self.baseline_dict = {'0-1': 25.0, '0-2': 25.0, '1-2': 2500.0}
+        self.pt = pre_average_multi.pt
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        pre_average_multi.pt = self.pt
+
+    def make_group(self):
+        """
+        Makes a group of two MSs with a gap of 100 s between them
+        """
+        ms_list = []
+        tables = {}
+        for i, start_time in enumerate([0.0, 500.0]):
+            msname = os.path.join(self.tempdir, 'chunk{0}.ms'.format(i))
+            if not os.path.exists(msname):
+                os.mkdir(msname)
+            ms = make_ms(msname, start_time, 400, 3, seed=i)
+            ms_list.append(ms)
+            tables[msname] = ms
+            tables[msname + '::SPECTRAL_WINDOW'] = Table(msname + '::SPECTRAL_WINDOW',
+                {'REF_FREQUENCY': np.array([self.freq])})
+        pre_average_multi.pt = TableModule(tables)
+        sorted_ms_dict = {'msnames': [ms.name() for ms in ms_list],
+            'starttimes': [0.0, 500.0], 'endtimes': [399.0, 899.0]}
+        return ms_list, sorted_ms_dict
+
+    def check_batched(self, max_memory_mb, ncpu):
+        ms_list, sorted_ms_dict = self.make_group()
+        expected = reference_average(ms_list, self.baseline_dict, self.ionfactor,
+            self.freq, 1.0)
+        pre_average_multi.BLavg_multi(sorted_ms_dict, self.baseline_dict, 'DATA',
+            'DATA_OUT', 'WEIGHTS_OUT', self.ionfactor, max_memory_mb=max_memory_mb,
+            ncpu=ncpu)
+        for ms, data, weights, flags in zip(ms_list, *expected):
+            np.testing.assert_allclose(ms.columns['DATA_OUT'], data, rtol=1e-8,
+                atol=1e-10)
+            np.testing.assert_allclose(ms.columns['WEIGHTS_OUT'], weights,
+                rtol=1e-8, atol=1e-10)
+            np.testing.assert_array_equal(ms.columns['FLAG'], flags)
+            self.assertTrue(np.all(ms.columns['WEIGHTS_OUT'] >= 0.0))
+
+    def test_single_batch(self):
+        self.check_batched(None, 1)
+
+    def test_single_batch_in_parallel(self):
+        self.check_batched(None, 2)
+
+    def test_batches_over_memory_limit(self):
+        # The memory limit is so low that each baseline is done in its own
+        # batch by a single process
+        self.check_batched(1e-6, 2)
+
+
+@unittest.skipUnless(have_dependencies, 'scipy, casacore or lofar is not available')
+class TestCorrelationLags(unittest.TestCase):
+
+    def setUp(self):
+        self.lofar = pre_average_multi.lofar
+
+    def tearDown(self):
+        pre_average_multi.lofar = self.lofar
+
+    def test_random_series(self):
+        # Random walks of different lengths and widths, some of which never
+        # exceed the target (so that the lag is n/2)
+        rng = np.random.RandomState(2)
+        phases = []
+        for nsamples in [1, 2, 3, 4, 7, 50, 51, 200]:
+            for ncols in [1, 2]:
+                for scale in [0.01, 0.05, 0.3]:
+                    phases.append(np.cumsum(rng.normal(scale=scale,
+                        size=(nsamples, ncols)), axis=0) + rng.uniform(-3.0, 3.0))
+        lags = pre_average_multi.find_correlation_lags(phases, 0.2)
+        self.assertEqual(list(lags), [reference_lag(ph, 0.2) for ph in phases])
+        self.assertTrue(any([lag == len(ph)/2 for lag, ph in zip(lags, phases)]))
+        self.assertTrue(any([0 < lag < len(ph)/2 for lag, ph in zip(lags, phases)]))
+
+    def test_no_series(self):
+        self.assertEqual(len(pre_average_multi.find_correlation_lags([], 0.2)), 0)
+
+    def test_ionfactors_with_flagged_solutions(self):
+        # Phase solutions of 4 stations with some flagged (NaN) solutions, and
+        # one station flagged over the whole second time range
+        rng = np.random.RandomState(3)
+        ntimes = 300
+        times = 1000.0 + 10.0 * np.arange(ntimes)
+        parms = {}
+        for s in range(4):
+            values = np.cumsum(rng.normal(scale=0.05, size=(ntimes, 1)), axis=0)
+            values = np.angle(np.exp(1j * values))
+            values[rng.uniform(size=ntimes) < 0.1] = np.nan
+            if s == 3:
+                values[150:] = np.nan
+            parms['Gain:0:0:Phase:CS00{0}'.format(s)] = {'values': values,
+                'times': times, 'timewidths': np.ones(ntimes) * 10.0,
+                'freqs': np.array([60.0e6])}
+        baseline_dict = {'0': 'CS000', '1': 'CS001', '2': 'CS002', '3': 'CS003',
+            '0-1': 20.0, '0-2': 40.0, '0-3': 60.0, '1-2': 5.0, '1-3': 30.0,
+            '2-3': 80.0}
+        time_ranges = [(1000.0, 2500.0), (2500.0, 4010.0)]
+        pre_average_multi.lofar = ParmDBModule(parms)
+        ionfactors = pre_average_multi.find_ionfactors('instrument', baseline_dict,
+            time_ranges, target_rms_rad=0.2)
+        expected = [reference_ionfactor(parms, baseline_dict, t1, t2, 0.2) for
+            t1, t2 in time_ranges]
+        np.testing.assert_allclose(ionfactors, expected, rtol=1e-12)
+
+
+@unittest.skipUnless(have_dependencies, 'scipy, casacore or lofar is not available')
+class TestGaussianSmooth(unittest.TestCase):
+
+    def check_against_gfilter(self, work, stddev):
+        expected = gfilter(work, stddev, axis=0)
+        pre_average_multi.gaussian_smooth(work, stddev)
+        self.assertLess(np.abs(work - expected).max(), 1e-12)
+        return expected
+
+    def test_direct(self):
+        stddev = 2.0
+        self.assertLess(int(4.0 * stddev + 0.5), pre_average_multi.FFT_MIN_RADIUS)
+        self.check_against_gfilter(make_work(300, (4, 2), slice(100, 150)), stddev)
+
+    def test_fft(self):
+        for nrows, stddev in [(2000, 20.0), (37, 50.0), (5, 40.0)]:
+            self.assertGreaterEqual(int(4.0 * stddev + 0.5),
+                pre_average_multi.FFT_MIN_RADIUS)
+            self.check_against_gfilter(make_work(nrows, (4, 2), slice(0, 0)), stddev)
+
+    def test_fft_flagged_gap(self):
+        # The smoothed data and weights must be exactly zero where no unflagged
+        # data lie within the kernel radius (80 samples), as with direct
+        # convolution
+        work = make_work(2000, (4, 2), slice(500, 1200))
+        expected = self.check_against_gfilter(work, 20.0)
+        self.assertTrue(np.all(expected[580:1120] == 0.0))
+        self.assertTrue(np.all(work[580:1120] == 0.0))
+        self.assertTrue(np.all(work[..., 2] >= 0.0))
+
+
+if __name__ == '__main__':
+    unittest.main()